@@ -0,0 +1,481 @@
+import asyncio
+import json
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+import paho.mqtt.client as mqtt
+
+from ingestor_decoder import dumps_rows
+from ingestor_metrics import SIZE_BUCKETS
+from ingestor_publisher import RateLimitedPublisher
+from ingestor_session import Backoff, SubscriptionSet, create_session_client, session_connect_options
+from ingestor_spool import DiskSpool
+
+# 停止批处理协程的哨兵对象（排在队列中已有数据之后）
+_STOP = object()
+
+
+class _AsyncioHelper:
+    """将paho客户端的socket挂到asyncio事件循环上，取代loop_start网络线程"""
+
+    def __init__(self, engine: "AsyncIngestor", client: mqtt.Client):
+        self.engine = engine
+        self.loop = engine.loop
+        self.client = client
+        self.fd: Optional[int] = None
+        self.misc_task: Optional[asyncio.Task] = None
+
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def _call(self, fn, *args):
+        """paho回调可能来自其他线程（如连接时），统一切回事件循环执行"""
+        if threading.get_ident() == self.engine.loop_thread_id:
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._call(self._opened, sock.fileno())
+
+    def _opened(self, fd: int):
+        self.fd = fd
+        self.engine.resume_reading()
+        if self.misc_task is None or self.misc_task.done():
+            self.misc_task = self.loop.create_task(self._misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self._call(self._closed)
+
+    def _closed(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+            self.fd = None
+        self.engine.reading = False
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._call(self._register_write)
+
+    def _register_write(self):
+        if self.fd is not None:
+            self.loop.add_writer(self.fd, self.client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self._unregister_write)
+
+    def _unregister_write(self):
+        if self.fd is not None:
+            self.loop.remove_writer(self.fd)
+
+    async def _misc_loop(self):
+        """处理心跳、超时重发等周期性任务"""
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+
+class AsyncIngestor:
+    """基于asyncio的单事件循环采集引擎
+
+    MQTT收包、解码、攒批和HTTP写库都在同一个事件循环中完成，
+    通过有界队列和在途写入数量上限控制并发。
+    """
+
+    def __init__(self,
+                 mqtt_config: Dict[str, Any],
+                 supabase_url: str,
+                 supabase_key: str,
+                 decode: Callable[[str, bytes], Optional[Dict[str, Any]]],
+                 table: str = "battery_cell_data",
+                 batch_size: int = 100,
+                 flush_interval: float = 1.0,
+                 max_queue_size: int = 10000,
+                 max_in_flight: int = 32,
+                 http_config: Optional[Dict[str, Any]] = None,
+                 publish_config: Optional[Dict[str, Any]] = None,
+                 spool_config: Optional[Dict[str, Any]] = None,
+                 conflict_column: Optional[str] = None,
+                 metrics=None,
+                 session_config: Optional[Dict[str, Any]] = None):
+        self.mqtt_config = mqtt_config
+        self.session_config = session_config
+        self.insert_url = f"{supabase_url}/rest/v1/{table}"
+        self.headers = {
+            "apikey": supabase_key,
+            "Authorization": f"Bearer {supabase_key}",
+            "Content-Type": "application/json",
+            "Prefer": "return=minimal",
+        }
+        if conflict_column:
+            # 按幂等键upsert，忽略已写入的重复数据
+            self.insert_url += f"?on_conflict={conflict_column}"
+            self.headers["Prefer"] = "resolution=ignore-duplicates,return=minimal"
+        self.decode = decode
+        self.table = table
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.max_in_flight = max(1, max_in_flight)
+        self.http_config = http_config or {}
+        self.spool_config = spool_config
+
+        # 写库耗时和批量大小直方图（传入MetricsRegistry时启用）
+        self.insert_latency = None
+        self.batch_rows = None
+        if metrics is not None:
+            self.insert_latency = metrics.histogram(
+                "ingestor_insert_latency_seconds", "批量写库耗时（秒）", ("table",))
+            self.batch_rows = metrics.histogram(
+                "ingestor_insert_batch_rows", "每批写入的行数", ("table",), buckets=SIZE_BUCKETS)
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.client: Optional[mqtt.Client] = None
+        self.connected = False
+        self.reading = False
+        # 未传会话配置时沿用非持久会话、QoS0订阅
+        if session_config:
+            self.subscriptions = SubscriptionSet(qos=session_config['subscribe_qos'])
+            self.backoff = Backoff(session_config['reconnect_min'], session_config['reconnect_max'])
+        else:
+            self.subscriptions = SubscriptionSet(qos=0)
+            self.backoff = Backoff(1.0, 60.0)
+        publish_config = publish_config or {}
+        self.max_inflight_messages = publish_config.get('max_inflight', 100)
+        self.publisher = RateLimitedPublisher(
+            lambda: self.client if self.connected else None,
+            rate=publish_config.get('rate', 50.0),
+            burst=publish_config.get('burst'),
+            ack_timeout=publish_config.get('ack_timeout', 30.0)
+        )
+
+        self._helper: Optional[_AsyncioHelper] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._http: Optional[httpx.AsyncClient] = None
+        self._spool: Optional[DiskSpool] = None
+        self._tasks: List[asyncio.Task] = []
+        self._batcher_task: Optional[asyncio.Task] = None
+        self._inserts: set = set()
+        self._disconnected: Optional[asyncio.Event] = None
+        self._stopping = False
+
+        # 统计信息
+        self.messages_received = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.sessions_resumed = 0
+        self.messages_dropped = 0
+        self.decode_errors = 0
+        self.messages_rejected = 0
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.rows_spooled = 0
+        self.batches_written = 0
+
+    # ------------------------------------------------------------------
+    # MQTT
+    # ------------------------------------------------------------------
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        """MQTT连接回调"""
+        if rc == 0:
+            session_present = bool(getattr(flags, 'session_present', False))
+            print(f"[OK] MQTT连接成功（asyncio模式，{'恢复会话' if session_present else '新会话'}）")
+            self.connected = True
+            self.connects += 1
+            self.backoff.reset()
+            if session_present:
+                self.sessions_resumed += 1
+            # 恢复会话时broker仍保留订阅，只补订缺失的主题
+            self.subscriptions.reset(session_present)
+            self.subscriptions.subscribe(client)
+        else:
+            print(f"[ERROR] MQTT连接失败，返回码: {rc}")
+            self.connected = False
+
+    def on_disconnect(self, client, userdata, flags, rc, properties=None):
+        """MQTT断开连接回调"""
+        print("[WARNING] MQTT连接断开")
+        self.connected = False
+        self.disconnects += 1
+        if self._disconnected is not None and not self._stopping:
+            self.loop.call_soon_threadsafe(self._disconnected.set)
+
+    def on_subscribe(self, client, userdata, mid, reason_codes, properties=None):
+        """SUBACK回调：记录broker已确认的订阅"""
+        rejected = self.subscriptions.acknowledged(mid, reason_codes)
+        if rejected:
+            print(f"[ERROR] broker拒绝订阅 {len(rejected)} 个主题: {', '.join(rejected[:5])}")
+
+    def on_message(self, client, userdata, msg):
+        """MQTT消息回调：只做解码，写库交给批处理协程"""
+        self.messages_received += 1
+        try:
+            row = self.decode(msg.topic, msg.payload)
+        except Exception as e:
+            self.decode_errors += 1
+            print(f"[ERROR] 处理MQTT消息时出错: {e}")
+            return
+        if row is None:
+            # 不合法或重复的消息，具体原因见解码器统计
+            self.messages_rejected += 1
+            return
+
+        try:
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            self.messages_dropped += 1
+            return
+        # 队列接近满时暂停读socket，把压力传回broker
+        if self._queue.qsize() >= self.max_queue_size * 0.9:
+            self.pause_reading()
+
+    def pause_reading(self):
+        if self.reading and self._helper and self._helper.fd is not None:
+            self.loop.remove_reader(self._helper.fd)
+            self.reading = False
+
+    def resume_reading(self):
+        if not self.reading and self._helper and self._helper.fd is not None:
+            self.loop.add_reader(self._helper.fd, self.client.loop_read)
+            self.reading = True
+
+    def subscribe(self, topic: str):
+        """订阅主题（断线重连后自动恢复）"""
+        self.subscriptions.add([topic])
+        if self.connected:
+            self.subscriptions.subscribe(self.client, [topic])
+            print(f"[OK] 订阅主题: {topic}")
+
+    def publish(self, topic: str, payload: Dict, qos: int = 0, retain: bool = False) -> bool:
+        """发布消息（可在其他线程中调用）"""
+        if not (self.connected and self.client):
+            print("[WARNING] MQTT客户端未连接，无法发布")
+            return False
+        result = self.client.publish(topic, json.dumps(payload), qos=qos, retain=retain)
+        return result.rc == mqtt.MQTT_ERR_SUCCESS
+
+    def broadcast(self, messages: List[tuple]):
+        """经限速发布器流水线发布一批消息，返回全部确认后完成的future"""
+        return self.publisher.broadcast(messages)
+
+    async def _connect(self):
+        """建立MQTT连接（阻塞的DNS/TLS握手放到线程池中执行）"""
+        config = self.mqtt_config
+        if self.session_config:
+            client = create_session_client(self.session_config)
+            options = session_connect_options(self.session_config)
+        else:
+            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+            options = {}
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        client.on_disconnect = self.on_disconnect
+        client.on_subscribe = self.on_subscribe
+        client.on_publish = self.publisher.on_publish
+        client.max_inflight_messages_set(self.max_inflight_messages)
+        client.username_pw_set(config['username'], config['password'])
+        if config['use_tls']:
+            client.tls_set(
+                cert_reqs=mqtt.ssl.CERT_NONE if config['insecure'] else mqtt.ssl.CERT_REQUIRED,
+                tls_version=config['tls_version']
+            )
+        self.client = client
+        self._helper = _AsyncioHelper(self, client)
+        await self.loop.run_in_executor(
+            None, lambda: client.connect(config['host'], config['port'], 60, **options))
+
+    async def _reconnect_loop(self):
+        """断线后复用同一客户端按抖动指数退避重连（持久会话由broker保留订阅和离线消息）"""
+        while not self._stopping:
+            await self._disconnected.wait()
+            await asyncio.sleep(self.backoff.next_delay())
+            if self._stopping:
+                break
+            if self.connected:
+                self._disconnected.clear()
+                continue
+            try:
+                print("[WARNING] MQTT连接断开，尝试重连...")
+                self._disconnected.clear()
+                await self.loop.run_in_executor(None, self.client.reconnect)
+            except Exception as e:
+                self._disconnected.set()
+                print(f"[ERROR] MQTT重连失败: {e}")
+
+    # ------------------------------------------------------------------
+    # 写库
+    # ------------------------------------------------------------------
+    async def _batcher(self):
+        """从队列攒批，达到批量大小或超时后提交写库；取到哨兵时提交手中的数据后退出"""
+        stopping = False
+        while not stopping:
+            row = await self._queue.get()
+            if row is _STOP:
+                return
+            batch = [row]
+            deadline = self.loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if row is _STOP:
+                    stopping = True
+                    break
+                batch.append(row)
+
+            if not self.reading and self._queue.qsize() <= self.max_queue_size // 2:
+                self.resume_reading()
+
+            # 在途写入达到上限时在此等待，队列随之积压，形成反压
+            await self._semaphore.acquire()
+            task = self.loop.create_task(self._insert(batch))
+            self._inserts.add(task)
+            task.add_done_callback(self._inserts.discard)
+
+    async def _post(self, rows: List[Dict[str, Any]]) -> bool:
+        """POST到PostgREST；返回False表示可重试的失败"""
+        started = time.perf_counter()
+        try:
+            response = await self._http.post(self.insert_url, content=dumps_rows(rows), headers=self.headers)
+            if self.insert_latency is not None:
+                self.insert_latency.observe(time.perf_counter() - started, table=self.table)
+                self.batch_rows.observe(len(rows), table=self.table)
+            if response.status_code < 300:
+                self.rows_written += len(rows)
+                self.batches_written += 1
+                return True
+            retryable = response.status_code >= 500 or response.status_code in (408, 429)
+            print(f"[ERROR] 批量写入 {self.table} 失败，状态码: {response.status_code}，共 {len(rows)} 条")
+        except httpx.HTTPError as e:
+            retryable = True
+            print(f"[ERROR] 批量写入 {self.table} 时出错: {e}")
+        if retryable and self._spool:
+            return False
+        self.rows_failed += len(rows)
+        return True
+
+    async def _insert(self, rows: List[Dict[str, Any]]):
+        try:
+            # 本地缓冲中还有待回放的数据时新数据也追加到缓冲，由回放协程按顺序写入，
+            # 与线程模式的写入管道一致，保证同一电池包的写入顺序
+            if self._spool and self._spool.pending():
+                await asyncio.to_thread(self._spool.append, rows)
+                self.rows_spooled += len(rows)
+                return
+            if not await self._post(rows):
+                await asyncio.to_thread(self._spool.append, rows)
+                self.rows_spooled += len(rows)
+        finally:
+            self._semaphore.release()
+
+    async def _replay_loop(self):
+        """定期回放本地缓冲中的数据"""
+        interval = self.spool_config['retry_interval']
+        while True:
+            await asyncio.sleep(interval)
+            while self._spool.pending():
+                rows, position = await asyncio.to_thread(self._spool.read_batch, self.batch_size)
+                if not rows or not await self._post(rows):
+                    break
+                await asyncio.to_thread(self._spool.commit, position, len(rows))
+
+    # ------------------------------------------------------------------
+    # 生命周期
+    # ------------------------------------------------------------------
+    async def start(self):
+        """启动引擎：连接MQTT并启动批处理、重连、回放协程"""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.http_config.get('max_connections', self.max_in_flight),
+                max_keepalive_connections=self.http_config.get('max_keepalive_connections', self.max_in_flight),
+                keepalive_expiry=self.http_config.get('keepalive_expiry', 30)
+            ),
+            timeout=self.http_config.get('timeout', 10)
+        )
+        if self.spool_config:
+            self._spool = await asyncio.to_thread(
+                DiskSpool,
+                f"{self.spool_config['directory']}/{self.table}/async",
+                self.spool_config['segment_bytes'],
+                self.spool_config['max_bytes'],
+                self.spool_config['fsync_interval'],
+                self.spool_config['fsync_every']
+            )
+            self._tasks.append(self.loop.create_task(self._replay_loop()))
+
+        self._batcher_task = self.loop.create_task(self._batcher())
+        self.publisher.start()
+        self._disconnected = asyncio.Event()
+        try:
+            await self._connect()
+        except Exception as e:
+            print(f"[ERROR] MQTT连接失败: {e}")
+            self._disconnected.set()
+        self._tasks.append(self.loop.create_task(self._reconnect_loop()))
+
+    async def stop(self):
+        """停止引擎，等待在途写入完成"""
+        self._stopping = True
+        self.publisher.stop()
+        if self.client:
+            self.client.disconnect()
+        # 批处理协程处理完队列中的数据（包括已取出、正在攒批的部分）后自行退出，不能直接取消
+        if self._batcher_task is not None:
+            await self._queue.put(_STOP)
+            await self._batcher_task
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._inserts:
+            await asyncio.gather(*self._inserts, return_exceptions=True)
+        # 刷新哨兵之后才到达的数据
+        remaining = []
+        while not self._queue.empty():
+            remaining.append(self._queue.get_nowait())
+        for i in range(0, len(remaining), self.batch_size):
+            await self._semaphore.acquire()
+            await self._insert(remaining[i:i + self.batch_size])
+        await self._http.aclose()
+        if self._spool:
+            self._spool.close()
+        print("[OK] asyncio采集引擎已停止")
+
+    def in_flight(self) -> int:
+        """在途的写库请求数"""
+        return len(self._inserts)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回引擎统计信息"""
+        return {
+            "messages_received": self.messages_received,
+            "connects": self.connects,
+            "sessions_resumed": self.sessions_resumed,
+            "disconnects": self.disconnects,
+            "messages_dropped": self.messages_dropped,
+            "decode_errors": self.decode_errors,
+            "messages_rejected": self.messages_rejected,
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "in_flight": self.in_flight(),
+            "rows_written": self.rows_written,
+            "rows_failed": self.rows_failed,
+            "rows_spooled": self.rows_spooled,
+            "spool_pending": self._spool.pending_rows if self._spool else 0,
+            "batches_written": self.batches_written,
+        }
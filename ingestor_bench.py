@@ -0,0 +1,368 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+BASE_TOPIC = "bms/telemetry/"
+
+
+# ----------------------------------------------------------------------
+# 负载生成
+# ----------------------------------------------------------------------
+def build_pack_payloads(packs: int, cells: int, temps: int, variants: int, seed: int) -> Dict[str, List[bytes]]:
+    """为每个电池包预生成若干份电芯数据（不含时间戳），发送时只拼接时间戳"""
+    rng = random.Random(seed)
+    payloads = {}
+    for i in range(packs):
+        packsn = f"BENCH{i:06d}"
+        base_voltage = rng.uniform(3.20, 3.35)
+        base_soc = rng.randint(20, 95)
+        base_temp = rng.uniform(20.0, 35.0)
+        bodies = []
+        for _ in range(variants):
+            body = {
+                "cell_voltages": [round(base_voltage + rng.uniform(-0.01, 0.01), 3) for _ in range(cells)],
+                "cell_socs": [base_soc + rng.randint(-1, 1) for _ in range(cells)],
+                "cell_temperatures": [round(base_temp + rng.uniform(-0.5, 0.5), 1) for _ in range(temps)],
+            }
+            # 去掉开头的'{'，发送时在前面拼接 {"ts":...,
+            bodies.append(json.dumps(body, separators=(',', ':'))[1:].encode('utf-8'))
+        payloads[packsn] = bodies
+    return payloads
+
+
+def paced_messages(payloads: Dict[str, List[bytes]], rate: float, duration: float, stop_event=None):
+    """按固定速率轮流产生各电池包的 (主题, payload)；payload中的ts为发送时刻"""
+    packsns = list(payloads)
+    topics = {packsn: f"{BASE_TOPIC}{packsn}" for packsn in packsns}
+    start = time.monotonic()
+    end = start + duration
+    sent = 0
+    while True:
+        now = time.monotonic()
+        if now >= end or (stop_event is not None and stop_event.is_set()):
+            return
+        if rate > 0:
+            # 按计划时间发送，落后时连续追赶，超前时等待
+            due = start + sent / rate
+            if due > now:
+                time.sleep(min(due - now, 0.01))
+                continue
+        packsn = packsns[sent % len(packsns)]
+        bodies = payloads[packsn]
+        body = bodies[(sent // len(packsns)) % len(bodies)]
+        yield topics[packsn], b'{"ts":%.6f,' % time.time() + body
+        sent += 1
+
+
+def run_broker_generator(host: str, port: int, args: Dict[str, Any], ready):
+    """在独立进程中向broker发布负载，避免生成端占用被测进程的CPU"""
+    import paho.mqtt.client as mqtt
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"bench-gen-{os.getpid()}")
+    client.max_queued_messages_set(0)
+    client.connect(host, port, 60)
+    client.loop_start()
+    payloads = build_pack_payloads(args['packs'], args['cells'], args['temps'], args['variants'], args['seed'])
+    ready.set()
+    for topic, payload in paced_messages(payloads, args['rate'], args['duration']):
+        client.publish(topic, payload, qos=args['qos'])
+    time.sleep(0.5)
+    client.disconnect()
+    client.loop_stop()
+
+
+# ----------------------------------------------------------------------
+# 写库端替身
+# ----------------------------------------------------------------------
+class LatencyRecorder:
+    """记录写库时每行的端到端延迟（发送时刻 -> 写库完成）"""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.rows = 0
+        self._lock = threading.Lock()
+
+    def record(self, sent_times: List[float]):
+        now = time.time()
+        with self._lock:
+            self.rows += len(sent_times)
+            self.latencies.extend(now - sent for sent in sent_times if sent)
+
+    def snapshot(self):
+        with self._lock:
+            return self.rows, list(self.latencies)
+
+    def reset(self):
+        with self._lock:
+            self.rows = 0
+            self.latencies = []
+
+
+def make_stub_sink(recorder: LatencyRecorder, latency_ms: float):
+    """桩sink：可选地模拟写库耗时，记录延迟后返回成功"""
+    def sink(rows: List[Dict[str, Any]]) -> bool:
+        if latency_ms > 0:
+            time.sleep(latency_ms / 1000.0)
+        recorder.record([row.get('bench_sent_at') for row in rows])
+        return True
+    return sink
+
+
+def start_fake_postgrest(recorder: LatencyRecorder, latency_ms: float) -> ThreadingHTTPServer:
+    """进程内的假PostgREST：解析请求体并记录延迟，包含真实的序列化和HTTP开销"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            raw = self.rfile.read(length)
+            rows = json.loads(raw)
+            if latency_ms > 0:
+                time.sleep(latency_ms / 1000.0)
+            recorder.record([row.get('bench_sent_at') for row in rows])
+            # 与PostgREST一致：return=representation时返回写入的行（写库端据此判断成功）
+            body = raw if 'return=minimal' not in self.headers.get('Prefer', '') else b''
+            self.send_response(201)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-postgrest", daemon=True).start()
+    return server
+
+
+# ----------------------------------------------------------------------
+# 进程资源
+# ----------------------------------------------------------------------
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def rss_mb() -> float:
+    """当前常驻内存（MB）"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        # 非Linux平台回退到峰值
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q / 100.0 * (len(values) - 1)))))
+    return values[index]
+
+
+# ----------------------------------------------------------------------
+# 基准测试
+# ----------------------------------------------------------------------
+def configure_environment(args):
+    """在导入ingestor_main之前设置环境变量，使全局实例按基准测试配置创建"""
+    os.environ.setdefault("SPOOL_ENABLED", "false")
+    os.environ.setdefault("METRICS_PORT", "0")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # 基准测试不在broker上留下持久会话
+    os.environ.setdefault("MQTT_CLIENT_ID", f"ingestor-bench-{os.getpid()}")
+    os.environ.setdefault("MQTT_SESSION_EXPIRY", "0")
+    if args.batch_size:
+        os.environ["BATCH_SIZE"] = str(args.batch_size)
+    if args.workers:
+        os.environ["INSERT_WORKERS"] = str(args.workers)
+    if args.sink == "postgrest":
+        os.environ["SINK_MODE"] = "postgrest"
+
+
+def run_benchmark(args) -> Dict[str, Any]:
+    configure_environment(args)
+    import ingestor_main as ingestor
+
+    recorder = LatencyRecorder()
+    server = None
+    if args.sink == "stub":
+        ingestor.write_pipeline.sink = make_stub_sink(recorder, args.sink_latency_ms)
+    else:
+        server = start_fake_postgrest(recorder, args.sink_latency_ms)
+        ingestor.SUPABASE_URL = f"http://127.0.0.1:{server.server_address[1]}"
+
+    # 把发送时刻带到写库端，用于计算端到端延迟
+    decoder = ingestor.telemetry_decoder
+    original_build_row = decoder.build_row
+
+    def build_row_with_sent_at(packsn, data, received_at=None, payload=None):
+        row = original_build_row(packsn, data, received_at, payload)
+        if row is not None and isinstance(data, dict):
+            row['bench_sent_at'] = data.get('ts')
+        return row
+
+    decoder.build_row = build_row_with_sent_at
+
+    ingestor.write_pipeline.start()
+    listener = ingestor.mqtt_listener
+    generator = None
+    stop_event = threading.Event()
+
+    if args.transport == "broker":
+        host, _, port = args.broker.partition(':')
+        ingestor.MQTT_CONFIG.update(host=host, port=int(port or 1883), use_tls=False)
+        if not listener.connect():
+            raise SystemExit(f"[ERROR] 无法连接broker {args.broker}")
+        listener.subscribe_packs_all()
+        time.sleep(0.5)
+        ctx = multiprocessing.get_context("spawn")
+        ready = ctx.Event()
+        generator = ctx.Process(target=run_broker_generator, args=(host, int(port or 1883), {
+            "packs": args.packs, "cells": args.cells, "temps": args.temps, "variants": args.variants,
+            "seed": args.seed, "rate": args.rate, "duration": args.warmup + args.duration, "qos": args.qos,
+        }, ready), daemon=True)
+        generator.start()
+        ready.wait(60)
+    else:
+        # 进程内传输：直接调用on_message，不经过网络（生成端CPU计入结果）
+        class _Message:
+            __slots__ = ('topic', 'payload')
+
+            def __init__(self, topic, payload):
+                self.topic = topic
+                self.payload = payload
+
+        payloads = build_pack_payloads(args.packs, args.cells, args.temps, args.variants, args.seed)
+
+        def feed():
+            for topic, payload in paced_messages(payloads, args.rate, args.warmup + args.duration, stop_event):
+                listener.on_message(None, None, _Message(topic, payload))
+
+        # 不调用connect()，收包通道需要在这里启动
+        if listener.ingest_lane is not None:
+            listener.ingest_lane.start()
+        generator = threading.Thread(target=feed, name="bench-feed", daemon=True)
+        generator.start()
+
+    # 预热后开始计量
+    time.sleep(args.warmup)
+    recorder.reset()
+    received_start = listener.messages_received
+    cpu_start = cpu_seconds()
+    wall_start = time.monotonic()
+    rss_samples = []
+    while time.monotonic() - wall_start < args.duration:
+        time.sleep(min(1.0, args.duration))
+        rss_samples.append(rss_mb())
+    wall = time.monotonic() - wall_start
+    cpu = cpu_seconds() - cpu_start
+    received = listener.messages_received - received_start
+
+    # 停止生成端，给管道一点时间排空（不计入吞吐）
+    stop_event.set()
+    if isinstance(generator, threading.Thread):
+        generator.join(5)
+    else:
+        generator.join(10)
+    rows, latencies = recorder.snapshot()
+    pipeline_stats = ingestor.write_pipeline.stats()
+    if listener.client:
+        listener.disconnect()
+    elif listener.ingest_lane is not None:
+        listener.ingest_lane.stop()
+    ingestor.write_pipeline.stop()
+    if server:
+        server.shutdown()
+
+    return {
+        "config": {
+            "transport": args.transport, "sink": args.sink, "packs": args.packs, "cells": args.cells,
+            "temps": args.temps, "target_rate": args.rate, "duration": args.duration, "qos": args.qos,
+            "batch_size": ingestor.PIPELINE_CONFIG['batch_size'], "workers": ingestor.PIPELINE_CONFIG['num_workers'],
+            "sink_latency_ms": args.sink_latency_ms, "seed": args.seed,
+        },
+        "messages_received": received,
+        "rows_written": rows,
+        "msgs_per_sec": round(received / wall, 1),
+        "rows_per_sec": round(rows / wall, 1),
+        "latency_ms": {
+            "p50": _ms(percentile(latencies, 50)),
+            "p99": _ms(percentile(latencies, 99)),
+            "max": _ms(max(latencies) if latencies else None),
+        },
+        "cpu_percent": round(100.0 * cpu / wall, 1),
+        "rss_mb": {"avg": round(sum(rss_samples) / len(rss_samples), 1), "max": round(max(rss_samples), 1)},
+        "rows_dropped": pipeline_stats['rows_dropped'],
+        "max_queue_depth": pipeline_stats['max_queue_depth'],
+        "decoder": decoder.stats(),
+    }
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000.0, 2) if seconds is not None else None
+
+
+def print_report(result: Dict[str, Any]):
+    config = result['config']
+    print("=" * 50)
+    print(f"[BENCH] 传输: {config['transport']}, 写库: {config['sink']}, 电池包: {config['packs']}, "
+          f"电芯: {config['cells']}, 目标速率: {config['target_rate']} 条/秒, 时长: {config['duration']} 秒")
+    print(f"[BENCH] 吞吐: {result['msgs_per_sec']} 条/秒收包, {result['rows_per_sec']} 行/秒写库")
+    latency = result['latency_ms']
+    print(f"[BENCH] 端到端延迟: p50 {latency['p50']} ms, p99 {latency['p99']} ms, 最大 {latency['max']} ms")
+    print(f"[BENCH] CPU: {result['cpu_percent']}%, RSS: 平均 {result['rss_mb']['avg']} MB, 峰值 {result['rss_mb']['max']} MB")
+    print(f"[BENCH] 丢弃: {result['rows_dropped']} 条, 最大队列深度: {result['max_queue_depth']}")
+    print("=" * 50)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="电池遥测采集性能基准测试")
+    parser.add_argument("--transport", choices=["inprocess", "broker"], default="inprocess",
+                        help="inprocess=直接调用on_message; broker=经本地MQTT broker（如mosquitto）")
+    parser.add_argument("--broker", default="127.0.0.1:1883", help="broker地址 host:port")
+    parser.add_argument("--sink", choices=["stub", "postgrest"], default="stub",
+                        help="stub=桩sink; postgrest=进程内假PostgREST（包含序列化和HTTP开销）")
+    parser.add_argument("--sink-latency-ms", type=float, default=0.0, help="模拟每批写库耗时（毫秒）")
+    parser.add_argument("--packs", type=int, default=100, help="模拟的电池包数量")
+    parser.add_argument("--cells", type=int, default=96, help="每包电芯数")
+    parser.add_argument("--temps", type=int, default=32, help="每包温度传感器数")
+    parser.add_argument("--variants", type=int, default=8, help="每包预生成的数据变体数")
+    parser.add_argument("--rate", type=float, default=1000.0, help="总发送速率（条/秒），0为尽快发送")
+    parser.add_argument("--duration", type=float, default=20.0, help="计量时长（秒）")
+    parser.add_argument("--warmup", type=float, default=3.0, help="预热时长（秒）")
+    parser.add_argument("--qos", type=int, choices=[0, 1], default=0)
+    parser.add_argument("--batch-size", type=int, default=0, help="覆盖BATCH_SIZE")
+    parser.add_argument("--workers", type=int, default=0, help="覆盖INSERT_WORKERS")
+    parser.add_argument("--seed", type=int, default=42, help="随机种子（保证负载可复现）")
+    parser.add_argument("--json", dest="json_path", help="把结果写入JSON文件")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = run_benchmark(args)
+    print_report(result)
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"[OK] 结果已写入 {args.json_path}")
+    # 冒烟检查：收到了消息却一行都没写入，说明收包到写库的链路断了；
+    # 写入了却没有延迟样本，说明发送时刻没有带到写库端，延迟结果无效
+    if result['messages_received'] and not result['rows_written']:
+        raise SystemExit("[ERROR] 基准测试期间没有写入任何数据")
+    if result['rows_written'] and result['latency_ms']['p50'] is None:
+        raise SystemExit("[ERROR] 基准测试没有采集到端到端延迟样本")
@@ -0,0 +1,237 @@
+import gzip
+import os
+import queue
+import struct
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from ingestor_metrics import get_logger
+
+# 捕获文件格式（整个文件为gzip流）：
+#   文件头  MAGIC(8字节)
+#   记录    <f64 接收时间><u16 主题长度><u32 payload长度><主题><payload>
+# 写入中的文件带.part后缀，滚动或关闭后改名，回放只读取已完成的文件
+MAGIC = b"BMSCAP01"
+_RECORD = struct.Struct("<dHI")
+CAPTURE_SUFFIX = ".cap.gz"
+_PARTIAL_SUFFIX = ".part"
+
+# 一条捕获的消息: (接收时间, 主题, payload)
+CapturedMessage = Tuple[float, str, bytes]
+
+# 关闭写入线程的哨兵对象
+_STOP = object()
+
+log = get_logger("ingestor.capture")
+
+
+class CaptureWriter:
+    """把收到的原始MQTT消息写入按大小/时间滚动的gzip文件
+
+    只记录 (接收时间, 主题, payload)，不做解码。record()只把消息放入有界队列（满时丢弃并计数），
+    压缩和写盘在独立的写入线程中进行，不阻塞MQTT网络线程；记录先追加到内存缓冲，
+    攒够buffer_bytes再整块压缩写盘。没有新消息时写入线程也会按rotate_seconds结束当前文件，
+    空闲时的.part文件同样能按时完成并被回放。
+    文件可回放到同一解码/校验/写入管道，用于补数和作为基准测试输入。
+    """
+
+    def __init__(self,
+                 directory: str,
+                 prefix: str = "capture",
+                 rotate_bytes: int = 64 * 1024 * 1024,
+                 rotate_seconds: float = 3600.0,
+                 compresslevel: int = 1,
+                 buffer_bytes: int = 256 * 1024,
+                 max_queue_size: int = 10000):
+        self.directory = directory
+        self.prefix = prefix
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.compresslevel = compresslevel
+        self.buffer_bytes = buffer_bytes
+        self.queue: "queue.Queue" = queue.Queue(maxsize=max_queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._buffer = bytearray()
+        self._raw = None
+        self._gzip: Optional[gzip.GzipFile] = None
+        self._path: Optional[str] = None
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.messages_captured = 0
+        self.messages_dropped = 0
+        self.bytes_captured = 0
+        self.files_completed = 0
+        self.write_errors = 0
+
+    def start(self):
+        """启动写入线程（重复调用无副作用）"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="capture-writer", daemon=True)
+        self._thread.start()
+
+    def record(self, topic: str, payload: bytes, received_at: Optional[float] = None):
+        """追加一条消息（只入队，不做IO）；队列满时丢弃并计数，不影响收包"""
+        try:
+            self.queue.put_nowait((time.time() if received_at is None else received_at, topic, payload))
+        except queue.Full:
+            self.messages_dropped += 1
+            log.warning("capture_full", "捕获队列已满，丢弃消息", messages_dropped=self.messages_dropped)
+
+    def _run(self):
+        # 没有新消息时也定期醒来检查按时间滚动
+        idle_wait = max(0.1, min(1.0, self.rotate_seconds))
+        while True:
+            try:
+                item = self.queue.get(timeout=idle_wait)
+            except queue.Empty:
+                with self._lock:
+                    if self._gzip is not None and time.monotonic() - self._opened_at >= self.rotate_seconds:
+                        self._safely(self._close)
+                continue
+            if item is _STOP:
+                return
+            with self._lock:
+                self._write(*item)
+
+    def _write(self, received_at: float, topic: str, payload: bytes):
+        raw_topic = topic.encode("utf-8")
+        header = _RECORD.pack(received_at, len(raw_topic), len(payload))
+        try:
+            if self._gzip is None:
+                self._open(received_at)
+            elif (self._raw.tell() >= self.rotate_bytes or
+                  time.monotonic() - self._opened_at >= self.rotate_seconds):
+                self._close()
+                self._open(received_at)
+            buffer = self._buffer
+            buffer += header
+            buffer += raw_topic
+            buffer += payload
+            if len(buffer) >= self.buffer_bytes:
+                self._flush()
+        except OSError as e:
+            self._write_failed(e)
+            return
+        self.messages_captured += 1
+        self.bytes_captured += len(payload)
+
+    def _write_failed(self, e: OSError):
+        self.write_errors += 1
+        if self.write_errors == 1 or self.write_errors % 1000 == 0:
+            print(f"[ERROR] 写入捕获文件失败（累计 {self.write_errors} 次）: {e}")
+
+    def _safely(self, action: Callable[[], Any]):
+        try:
+            action()
+        except OSError as e:
+            self._write_failed(e)
+
+    def _open(self, received_at: float):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.fromtimestamp(received_at).strftime("%Y%m%d%H%M%S")
+        path = os.path.join(self.directory, f"{self.prefix}-{stamp}-{self.files_completed:06d}{CAPTURE_SUFFIX}")
+        self._raw = open(path + _PARTIAL_SUFFIX, "wb")
+        self._gzip = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=self.compresslevel)
+        self._gzip.write(MAGIC)
+        self._path = path
+        self._opened_at = time.monotonic()
+
+    def _flush(self):
+        self._gzip.write(self._buffer)
+        self._buffer.clear()
+
+    def _close(self):
+        self._flush()
+        self._gzip.close()
+        self._raw.close()
+        os.replace(self._path + _PARTIAL_SUFFIX, self._path)
+        self._gzip = self._raw = self._path = None
+        self.files_completed += 1
+
+    def rotate(self):
+        """结束当前文件（之后的消息写入新文件）"""
+        with self._lock:
+            if self._gzip is not None:
+                self._safely(self._close)
+
+    def close(self, timeout: float = 10.0):
+        """写完已入队的消息后停止写入线程并结束当前文件"""
+        if self._thread is not None:
+            self.queue.put(_STOP)
+            self._thread.join(timeout)
+            self._thread = None
+        self.rotate()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "messages_captured": self.messages_captured,
+            "messages_dropped": self.messages_dropped,
+            "queue_depth": self.queue.qsize(),
+            "bytes_captured": self.bytes_captured,
+            "files_completed": self.files_completed,
+            "write_errors": self.write_errors,
+        }
+
+
+def capture_files(paths: Iterable[str]) -> List[str]:
+    """展开文件和目录参数，返回按文件名（即开始时间）排序的已完成捕获文件"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names if name.endswith(CAPTURE_SUFFIX))
+        else:
+            files.append(path)
+    return sorted(files, key=os.path.basename)
+
+
+def read_capture(path: str) -> Iterator[CapturedMessage]:
+    """逐条读取一个捕获文件；文件尾部不完整（进程被强制终止）时读到最后一条完整记录为止"""
+    with gzip.open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"不是捕获文件: {path}")
+        while True:
+            try:
+                header = f.read(_RECORD.size)
+                if len(header) < _RECORD.size:
+                    return
+                received_at, topic_length, payload_length = _RECORD.unpack(header)
+                topic = f.read(topic_length)
+                payload = f.read(payload_length)
+            except EOFError:
+                print(f"[WARNING] 捕获文件 {path} 不完整，已读到最后一条完整记录")
+                return
+            if len(topic) < topic_length or len(payload) < payload_length:
+                print(f"[WARNING] 捕获文件 {path} 不完整，已读到最后一条完整记录")
+                return
+            yield received_at, topic.decode("utf-8"), payload
+
+
+def replay_messages(files: List[str],
+                    speed: float = 0.0,
+                    accept: Optional[Callable[[str], bool]] = None,
+                    start_at: Optional[float] = None) -> Iterator[CapturedMessage]:
+    """按捕获顺序产生消息
+
+    speed<=0时尽快产生；否则按原始时间间隔的1/speed节奏产生（1为实时，10为10倍速）。
+    accept按主题过滤（多进程回放时各进程只处理自己的分片），
+    start_at为各进程共同的起始时刻（time.time()），保证多进程按同一时间轴推进。
+    """
+    first_ts = None
+    start = time.time() if start_at is None else start_at
+    for path in files:
+        for received_at, topic, payload in read_capture(path):
+            if first_ts is None:
+                first_ts = received_at
+            if accept is not None and not accept(topic):
+                continue
+            if speed > 0:
+                delay = start + (received_at - first_ts) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            yield received_at, topic, payload
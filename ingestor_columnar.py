@@ -0,0 +1,211 @@
+import io
+import os
+import threading
+import time
+from array import array
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from ingestor_decoder import CELL_ARRAY_FIELDS
+
+
+def _value_kind(values) -> str:
+    """电芯数组的数值类型: i=整数, f=float32, d=float64"""
+    if isinstance(values, array):
+        return 'f' if values.typecode == 'f' else ('d' if values.typecode == 'd' else 'i')
+    if isinstance(values, np.ndarray):
+        if values.dtype.kind in ('i', 'u'):
+            return 'i'
+        return 'f' if values.dtype == np.float32 else 'd'
+    return 'i' if all(type(v) is int for v in values) else 'd'
+
+
+class CellMatrix:
+    """定宽电芯矩阵：每行一个电池包读数，短于最大宽度的行用填充值补齐"""
+
+    def __init__(self, rows: List[Any]):
+        self.lengths = np.fromiter((len(values) for values in rows), dtype=np.int32, count=len(rows))
+        width = int(self.lengths.max()) if len(rows) else 0
+        kinds = {_value_kind(values) for values in rows}
+        self.is_integer = kinds <= {'i'}
+        # 全部为float32时保持float32，否则用float64避免损失精度
+        self.is_float32 = not self.is_integer and kinds <= {'i', 'f'}
+        dtype = np.int32 if self.is_integer else (np.float32 if self.is_float32 else np.float64)
+        self.values = np.full((len(rows), width), 0 if self.is_integer else np.nan, dtype=dtype)
+        for i, values in enumerate(rows):
+            if len(values):
+                self.values[i, :len(values)] = values
+
+    def flat(self):
+        """按行展开的有效值和偏移量（供Arrow列表列使用）"""
+        mask = np.arange(self.values.shape[1]) < self.lengths[:, None]
+        offsets = np.zeros(len(self.lengths) + 1, dtype=np.int32)
+        np.cumsum(self.lengths, out=offsets[1:])
+        return self.values[mask], offsets
+
+    def row_text(self, i: int) -> List[str]:
+        """第i行的有效值格式化为文本（float32保留7位有效数字）"""
+        values = self.values[i, :self.lengths[i]].tolist()
+        if self.is_float32:
+            return ['%.7g' % v for v in values]
+        return [repr(v) for v in values]
+
+
+class ColumnarBatch:
+    """按列组织的一批battery_cell_data：packsn、时间戳和定宽电芯矩阵"""
+
+    def __init__(self, rows: List[Dict[str, Any]]):
+        self.size = len(rows)
+        self.packsn = [row['packsn'] for row in rows]
+        self.created_at = [row['created_at'] for row in rows]
+        self.cells = {field: CellMatrix([row[field] for row in rows]) for field in CELL_ARRAY_FIELDS}
+        # 其他标量字段（如幂等键）按原样保留为列
+        extra_keys = [key for key in (rows[0] if rows else {})
+                      if key not in CELL_ARRAY_FIELDS and key not in ('packsn', 'created_at')]
+        self.extra = {key: [row.get(key) for row in rows] for key in extra_keys}
+
+    def columns(self) -> List[str]:
+        return ['packsn', *CELL_ARRAY_FIELDS, 'created_at', *self.extra]
+
+
+def _copy_escape(value: Any) -> str:
+    """COPY文本格式转义"""
+    if value is None:
+        return '\\N'
+    text = str(value)
+    return text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class PostgresCopySink:
+    """通过PostgreSQL COPY批量写入，每个写入线程使用独立连接"""
+
+    def __init__(self, dsn: str, table: str = "battery_cell_data", array_format: str = "pg_array",
+                 conflict_column: Optional[str] = None):
+        import psycopg2  # 仅在使用COPY模式时需要
+        self.psycopg2 = psycopg2
+        self.dsn = dsn
+        self.table = table
+        # 设置幂等键列时先COPY到临时表，再INSERT ... ON CONFLICT DO NOTHING
+        self.conflict_column = conflict_column
+        self.stage_table = f"_stage_{table}"
+        # pg_array: {1,2,3} 写入 real[]/int[] 列；json: [1,2,3] 写入 json/jsonb 列
+        self.array_format = array_format
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or conn.closed:
+            conn = self.psycopg2.connect(self.dsn)
+            self._local.conn = conn
+        return conn
+
+    def _array_literal(self, items: List[str]) -> str:
+        if self.array_format == "json":
+            return '[' + ','.join(items) + ']'
+        return '{' + ','.join(items) + '}'
+
+    def to_copy_text(self, batch: ColumnarBatch) -> str:
+        """将列式批次编码为COPY文本格式"""
+        lines = []
+        cells = [batch.cells[field] for field in CELL_ARRAY_FIELDS]
+        extra = list(batch.extra.values())
+        for i in range(batch.size):
+            fields = [_copy_escape(batch.packsn[i])]
+            fields.extend(self._array_literal(matrix.row_text(i)) for matrix in cells)
+            fields.append(_copy_escape(batch.created_at[i]))
+            fields.extend(_copy_escape(column[i]) for column in extra)
+            lines.append('\t'.join(fields))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def __call__(self, rows: List[Dict[str, Any]]) -> bool:
+        batch = ColumnarBatch(rows)
+        buffer = io.StringIO(self.to_copy_text(batch))
+        columns = ', '.join(batch.columns())
+        conn = self._connection()
+        try:
+            with conn.cursor() as cursor:
+                if self.conflict_column:
+                    cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {self.stage_table} "
+                                   f"(LIKE {self.table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS")
+                    cursor.copy_expert(f"COPY {self.stage_table} ({columns}) FROM STDIN", buffer)
+                    cursor.execute(f"INSERT INTO {self.table} ({columns}) SELECT {columns} FROM {self.stage_table} "
+                                   f"ON CONFLICT ({self.conflict_column}) DO NOTHING")
+                else:
+                    cursor.copy_expert(f"COPY {self.table} ({columns}) FROM STDIN", buffer)
+            conn.commit()
+        except Exception:
+            # 连接可能已失效，下次重新建立
+            try:
+                conn.close()
+            except Exception:
+                pass
+            self._local.conn = None
+            raise
+        return True
+
+
+class ParquetSegmentSink:
+    """把每批数据写成Parquet段文件，供之后批量导入"""
+
+    def __init__(self, directory: str, table: str = "battery_cell_data", compression: str = "zstd"):
+        import pyarrow  # 仅在使用Parquet模式时需要
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.directory = os.path.join(directory, table)
+        self.table = table
+        self.compression = compression
+        self._seq = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _cell_column(self, matrix: CellMatrix):
+        values, offsets = matrix.flat()
+        return self.pa.ListArray.from_arrays(self.pa.array(offsets), self.pa.array(values))
+
+    def to_arrow(self, batch: ColumnarBatch):
+        """将列式批次转换为Arrow表"""
+        pa = self.pa
+        columns = {
+            'packsn': pa.array(batch.packsn, type=pa.string()),
+            'created_at': pa.array([datetime.fromisoformat(ts) for ts in batch.created_at],
+                                   type=pa.timestamp('s', tz='Asia/Shanghai')),
+        }
+        for field in CELL_ARRAY_FIELDS:
+            columns[field] = self._cell_column(batch.cells[field])
+        for key, values in batch.extra.items():
+            columns[key] = pa.array(values)
+        return pa.table(columns)
+
+    def __call__(self, rows: List[Dict[str, Any]]) -> bool:
+        table = self.to_arrow(ColumnarBatch(rows))
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+        name = f"{self.table}-{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}-{threading.get_ident() % 10000:04d}-{seq:08d}.parquet"
+        path = os.path.join(self.directory, name)
+        # 先写临时文件再改名，导入程序不会读到写了一半的文件
+        tmp_path = path + ".tmp"
+        self.pq.write_table(table, tmp_path, compression=self.compression)
+        os.replace(tmp_path, path)
+        return True
+
+
+def create_columnar_sink(config: Dict[str, Any], table: str = "battery_cell_data",
+                         conflict_column: Optional[str] = None) -> Optional[Any]:
+    """按配置创建列式写入sink；mode为postgrest时返回None"""
+    mode = config.get('mode', 'postgrest')
+    if mode == 'copy':
+        if not config.get('dsn'):
+            raise ValueError("SINK_MODE=copy 需要配置 DATABASE_URL")
+        return PostgresCopySink(config['dsn'], table=table, array_format=config.get('array_format', 'pg_array'),
+                                conflict_column=conflict_column)
+    if mode == 'parquet':
+        return ParquetSegmentSink(config['parquet_dir'], table=table,
+                                  compression=config.get('parquet_compression', 'zstd'))
+    if mode != 'postgrest':
+        raise ValueError(f"未知的SINK_MODE: {mode}")
+    return None
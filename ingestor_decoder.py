@@ -0,0 +1,236 @@
+import json
+import time
+from array import array
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+from ingestor_dedup import message_digest, idempotency_key
+from ingestor_metrics import get_logger
+
+# 逐条消息的错误日志按事件类型限流
+log = get_logger("ingestor.decoder")
+
+try:
+    import orjson
+except ImportError:  # orjson为可选依赖，缺失时回退到标准库json
+    orjson = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 需要转换为定长数组的字段
+CELL_ARRAY_FIELDS = ('cell_voltages', 'cell_socs', 'cell_temperatures')
+
+# 字段长度对应的电池包元数据
+_LENGTH_FIELDS = {
+    'cell_voltages': 'number_of_cells',
+    'cell_socs': 'number_of_cells',
+    'cell_temperatures': 'number_of_temperature_sensors',
+}
+
+_INT32_MIN = -(1 << 31)
+_INT32_MAX = (1 << 31) - 1
+
+
+def get_json_loads(backend: str = "auto") -> Callable[[bytes], Any]:
+    """选择JSON解析实现: auto(有orjson则用) / orjson / json"""
+    if backend == "orjson" or (backend == "auto" and orjson is not None):
+        if orjson is None:
+            raise ImportError("JSON_BACKEND=orjson 需要安装 orjson")
+        return orjson.loads
+    return json.loads
+
+
+def to_json_list(values) -> Any:
+    """将定长数组转换为可JSON序列化的列表；float32按7位有效数字还原，避免3.3变成3.299999952"""
+    if isinstance(values, array):
+        if values.typecode == 'f':
+            return [float('%.7g' % v) for v in values]
+        return values.tolist()
+    if np is not None and isinstance(values, np.ndarray):
+        if values.dtype == np.float32:
+            return [float('%.7g' % v) for v in values.tolist()]
+        return values.tolist()
+    return values
+
+
+def jsonable_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """将行中的定长数组转换为列表，供PostgREST/JSON写入"""
+    return {key: to_json_list(value) for key, value in row.items()}
+
+
+def dumps_rows(rows) -> bytes:
+    """序列化一批行为JSON字节串"""
+    rows = [jsonable_row(row) for row in rows]
+    if orjson is not None:
+        return orjson.dumps(rows)
+    return json.dumps(rows, separators=(',', ':')).encode('utf-8')
+
+
+class TelemetryDecoder:
+    """遥测消息解码器
+
+    直接从payload字节解析JSON（优先使用orjson），按电池包元数据校验数组长度，
+    并把电芯数组转换为紧凑的定长数组（array或NumPy），替代Python float列表。
+    """
+
+    def __init__(self,
+                 registry=None,
+                 json_backend: str = "auto",
+                 array_backend: str = "array",
+                 float_typecode: str = "f",
+                 strict_lengths: bool = True,
+                 validate_packsn: bool = False,
+                 tz=None,
+                 dedup=None,
+                 dedup_key_column: Optional[str] = None):
+        self.registry = registry
+        self.loads = get_json_loads(json_backend)
+        if array_backend == "numpy" and np is None:
+            raise ImportError("DECODER_ARRAY_BACKEND=numpy 需要安装 numpy")
+        self.array_backend = array_backend
+        self.float_typecode = float_typecode
+        self.strict_lengths = strict_lengths
+        self.validate_packsn = validate_packsn
+        self.tz = tz
+        # 内存去重窗口（DedupWindow），以及写库时携带幂等键的列名
+        self.dedup = dedup
+        self.dedup_key_column = dedup_key_column
+
+        # created_at精确到秒，同一秒内复用格式化结果
+        self._ts_second = None
+        self._ts_text = None
+
+        # 统计信息
+        self.messages_decoded = 0
+        self.decode_errors = 0
+        self.missing_fields = 0
+        self.length_mismatches = 0
+        self.unknown_packs = 0
+        self.duplicates = 0
+
+    def created_at(self, received_at: Optional[float] = None) -> str:
+        """接收时间（默认当前时间，秒级，带时区）的ISO字符串"""
+        second = int(time.time() if received_at is None else received_at)
+        if second != self._ts_second:
+            self._ts_text = datetime.fromtimestamp(second, self.tz).isoformat()
+            self._ts_second = second
+        return self._ts_text
+
+    @staticmethod
+    def packsn_from_topic(topic: str) -> str:
+        """从主题中提取packsn (bms/telemetry/PKG001 -> PKG001)"""
+        return topic[topic.rfind('/') + 1:].strip()
+
+    def _to_array(self, values):
+        """将JSON列表转换为定长数组；全为整数时保留整数类型"""
+        if not isinstance(values, list):
+            raise TypeError(f"期望数组，实际为 {type(values).__name__}")
+        is_int = all(type(v) is int and _INT32_MIN <= v <= _INT32_MAX for v in values)
+        if self.array_backend == "numpy":
+            dtype = np.int32 if is_int else (np.float32 if self.float_typecode == 'f' else np.float64)
+            return np.asarray(values, dtype=dtype)
+        return array('i' if is_int else self.float_typecode, values)
+
+    def _check_lengths(self, packsn: str, row: Dict[str, Any]) -> bool:
+        """按电池包元数据校验电芯/温度传感器数量"""
+        if self.registry is None:
+            return True
+        pack = self.registry.peek(packsn)
+        if pack is None:
+            return True
+        for field, meta_key in _LENGTH_FIELDS.items():
+            expected = pack.get(meta_key)
+            if expected is None:
+                continue
+            try:
+                expected = int(expected)
+            except (TypeError, ValueError):
+                continue
+            actual = len(row[field])
+            if actual != expected:
+                self.length_mismatches += 1
+                log.error("length_mismatch", "数组长度与电池包元数据不符",
+                          packsn=packsn, field=field, actual=actual, expected=expected)
+                if self.strict_lengths:
+                    return False
+        return True
+
+    def build_row(self,
+                  packsn: str,
+                  data: Dict,
+                  received_at: Optional[float] = None,
+                  payload: Optional[bytes] = None) -> Optional[Dict[str, Any]]:
+        """校验已解析的消息并构建battery_cell_data行，不合法或重复时返回None
+
+        received_at为消息的接收时间（回放捕获的消息时传入），默认取当前时间。
+        payload为原始消息字节，传入时按去重窗口判断重复并写入幂等键。
+        """
+        row = self._build_row(packsn, data, received_at)
+        if row is None:
+            return None
+        if payload is not None and (self.dedup is not None or self.dedup_key_column):
+            # 先校验再计算指纹，不合法的消息不会占用去重窗口，也不会被计为重复
+            digest, has_device_ts = message_digest(packsn, payload, data)
+            # 只有带设备时间戳的消息才能可靠判断重复；没有时间戳时相同数值可能是不同时刻的真实读数
+            if has_device_ts and self.dedup is not None and self.dedup.seen(digest):
+                self.duplicates += 1
+                return None
+            if self.dedup_key_column:
+                row[self.dedup_key_column] = idempotency_key(digest, has_device_ts, row["created_at"])
+        self.messages_decoded += 1
+        return row
+
+    def _build_row(self, packsn: str, data: Dict, received_at: Optional[float]) -> Optional[Dict[str, Any]]:
+        """校验并构建一行（不做去重，不计入messages_decoded）"""
+        if not isinstance(data, dict):
+            self.decode_errors += 1
+            log.error("not_object", "消息不是JSON对象", packsn=packsn)
+            return None
+
+        # 验证必需的字段
+        for field in CELL_ARRAY_FIELDS:
+            if field not in data:
+                self.missing_fields += 1
+                log.error("missing_field", "消息缺少必需字段", packsn=packsn, field=field)
+                return None
+
+        if self.validate_packsn and self.registry is not None and not self.registry.contains(packsn):
+            self.unknown_packs += 1
+            return None
+
+        row = {"packsn": packsn}
+        try:
+            for field in CELL_ARRAY_FIELDS:
+                row[field] = self._to_array(data[field])
+        except (TypeError, OverflowError) as e:
+            self.decode_errors += 1
+            log.error("bad_array", "字段不是数值数组", packsn=packsn, field=field, error=e)
+            return None
+        if not self._check_lengths(packsn, row):
+            return None
+        row["created_at"] = self.created_at(received_at)
+        return row
+
+    def decode(self, topic: str, payload: bytes, received_at: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """直接从payload字节解码一条遥测消息"""
+        try:
+            data = self.loads(payload)
+        except ValueError as e:
+            self.decode_errors += 1
+            log.error("bad_json", "解析MQTT消息JSON时出错", topic=topic, error=e)
+            return None
+        return self.build_row(self.packsn_from_topic(topic), data, received_at, payload)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回解码统计信息"""
+        return {
+            "messages_decoded": self.messages_decoded,
+            "decode_errors": self.decode_errors,
+            "missing_fields": self.missing_fields,
+            "length_mismatches": self.length_mismatches,
+            "unknown_packs": self.unknown_packs,
+            "duplicates": self.duplicates,
+        }
@@ -0,0 +1,111 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+# 设备侧时间戳字段（按顺序取第一个存在的）
+DEVICE_TIMESTAMP_FIELDS = ('timestamp', 'ts', 'device_time', 'time')
+
+
+def device_timestamp(data: Dict[str, Any]) -> Optional[str]:
+    """取消息中的设备时间戳，没有时返回None"""
+    for field in DEVICE_TIMESTAMP_FIELDS:
+        value = data.get(field)
+        if value is not None and value != '':
+            return str(value)
+    return None
+
+
+def message_digest(packsn: str, payload: bytes, data: Dict[str, Any]) -> Tuple[bytes, bool]:
+    """计算消息指纹：有设备时间戳时按(packsn, 时间戳)，否则按(packsn, payload)
+
+    返回 (指纹, 是否基于设备时间戳)
+    """
+    ts = device_timestamp(data)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(packsn.encode('utf-8'))
+    h.update(b'\x00')
+    if ts is not None:
+        h.update(ts.encode('utf-8'))
+    else:
+        h.update(payload)
+    return h.digest(), ts is not None
+
+
+def idempotency_key(digest: bytes, has_device_ts: bool, created_at: str) -> str:
+    """写库用的确定性幂等键
+
+    有设备时间戳时同一读数的键始终相同；没有时加入入库时间（秒），
+    避免把不同时刻上报的相同数值当作重复数据永久拒绝。
+    """
+    if has_device_ts:
+        return digest.hex()
+    return hashlib.blake2b(digest + created_at.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class DedupWindow:
+    """内存去重窗口（有界有序字典 + TTL）
+
+    记录最近见过的消息指纹，窗口内再次出现的指纹视为QoS1重发或重连风暴带来的重复消息。
+    解码器只对带设备时间戳的消息使用窗口，没有时间戳的相同读数不视为重复。
+    指纹按首次出现的时间排序，超过容量时淘汰最早的指纹，超过TTL的指纹不再视为重复。
+    """
+
+    def __init__(self, capacity: int = 100000, ttl: float = 30.0):
+        self.capacity = max(1, capacity)
+        self.ttl = ttl
+        self._entries: "OrderedDict[bytes, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def seen(self, key: bytes) -> bool:
+        """检查并记录指纹；窗口内已出现过时返回True"""
+        now = time.monotonic()
+        with self._lock:
+            entries = self._entries
+            seen_at = entries.get(key)
+            if seen_at is not None:
+                if now - seen_at < self.ttl:
+                    # 命中不刷新时间，否则持续重复的相同数值会被一直过滤
+                    self.hits += 1
+                    return True
+                self.expired += 1
+            entries[key] = now
+            entries.move_to_end(key)
+            self.misses += 1
+            # 队首是最早的指纹：淘汰已过期的，再按容量淘汰
+            while entries:
+                oldest_key, oldest_at = next(iter(entries.items()))
+                if now - oldest_at < self.ttl and len(entries) <= self.capacity:
+                    break
+                del entries[oldest_key]
+                if now - oldest_at < self.ttl:
+                    self.evictions += 1
+            return False
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def size(self) -> int:
+        """窗口中当前的指纹数"""
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回去重窗口统计信息"""
+        total = self.hits + self.misses
+        return {
+            "size": self.size(),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "expired": self.expired,
+        }
@@ -0,0 +1,234 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from ingestor_decoder import CELL_ARRAY_FIELDS
+
+MODES = ('off', 'deadband', 'rollup', 'both')
+
+
+class _PackState:
+    """单个电池包的降采样状态，大小只与电芯数有关"""
+
+    __slots__ = ('last', 'last_written_at', 'window_start', 'window_shape',
+                 'count', 'sum', 'min', 'max')
+
+    def __init__(self):
+        # 死区：上一次写入的向量
+        self.last: Optional[Dict[str, np.ndarray]] = None
+        self.last_written_at = 0.0
+        # 汇总：当前窗口的累加器
+        self.window_start: Optional[float] = None
+        self.window_shape = None
+        self.count = 0
+        self.sum: Dict[str, np.ndarray] = {}
+        self.min: Dict[str, np.ndarray] = {}
+        self.max: Dict[str, np.ndarray] = {}
+
+
+class PackDownsampler:
+    """按电池包的边缘降采样
+
+    deadband: 只有任一电芯的变化超过死区，或距上次写入超过心跳间隔时才写入原始行；
+    rollup: 每个时间窗口输出一行各电芯的min/max/mean汇总；
+    both: 同时启用两者。状态按packsn保存，超过max_packs时淘汰最久未上报的电池包。
+    """
+
+    def __init__(self,
+                 mode: str = "off",
+                 deadbands: Optional[Dict[str, float]] = None,
+                 heartbeat_interval: float = 60.0,
+                 rollup_window: float = 60.0,
+                 emit_rollup: Optional[Callable[[Dict[str, Any]], Any]] = None,
+                 max_packs: int = 100000,
+                 tz=None):
+        if mode not in MODES:
+            raise ValueError(f"未知的降采样模式: {mode}")
+        self.mode = mode
+        self.deadband_enabled = mode in ('deadband', 'both')
+        self.rollup_enabled = mode in ('rollup', 'both')
+        self.deadbands = {field: float((deadbands or {}).get(field, 0.0)) for field in CELL_ARRAY_FIELDS}
+        self.heartbeat_interval = heartbeat_interval
+        self.rollup_window = rollup_window
+        self.emit_rollup = emit_rollup
+        self.max_packs = max(1, max_packs)
+        self.tz = tz
+
+        self._packs: "OrderedDict[str, _PackState]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # 统计信息
+        self.rows_in = 0
+        self.rows_passed = 0
+        self.rows_suppressed = 0
+        self.heartbeats = 0
+        self.rollups_emitted = 0
+        self.packs_evicted = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != 'off'
+
+    # ------------------------------------------------------------------
+    # 热路径
+    # ------------------------------------------------------------------
+    def process(self, row: Dict[str, Any], now: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """处理一行遥测数据，返回需要写入的原始行（被死区过滤时返回None）
+
+        now为该行的接收时间（回放捕获的消息时传入），默认取当前时间。
+        """
+        if not self.enabled:
+            return row
+        now = time.time() if now is None else now
+        vectors = {field: np.asarray(row[field], dtype=np.float64) for field in CELL_ARRAY_FIELDS}
+        rollups = []
+        with self._lock:
+            self.rows_in += 1
+            state = self._state(row['packsn'], rollups, now)
+            if self.rollup_enabled:
+                self._accumulate(row['packsn'], state, vectors, now, rollups)
+            if self.deadband_enabled:
+                write = self._deadband(state, vectors, now)
+            else:
+                # 仅汇总模式不写原始行
+                write = not self.rollup_enabled
+            if write:
+                self.rows_passed += 1
+            else:
+                self.rows_suppressed += 1
+        self._emit(rollups)
+        return row if write else None
+
+    def _state(self, packsn: str, rollups: List[Dict[str, Any]], now: float) -> _PackState:
+        state = self._packs.get(packsn)
+        if state is None:
+            state = self._packs[packsn] = _PackState()
+            while len(self._packs) > self.max_packs:
+                evicted_sn, evicted = self._packs.popitem(last=False)
+                self.packs_evicted += 1
+                if evicted.count:
+                    rollups.append(self._close_window(evicted_sn, evicted, now))
+        else:
+            self._packs.move_to_end(packsn)
+        return state
+
+    def _deadband(self, state: _PackState, vectors: Dict[str, np.ndarray], now: float) -> bool:
+        """与上次写入的向量比较，任一电芯超出死区或到达心跳间隔时写入"""
+        last = state.last
+        write = last is None
+        if not write:
+            for field, values in vectors.items():
+                previous = last[field]
+                # 电芯数量变化或任一电芯变化超过死区
+                if values.shape != previous.shape or np.any(np.abs(values - previous) > self.deadbands[field]):
+                    write = True
+                    break
+        if not write and now - state.last_written_at >= self.heartbeat_interval:
+            write = True
+            self.heartbeats += 1
+        if write:
+            state.last = vectors
+            state.last_written_at = now
+        return write
+
+    def _accumulate(self, packsn: str, state: _PackState, vectors: Dict[str, np.ndarray],
+                    now: float, rollups: List[Dict[str, Any]]):
+        """把一行累加到当前窗口；窗口到期或电芯数量变化时先输出汇总"""
+        shape = tuple(vectors[field].shape for field in CELL_ARRAY_FIELDS)
+        if state.count and (shape != state.window_shape or now - state.window_start >= self.rollup_window):
+            rollups.append(self._close_window(packsn, state, now))
+        if not state.count:
+            state.window_start = now
+            state.window_shape = shape
+            state.sum = {field: values.copy() for field, values in vectors.items()}
+            state.min = {field: values.copy() for field, values in vectors.items()}
+            state.max = {field: values.copy() for field, values in vectors.items()}
+        else:
+            for field, values in vectors.items():
+                state.sum[field] += values
+                np.minimum(state.min[field], values, out=state.min[field])
+                np.maximum(state.max[field], values, out=state.max[field])
+        state.count += 1
+
+    def _close_window(self, packsn: str, state: _PackState, now: float) -> Dict[str, Any]:
+        """生成当前窗口的汇总行并清空累加器"""
+        window_end = min(now, state.window_start + self.rollup_window)
+        rollup = {
+            "packsn": packsn,
+            "window_start": datetime.fromtimestamp(int(state.window_start), self.tz).isoformat(),
+            "window_end": datetime.fromtimestamp(int(window_end), self.tz).isoformat(),
+            "samples": state.count,
+        }
+        for field in CELL_ARRAY_FIELDS:
+            rollup[f"{field}_min"] = state.min[field].astype(np.float32)
+            rollup[f"{field}_max"] = state.max[field].astype(np.float32)
+            rollup[f"{field}_mean"] = (state.sum[field] / state.count).astype(np.float32)
+        state.count = 0
+        state.window_start = None
+        state.sum, state.min, state.max = {}, {}, {}
+        self.rollups_emitted += 1
+        return rollup
+
+    def _emit(self, rollups: List[Dict[str, Any]]):
+        if not rollups or self.emit_rollup is None:
+            return
+        for rollup in rollups:
+            try:
+                self.emit_rollup(rollup)
+            except Exception as e:
+                print(f"[ERROR] 提交电池包 {rollup['packsn']} 的汇总数据时出错: {e}")
+
+    # ------------------------------------------------------------------
+    # 窗口到期检查（停止上报的电池包也要输出最后一个窗口）
+    # ------------------------------------------------------------------
+    def flush_expired(self, force: bool = False):
+        """输出所有已到期的窗口；force为True时输出全部未完成的窗口"""
+        if not self.rollup_enabled:
+            return
+        now = time.time()
+        rollups = []
+        with self._lock:
+            for packsn, state in self._packs.items():
+                if state.count and (force or now - state.window_start >= self.rollup_window):
+                    rollups.append(self._close_window(packsn, state, now))
+        self._emit(rollups)
+
+    def _run(self):
+        interval = max(0.5, min(self.rollup_window / 4, 5.0))
+        while not self._stop_event.wait(interval):
+            self.flush_expired()
+
+    def start(self):
+        """启动窗口到期检查线程（重复调用无副作用）"""
+        if not self.rollup_enabled or (self._thread and self._thread.is_alive()):
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="downsample-rollup", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止检查线程并输出所有未完成的窗口"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(5.0)
+            self._thread = None
+        self.flush_expired(force=True)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回降采样统计信息"""
+        return {
+            "mode": self.mode,
+            "packs": len(self._packs),
+            "rows_in": self.rows_in,
+            "rows_passed": self.rows_passed,
+            "rows_suppressed": self.rows_suppressed,
+            "heartbeats": self.heartbeats,
+            "rollups_emitted": self.rollups_emitted,
+            "packs_evicted": self.packs_evicted,
+        }
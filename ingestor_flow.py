@@ -0,0 +1,158 @@
+import queue
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ingestor_metrics import get_logger
+from ingestor_publisher import TokenBucket
+
+# 关闭收包通道线程的哨兵对象
+_STOP = object()
+
+log = get_logger("ingestor.flow")
+
+
+class PackRateLimiter:
+    """按电池包的令牌桶限速：单个电池包刷屏时只丢弃它自己的消息，不影响其他电池包
+
+    每个packsn一个TokenBucket，按最近使用淘汰，最多保留max_packs个。
+    rate<=0 时不限速。
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None, max_packs: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_packs = max(1, max_packs)
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        # packsn -> 被限速丢弃的消息数（只保留最近被限速的电池包）
+        self._throttled: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.messages_allowed = 0
+        self.messages_throttled = 0
+        self.packs_throttled = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def allow(self, packsn: str) -> bool:
+        """收到一条消息时调用，超过该电池包的速率时返回False"""
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            bucket = self._buckets.get(packsn)
+            if bucket is None:
+                bucket = self._buckets[packsn] = TokenBucket(self.rate, self.burst)
+                if len(self._buckets) > self.max_packs:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(packsn)
+        if bucket.try_acquire():
+            self.messages_allowed += 1
+            return True
+        with self._lock:
+            self.messages_throttled += 1
+            count = self._throttled.pop(packsn, 0)
+            if count == 0:
+                # 该电池包（重新）开始被限速
+                self.packs_throttled += 1
+            self._throttled[packsn] = count + 1
+            if len(self._throttled) > self.max_packs:
+                self._throttled.popitem(last=False)
+        return False
+
+    def top_throttled(self, limit: int = 5) -> List[Tuple[str, int]]:
+        """被限速丢弃消息最多的电池包"""
+        with self._lock:
+            items = list(self._throttled.items())
+        return sorted(items, key=lambda item: item[1], reverse=True)[:limit]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "packs": len(self._buckets),
+                "messages_allowed": self.messages_allowed,
+                "messages_throttled": self.messages_throttled,
+                "packs_throttled": self.packs_throttled,
+            }
+
+
+class IngestLane:
+    """遥测收包通道：MQTT网络线程只负责入队，解码、校验和提交写入在独立线程中进行
+
+    网络线程不再被遥测处理占满，控制消息的发送和PUBACK不会排在遥测洪峰之后。
+    单个工作线程按到达顺序处理，同一电池包的消息保持有序。
+    队列满时直接丢弃并计数，不阻塞网络线程（否则PINGREQ和控制消息的PUBACK也会被卡住）。
+    """
+
+    def __init__(self,
+                 handler: Callable[[str, bytes], Any],
+                 max_queue_size: int = 10000,
+                 name: str = "telemetry"):
+        self.handler = handler
+        self.name = name
+        self.queue: "queue.Queue" = queue.Queue(maxsize=max_queue_size)
+        self._thread: Optional[threading.Thread] = None
+
+        # 统计信息
+        self.messages_submitted = 0
+        self.messages_processed = 0
+        self.messages_dropped = 0
+        self.handler_errors = 0
+        self.max_depth_seen = 0
+
+    def start(self):
+        """启动处理线程（重复调用无副作用）"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name=f"lane-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """处理完已入队的消息后停止"""
+        if self._thread is None:
+            return
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, topic: str, payload: bytes) -> bool:
+        """提交一条消息；队列满时立即丢弃"""
+        try:
+            self.queue.put_nowait((topic, payload))
+        except queue.Full:
+            self.messages_dropped += 1
+            log.warning("lane_full", "收包通道队列已满，丢弃消息", lane=self.name,
+                        messages_dropped=self.messages_dropped)
+            return False
+        self.messages_submitted += 1
+        depth = self.queue.qsize()
+        if depth > self.max_depth_seen:
+            self.max_depth_seen = depth
+        return True
+
+    def _run(self):
+        handler = self.handler
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            try:
+                handler(*item)
+            except Exception as e:
+                self.handler_errors += 1
+                print(f"[ERROR] 处理MQTT消息时出错: {e}")
+            self.messages_processed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_capacity": self.queue.maxsize,
+            "max_depth_seen": self.max_depth_seen,
+            "messages_submitted": self.messages_submitted,
+            "messages_processed": self.messages_processed,
+            "messages_dropped": self.messages_dropped,
+            "handler_errors": self.handler_errors,
+        }
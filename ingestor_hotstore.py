@@ -0,0 +1,416 @@
+import calendar
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from ingestor_decoder import CELL_ARRAY_FIELDS
+from ingestor_spool import decode_row, encode_row
+
+UPLOAD_MODES = ('rollup', 'raw')
+
+_SUFFIX = ".db"
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS rows (ts REAL NOT NULL, packsn TEXT NOT NULL, body BLOB NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+)
+
+
+def row_timestamp(row: Dict[str, Any], default: float) -> float:
+    """行的created_at转换为Unix时间戳，无法解析时使用default"""
+    created_at = row.get('created_at')
+    if isinstance(created_at, str):
+        try:
+            return datetime.fromisoformat(created_at).timestamp()
+        except ValueError:
+            pass
+    return default
+
+
+class HotStore:
+    """本地按时间分区的热数据存储
+
+    每个分区是一个WAL模式的SQLite文件（{directory}/{table}/{分区起始时间}.db），
+    原始行以紧凑二进制（与本地缓冲相同的编码）追加写入；分区关闭后由压缩任务上传并按保留期删除。
+    可直接作为WritePipeline的sink使用。
+    磁盘占用超过max_bytes时丢弃最旧的分区（max_bytes<=0时不限制）。
+    """
+
+    def __init__(self,
+                 directory: str,
+                 table: str = "battery_cell_data",
+                 partition_seconds: int = 600,
+                 synchronous: str = "NORMAL",
+                 max_bytes: int = 0):
+        self.directory = os.path.join(directory, table)
+        self.table = table
+        self.partition_seconds = max(1, int(partition_seconds))
+        self.synchronous = synchronous
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conns: Dict[int, sqlite3.Connection] = {}
+        # 早于此时间的分区已关闭，迟到的行写入当前最早的开放分区
+        self._sealed_before = 0
+
+        # 统计信息
+        self.rows_written = 0
+        self.late_rows = 0
+        self.partitions_discarded = 0
+        self.rows_discarded = 0
+
+        self._recover_watermark()
+
+    def _recover_watermark(self):
+        """重启后从磁盘恢复关闭水位：已开始上传的分区不能再写入迟到的行
+
+        压缩任务按时间顺序上传，从最新的分区往前找到第一个有上传记录的分区即可。
+        """
+        for start in reversed(self.partitions()):
+            if self.get_meta(start, 'uploaded_at') is not None or self.get_meta(start, 'progress') is not None:
+                self._sealed_before = start + self.partition_seconds
+                return
+
+    def partition_of(self, ts: float) -> int:
+        return int(ts // self.partition_seconds) * self.partition_seconds
+
+    def path_of(self, start: int) -> str:
+        return os.path.join(self.directory, time.strftime("%Y%m%d%H%M%S", time.gmtime(start)) + _SUFFIX)
+
+    def _open(self, path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute("PRAGMA busy_timeout=5000")
+        for statement in _SCHEMA:
+            conn.execute(statement)
+        return conn
+
+    def _connection(self, start: int) -> sqlite3.Connection:
+        conn = self._conns.get(start)
+        if conn is None:
+            conn = self._conns[start] = self._open(self.path_of(start))
+            if self.max_bytes > 0:
+                self._enforce_cap_locked(keep=start)
+        return conn
+
+    def _enforce_cap_locked(self, keep: Optional[int] = None):
+        """超过磁盘上限时丢弃最旧的分区（不丢弃keep和最新的分区）"""
+        starts = [start for start in self.partitions() if start != keep]
+        usage = self.disk_bytes()
+        while usage > self.max_bytes and len(starts) > 1:
+            start = starts.pop(0)
+            conn = self._conns.pop(start, None)
+            if conn is not None:
+                conn.close()
+            path = self.path_of(start)
+            try:
+                conn = sqlite3.connect(path)
+                try:
+                    dropped = conn.execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+                finally:
+                    conn.close()
+            except sqlite3.Error:
+                dropped = 0
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    usage -= os.path.getsize(path + suffix)
+                except OSError:
+                    pass
+            self.delete(start)
+            self.partitions_discarded += 1
+            self.rows_discarded += dropped
+            print(f"[WARNING] 本地热数据超过上限 {self.max_bytes} 字节，丢弃最旧的分区 {start}（{dropped} 条）")
+
+    def enforce_cap(self):
+        """检查磁盘上限（由压缩任务定期调用）"""
+        if self.max_bytes <= 0:
+            return
+        with self._lock:
+            self._enforce_cap_locked()
+
+    def write(self, rows: List[Dict[str, Any]]) -> bool:
+        """把一批行按created_at写入对应分区（每个分区一个事务）"""
+        now = time.time()
+        groups: Dict[int, List[tuple]] = {}
+        late = 0
+        with self._lock:
+            for row in rows:
+                ts = row_timestamp(row, now)
+                start = self.partition_of(ts)
+                if start < self._sealed_before:
+                    start = self._sealed_before
+                    late += 1
+                groups.setdefault(start, []).append((ts, row['packsn'], encode_row(row)))
+            for start, records in groups.items():
+                conn = self._connection(start)
+                conn.execute("BEGIN")
+                try:
+                    conn.executemany("INSERT INTO rows (ts, packsn, body) VALUES (?, ?, ?)", records)
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+            self.rows_written += len(rows)
+            self.late_rows += late
+        return True
+
+    def seal(self, before: float):
+        """关闭起始时间早于before的分区，之后不再写入"""
+        with self._lock:
+            before = self.partition_of(before)
+            self._sealed_before = max(self._sealed_before, before)
+            for start in [start for start in self._conns if start < self._sealed_before]:
+                self._conns.pop(start).close()
+
+    def partitions(self) -> List[int]:
+        """磁盘上所有分区的起始时间（升序）"""
+        starts = []
+        for name in os.listdir(self.directory):
+            if name.endswith(_SUFFIX):
+                try:
+                    starts.append(calendar.timegm(time.strptime(name[:-len(_SUFFIX)], "%Y%m%d%H%M%S")))
+                except ValueError:
+                    continue
+        return sorted(starts)
+
+    def read(self, start: int, order_by: str = "rowid") -> Iterator[Tuple[float, Dict[str, Any]]]:
+        """按顺序读出一个分区的所有行 (ts, row)"""
+        conn = self._open(self.path_of(start))
+        try:
+            for ts, body in conn.execute(f"SELECT ts, body FROM rows ORDER BY {order_by}"):
+                yield ts, decode_row(body)
+        finally:
+            conn.close()
+
+    def get_meta(self, start: int, key: str) -> Optional[str]:
+        conn = self._open(self.path_of(start))
+        try:
+            found = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            return found[0] if found else None
+        finally:
+            conn.close()
+
+    def set_meta(self, start: int, key: str, value: Any):
+        conn = self._open(self.path_of(start))
+        try:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+        finally:
+            conn.close()
+
+    def delete(self, start: int):
+        """删除一个分区（含WAL和共享内存文件）"""
+        path = self.path_of(start)
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def disk_bytes(self) -> int:
+        total = 0
+        for name in os.listdir(self.directory):
+            try:
+                total += os.path.getsize(os.path.join(self.directory, name))
+            except OSError:
+                continue
+        return total
+
+    def close(self):
+        with self._lock:
+            for conn in self._conns.values():
+                conn.close()
+            self._conns.clear()
+
+
+class HotStoreCompactor:
+    """热数据压缩任务
+
+    定期把已关闭的分区上传到远端：rollup模式按电池包和时间窗口汇总为min/max/mean
+    （与降采样汇总表格式相同），raw模式按原始行批量上传。上传进度记录在分区的meta表中，
+    失败后从断点继续；已上传且超过保留期的分区被删除。
+    """
+
+    def __init__(self,
+                 store: HotStore,
+                 upload: Callable[[List[Dict[str, Any]]], bool],
+                 mode: str = "rollup",
+                 rollup_window: float = 60.0,
+                 batch_size: int = 500,
+                 interval: float = 60.0,
+                 grace: float = 60.0,
+                 retention: float = 86400.0,
+                 is_retryable: Callable[[Exception], bool] = lambda e: True,
+                 tz=None):
+        if mode not in UPLOAD_MODES:
+            raise ValueError(f"未知的热数据上传模式: {mode}")
+        self.store = store
+        self.upload = upload
+        self.mode = mode
+        self.rollup_window = rollup_window
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self.grace = grace
+        self.retention = retention
+        self.is_retryable = is_retryable
+        self.tz = tz
+
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # 统计信息
+        self.partitions_uploaded = 0
+        self.partitions_deleted = 0
+        self.rows_uploaded = 0
+        self.rows_failed = 0
+        self.upload_failures = 0
+        self.last_error: Optional[str] = None
+
+    # ------------------------------------------------------------------
+    # 汇总
+    # ------------------------------------------------------------------
+    def _rollups(self, start: int) -> Iterator[Dict[str, Any]]:
+        """按packsn、时间排序读出分区，逐个窗口输出汇总行（同一时刻只保留一个电池包的累加器）"""
+        key = None
+        count = 0
+        acc: Dict[str, List[np.ndarray]] = {}
+        for ts, row in self.store.read(start, order_by="packsn, ts, rowid"):
+            vectors = {field: np.asarray(row[field], dtype=np.float64) for field in CELL_ARRAY_FIELDS}
+            window_start = int(ts // self.rollup_window * self.rollup_window)
+            shape = tuple(vectors[field].shape for field in CELL_ARRAY_FIELDS)
+            row_key = (row['packsn'], window_start, shape)
+            if row_key != key:
+                if count:
+                    yield self._rollup_row(key, count, acc)
+                key, count = row_key, 0
+                acc = {field: [np.zeros(values.shape), np.full(values.shape, np.inf), np.full(values.shape, -np.inf)]
+                       for field, values in vectors.items()}
+            count += 1
+            for field, values in vectors.items():
+                total, low, high = acc[field]
+                total += values
+                np.minimum(low, values, out=low)
+                np.maximum(high, values, out=high)
+        if count:
+            yield self._rollup_row(key, count, acc)
+
+    def _rollup_row(self, key, count: int, acc: Dict[str, List[np.ndarray]]) -> Dict[str, Any]:
+        packsn, window_start, _ = key
+        rollup = {
+            "packsn": packsn,
+            "window_start": datetime.fromtimestamp(window_start, self.tz).isoformat(),
+            "window_end": datetime.fromtimestamp(int(window_start + self.rollup_window), self.tz).isoformat(),
+            "samples": count,
+        }
+        for field in CELL_ARRAY_FIELDS:
+            total, low, high = acc[field]
+            rollup[f"{field}_min"] = low.astype(np.float32)
+            rollup[f"{field}_max"] = high.astype(np.float32)
+            rollup[f"{field}_mean"] = (total / count).astype(np.float32)
+        return rollup
+
+    def _records(self, start: int) -> Iterator[Dict[str, Any]]:
+        if self.mode == 'rollup':
+            return self._rollups(start)
+        return (row for _, row in self.store.read(start))
+
+    # ------------------------------------------------------------------
+    # 上传与清理
+    # ------------------------------------------------------------------
+    def upload_partition(self, start: int) -> bool:
+        """上传一个已关闭的分区，返回是否全部完成"""
+        store = self.store
+        if store.get_meta(start, 'uploaded_at') is not None:
+            return True
+        done = int(store.get_meta(start, 'progress') or 0)
+        position = 0
+        batch: List[Dict[str, Any]] = []
+        for record in self._records(start):
+            position += 1
+            if position <= done:
+                continue
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                if not self._upload(start, batch, position):
+                    return False
+                batch = []
+        if batch and not self._upload(start, batch, position):
+            return False
+        store.set_meta(start, 'uploaded_at', time.time())
+        self.partitions_uploaded += 1
+        return True
+
+    def _upload(self, start: int, batch: List[Dict[str, Any]], position: int) -> bool:
+        try:
+            ok = self.upload(batch)
+        except Exception as e:
+            ok = False
+            self.last_error = str(e)
+            if not self.is_retryable(e):
+                # 数据错误重试也不会成功，跳过这一批以免阻塞后续分区
+                print(f"[ERROR] 热数据分区 {start} 有 {len(batch)} 条数据无法上传，已跳过: {e}")
+                self.rows_failed += len(batch)
+                self.store.set_meta(start, 'progress', position)
+                return True
+        if not ok:
+            self.upload_failures += 1
+            print(f"[ERROR] 热数据分区 {start} 上传失败，下次从第 {position - len(batch)} 条继续")
+            return False
+        self.store.set_meta(start, 'progress', position)
+        self.rows_uploaded += len(batch)
+        return True
+
+    def run_once(self, now: Optional[float] = None):
+        """关闭到期分区、上传未上传的分区、删除超过保留期的分区"""
+        now = time.time() if now is None else now
+        store = self.store
+        store.seal(now - self.grace)
+        sealed_before = store.partition_of(now - self.grace)
+        for start in store.partitions():
+            end = start + store.partition_seconds
+            if start >= sealed_before:
+                break
+            if not self.upload_partition(start):
+                # 保持顺序，后面的分区等这个分区上传成功后再处理
+                break
+            if end <= now - self.retention:
+                store.delete(start)
+                self.partitions_deleted += 1
+        store.enforce_cap()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"[ERROR] 热数据压缩任务出错: {e}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="hotstore-compactor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(5.0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "partitions": len(self.store.partitions()),
+            "disk_bytes": self.store.disk_bytes(),
+            "rows_written": self.store.rows_written,
+            "late_rows": self.store.late_rows,
+            "partitions_discarded": self.store.partitions_discarded,
+            "rows_discarded": self.store.rows_discarded,
+            "partitions_uploaded": self.partitions_uploaded,
+            "partitions_deleted": self.partitions_deleted,
+            "rows_uploaded": self.rows_uploaded,
+            "rows_failed": self.rows_failed,
+            "upload_failures": self.upload_failures,
+        }
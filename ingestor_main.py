@@ -1,12 +1,39 @@
 import os
 import json
+import socket
+import asyncio
+import argparse
 import threading
 import time
 import pytz
+import httpx
 import paho.mqtt.client as mqtt
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, TYPE_CHECKING
 from datetime import datetime
-from supabase import create_client, Client
+from dotenv import load_dotenv
+
+from ingestor_pipeline import WritePipeline
+from ingestor_async import AsyncIngestor
+from ingestor_publisher import RateLimitedPublisher
+from ingestor_packinfo import PackInfoBroadcaster
+from ingestor_registry import PackRegistry
+from ingestor_decoder import TelemetryDecoder, jsonable_row
+from ingestor_columnar import create_columnar_sink
+from ingestor_dedup import DedupWindow
+from ingestor_downsample import PackDownsampler
+from ingestor_supervisor import Supervisor, ShardStats, ShardReporter, shard_of
+from ingestor_metrics import MetricsRegistry, MetricsServer, configure_logging, get_logger
+from ingestor_session import Backoff, SubscriptionSet, create_session_client, session_connect_options
+from ingestor_state import LatestStateStore, StateServer, create_state_app
+from ingestor_rules import RuleEngine, load_threshold_overrides
+from ingestor_hotstore import HotStore, HotStoreCompactor
+from ingestor_flow import IngestLane, PackRateLimiter
+from ingestor_capture import CaptureWriter
+
+if TYPE_CHECKING:
+    from supabase import Client
+
+load_dotenv()
 
 beijing_tz = pytz.timezone('Asia/Shanghai')
 
@@ -27,27 +54,291 @@ MQTT_CONFIG = {
     "control_topic": "bms/control"
 }
 
-# 初始化Supabase客户端
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# 写入管道配置
+PIPELINE_CONFIG = {
+    "batch_size": int(os.getenv("BATCH_SIZE", "100")),
+    "flush_interval": float(os.getenv("FLUSH_INTERVAL", "1.0")),  # 秒
+    "max_queue_size": int(os.getenv("MAX_QUEUE_SIZE", "10000")),
+    "put_timeout": float(os.getenv("QUEUE_PUT_TIMEOUT", "5.0")),  # 队列满时的最长阻塞时间
+    "num_workers": int(os.getenv("INSERT_WORKERS", "4")),  # 并行写入线程数
+}
+
+# 多进程分片配置（SHARD_INDEX等由监督进程为每个工作进程设置）
+SHARD_CONFIG = {
+    "workers": int(os.getenv("SHARD_WORKERS", "1")),  # 监督模式启动的工作进程数，1为单进程
+    "index": int(os.getenv("SHARD_INDEX", "0")),
+    "count": int(os.getenv("SHARD_COUNT", "1")),
+    "mode": os.getenv("SHARD_MODE", "share"),  # share=MQTT共享订阅, hash=按packsn哈希分配订阅
+    "group": os.getenv("SHARED_SUBSCRIPTION_GROUP", "ingestor"),  # 共享订阅组名
+    "stats_shm": os.getenv("SHARD_STATS_SHM"),  # 与监督进程共享的统计内存
+}
+# 只有0号分片负责广播电池包信息，避免重复发布
+IS_LEADER_SHARD = SHARD_CONFIG['index'] == 0
+
+# 批量写入方式配置
+SINK_CONFIG = {
+    "mode": os.getenv("SINK_MODE", "postgrest"),  # postgrest / copy / parquet
+    "dsn": os.getenv("DATABASE_URL"),  # copy模式使用的PostgreSQL连接串
+    "array_format": os.getenv("COPY_ARRAY_FORMAT", "pg_array"),  # pg_array / json，对应数组列类型
+    "parquet_dir": os.getenv("PARQUET_DIR", "parquet"),  # parquet模式的段文件目录
+    "parquet_compression": os.getenv("PARQUET_COMPRESSION", "zstd"),
+}
+
+# 本地缓冲配置（写库失败时转存，恢复后按顺序回放）
+SPOOL_CONFIG = {
+    "enabled": os.getenv("SPOOL_ENABLED", "true").lower() == "true",
+    # 多进程时每个分片使用独立的缓冲目录
+    "directory": os.path.join(os.getenv("SPOOL_DIR", "spool"), f"shard-{SHARD_CONFIG['index']}")
+                 if SHARD_CONFIG['count'] > 1 else os.getenv("SPOOL_DIR", "spool"),
+    "segment_bytes": int(os.getenv("SPOOL_SEGMENT_BYTES", str(64 * 1024 * 1024))),
+    "max_bytes": int(os.getenv("SPOOL_MAX_BYTES", str(2 * 1024 * 1024 * 1024))),  # 磁盘占用上限
+    "fsync_interval": float(os.getenv("SPOOL_FSYNC_INTERVAL", "1.0")),  # 秒
+    "fsync_every": int(os.getenv("SPOOL_FSYNC_EVERY", "1000")),  # 条
+    "retry_interval": float(os.getenv("SPOOL_RETRY_INTERVAL", "5.0")),  # 写库失败后的重试间隔（秒）
+    "replay_batches": int(os.getenv("SPOOL_REPLAY_BATCHES", "10")),  # 每次刷新最多回放的批数
+}
+
+# 本地热数据存储配置（原始数据先写本地分区，由压缩任务定期汇总上传）
+HOTSTORE_CONFIG = {
+    "enabled": os.getenv("HOTSTORE_ENABLED", "false").lower() == "true",
+    # 多进程时每个分片使用独立的目录
+    "directory": os.path.join(os.getenv("HOTSTORE_DIR", "hotstore"), f"shard-{SHARD_CONFIG['index']}")
+                 if SHARD_CONFIG['count'] > 1 else os.getenv("HOTSTORE_DIR", "hotstore"),
+    "partition_seconds": int(os.getenv("HOTSTORE_PARTITION_SECONDS", "600")),  # 每个分区覆盖的时长（秒）
+    "synchronous": os.getenv("HOTSTORE_SYNCHRONOUS", "NORMAL"),  # SQLite synchronous: OFF / NORMAL / FULL
+    "upload_mode": os.getenv("HOTSTORE_UPLOAD_MODE", "rollup"),  # rollup=按窗口汇总后上传, raw=上传原始行
+    "rollup_window": float(os.getenv("HOTSTORE_ROLLUP_WINDOW", "60")),  # 汇总窗口（秒）
+    "compact_interval": float(os.getenv("HOTSTORE_COMPACT_INTERVAL", "60")),  # 压缩任务周期（秒）
+    "grace": float(os.getenv("HOTSTORE_GRACE", "60")),  # 分区结束后等待迟到数据的时间（秒）
+    "retention": float(os.getenv("HOTSTORE_RETENTION", "86400")),  # 已上传分区在本地保留的时长（秒）
+    "max_bytes": int(os.getenv("HOTSTORE_MAX_BYTES", str(10 * 1024 * 1024 * 1024))),  # 磁盘占用上限，超过时丢弃最旧的分区
+}
+
+# MQTT发布/订阅配置
+PUBLISH_CONFIG = {
+    "rate": float(os.getenv("PUBLISH_RATE", "50")),  # 每秒最多发布的消息数，<=0不限速
+    "burst": float(os.getenv("PUBLISH_BURST", "50")),  # 令牌桶容量
+    "ack_timeout": float(os.getenv("PUBLISH_ACK_TIMEOUT", "30")),  # QoS1确认超时（秒）
+    "max_inflight": int(os.getenv("PUBLISH_MAX_INFLIGHT", "100")),  # 同时等待确认的QoS1消息上限
+    "broadcast_timeout": float(os.getenv("BROADCAST_TIMEOUT", "600")),  # 等待一次广播完成的上限（秒）
+    "connect_timeout": float(os.getenv("MQTT_CONNECT_TIMEOUT", "5")),  # 等待CONNACK的上限（秒）
+}
+
+# MQTT会话与重连配置（固定client_id + 持久会话，断线后复用客户端快速恢复）
+SESSION_CONFIG = {
+    "client_id": os.getenv("MQTT_CLIENT_ID") or f"ingestor-{socket.gethostname()}-{SHARD_CONFIG['index']}",
+    "protocol": int(os.getenv("MQTT_PROTOCOL", "5")),  # 5=MQTT 5（clean_start=False），4=MQTT 3.1.1（clean_session=False）
+    "session_expiry": int(os.getenv("MQTT_SESSION_EXPIRY", "3600")),  # 断线后broker保留会话的时长（秒），0为不保留
+    "subscribe_qos": int(os.getenv("MQTT_SUBSCRIBE_QOS", "1")),  # QoS1时断线期间的消息由broker缓存
+    "reconnect_min": float(os.getenv("MQTT_RECONNECT_MIN", "0.1")),  # 首次重连延迟（秒）
+    "reconnect_max": float(os.getenv("MQTT_RECONNECT_MAX", "30")),  # 重连延迟上限（秒）
+}
+
+# 流量控制配置
+FLOW_CONFIG = {
+    "pack_rate": float(os.getenv("PACK_RATE_LIMIT", "0")),  # 每个电池包每秒最多接收的消息数，0为不限速
+    "pack_burst": float(os.getenv("PACK_RATE_BURST", "0")) or None,  # 允许的突发消息数，0为与速率相同
+    "ingest_lane": os.getenv("INGEST_LANE_ENABLED", "true").lower() == "true",  # 遥测在独立线程处理，网络线程只收包
+    "ingest_queue_size": int(os.getenv("INGEST_LANE_QUEUE", "10000")),  # 遥测收包通道队列长度
+    "control_connection": os.getenv("CONTROL_CONNECTION", "shared"),  # shared=与遥测共用连接, separate=控制消息独立连接
+}
+
+# 电池包信息广播配置
+PACK_INFO_CONFIG = {
+    "broadcast_interval": float(os.getenv("PACK_INFO_INTERVAL", "30")),  # 增量广播周期（秒）
+    "full_refresh_interval": float(os.getenv("PACK_INFO_FULL_REFRESH", "600")),  # 全量比对周期（秒）
+    "retain": os.getenv("PACK_INFO_RETAIN", "false").lower() == "true",  # 是否按电池包发布retained消息
+}
+
+# 启动配置
+STARTUP_CONFIG = {
+    "mode": os.getenv("STARTUP_MODE", "fast"),  # fast=连接与加载电池包并行、后台广播; full=按顺序执行并打印全部电池包信息
+    "subscribe_timeout": float(os.getenv("STARTUP_SUBSCRIBE_TIMEOUT", "10")),  # 等待SUBACK的时长（秒）
+}
+
+# 电池包信息缓存配置
+REGISTRY_CONFIG = {
+    "ttl": float(os.getenv("REGISTRY_TTL", "300")),  # 缓存有效期（秒）
+    "miss_refresh_interval": float(os.getenv("REGISTRY_MISS_REFRESH", "30")),  # 未知packsn触发刷新的最小间隔（秒）
+    "validate_packsn": os.getenv("VALIDATE_PACKSN", "false").lower() == "true",  # 丢弃未登记电池包的数据
+}
+
+# 遥测解码配置
+DECODER_CONFIG = {
+    "json_backend": os.getenv("JSON_BACKEND", "auto"),  # auto / orjson / json
+    "array_backend": os.getenv("DECODER_ARRAY_BACKEND", "array"),  # array / numpy
+    "float_typecode": os.getenv("DECODER_FLOAT_TYPE", "f"),  # f=float32, d=float64
+    "strict_lengths": os.getenv("DECODER_STRICT_LENGTHS", "true").lower() == "true",  # 数组长度与元数据不符时丢弃
+}
+
+# 去重与幂等写入配置
+DEDUP_CONFIG = {
+    "enabled": os.getenv("DEDUP_ENABLED", "true").lower() == "true",  # 内存去重窗口（只对带设备时间戳的消息生效）
+    "capacity": int(os.getenv("DEDUP_CAPACITY", "100000")),  # 窗口内最多记录的消息指纹数
+    "ttl": float(os.getenv("DEDUP_WINDOW_SECONDS", "30")),  # 指纹有效期（秒）
+    "key_column": os.getenv("DEDUP_KEY_COLUMN") or None,  # 幂等键列名（需在表上建唯一索引），为空时不写入
+}
+
+# 边缘降采样配置
+DOWNSAMPLE_CONFIG = {
+    "mode": os.getenv("DOWNSAMPLE_MODE", "off"),  # off / deadband / rollup / both
+    "deadbands": {
+        "cell_voltages": float(os.getenv("DEADBAND_VOLTAGE", "0.005")),  # V
+        "cell_socs": float(os.getenv("DEADBAND_SOC", "0.5")),  # %
+        "cell_temperatures": float(os.getenv("DEADBAND_TEMPERATURE", "0.5")),  # ℃
+    },
+    "heartbeat_interval": float(os.getenv("DOWNSAMPLE_HEARTBEAT", "60")),  # 无变化时的最长写入间隔（秒）
+    "rollup_window": float(os.getenv("ROLLUP_WINDOW", "60")),  # 汇总窗口（秒）
+    "rollup_table": os.getenv("ROLLUP_TABLE", "battery_cell_rollup"),
+    "max_packs": int(os.getenv("DOWNSAMPLE_MAX_PACKS", "100000")),  # 保存状态的电池包数上限
+}
+
+# 指标与日志配置
+METRICS_CONFIG = {
+    "port": int(os.getenv("METRICS_PORT", "9108")),  # Prometheus指标端口，0为关闭；多进程时按分片序号递增
+    "host": os.getenv("METRICS_HOST", "127.0.0.1"),
+    "log_level": os.getenv("LOG_LEVEL", "INFO"),  # DEBUG级别才输出逐条收包日志
+    "log_sample_per_second": int(os.getenv("LOG_SAMPLE_PER_SECOND", "10")),  # 同类日志每秒最多输出条数
+}
+
+def env_threshold(name: str, default: str) -> Optional[float]:
+    """读取阈值环境变量，设为空字符串时关闭对应规则"""
+    value = os.getenv(name, default).strip()
+    return float(value) if value else None
+
+# 告警规则配置
+RULES_CONFIG = {
+    "enabled": os.getenv("RULES_ENABLED", "false").lower() == "true",  # 收包时检查阈值并发布告警
+    "alert_topic": os.getenv("ALERT_TOPIC", "bms/alerts"),  # 告警发布到 {alert_topic}/{packsn}
+    "qos": int(os.getenv("ALERT_QOS", "1")),
+    "repeat_interval": float(os.getenv("ALERT_REPEAT_INTERVAL", "300")),  # 持续触发的告警重复发布间隔（秒）
+    "overrides_file": os.getenv("RULES_OVERRIDES_FILE"),  # 按电池包覆盖阈值的JSON文件
+    "thresholds": {
+        "voltage_max": env_threshold("RULE_VOLTAGE_MAX", "3.65"),  # V
+        "voltage_min": env_threshold("RULE_VOLTAGE_MIN", "2.5"),  # V
+        "voltage_spread_max": env_threshold("RULE_VOLTAGE_SPREAD_MAX", "0.3"),  # 最大压差 V
+        "voltage_rate_max": env_threshold("RULE_VOLTAGE_RATE_MAX", ""),  # V/秒
+        "temperature_max": env_threshold("RULE_TEMPERATURE_MAX", "55"),  # ℃
+        "temperature_min": env_threshold("RULE_TEMPERATURE_MIN", "-20"),  # ℃
+        "temperature_spread_max": env_threshold("RULE_TEMPERATURE_SPREAD_MAX", "10"),  # 最大温差 ℃
+        "temperature_rate_max": env_threshold("RULE_TEMPERATURE_RATE_MAX", "1"),  # ℃/秒
+        "soc_min": env_threshold("RULE_SOC_MIN", "5"),  # %
+        "soc_max": env_threshold("RULE_SOC_MAX", ""),  # %
+    },
+}
+
+# 最新状态查询接口配置
+STATE_CONFIG = {
+    "enabled": os.getenv("STATE_API_ENABLED", "true").lower() == "true",  # 内存中保存每个电池包的最新读数
+    "port": int(os.getenv("STATE_API_PORT", "9110")),  # 查询接口端口，0为不启动；多进程时按分片序号递增
+    "host": os.getenv("STATE_API_HOST", "127.0.0.1"),
+    "max_packs": int(os.getenv("STATE_MAX_PACKS", "100000")),  # 保存状态的电池包数上限
+}
+
+# 原始消息捕获配置（捕获文件可用 ingestor_replay.py 回放补数）
+CAPTURE_CONFIG = {
+    "enabled": os.getenv("CAPTURE_ENABLED", "false").lower() == "true",
+    "directory": os.getenv("CAPTURE_DIR", "captures"),
+    "rotate_bytes": int(float(os.getenv("CAPTURE_ROTATE_MB", "64")) * 1024 * 1024),  # 单个文件压缩后的大小上限
+    "rotate_seconds": float(os.getenv("CAPTURE_ROTATE_SECONDS", "3600")),  # 单个文件的时长上限（秒）
+    "compresslevel": int(os.getenv("CAPTURE_COMPRESS_LEVEL", "1")),  # gzip压缩级别，1最快
+    "queue_size": int(os.getenv("CAPTURE_QUEUE", "10000")),  # 等待写盘的消息数上限，满时丢弃
+}
+
+configure_logging(METRICS_CONFIG['log_level'], max_per_interval=METRICS_CONFIG['log_sample_per_second'])
+receive_log = get_logger("ingestor.receive")
+
+# 全局指标注册表
+metrics = MetricsRegistry(const_labels={"shard": SHARD_CONFIG['index']} if SHARD_CONFIG['count'] > 1 else None)
+
+# asyncio运行模式配置
+ASYNC_CONFIG = {
+    "max_in_flight": int(os.getenv("ASYNC_MAX_IN_FLIGHT", "32")),  # 同时在途的写库请求上限
+}
+
+# HTTP连接池配置（所有写入线程共享）
+HTTP_POOL_CONFIG = {
+    "max_connections": int(os.getenv("HTTP_MAX_CONNECTIONS", "16")),
+    "max_keepalive_connections": int(os.getenv("HTTP_MAX_KEEPALIVE", "8")),
+    "keepalive_expiry": float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30")),  # 秒
+    "timeout": float(os.getenv("HTTP_TIMEOUT", "10")),  # 秒
+}
+
+# Supabase客户端（首次使用时创建）
+_supabase_client: Optional["Client"] = None
+_supabase_lock = threading.Lock()
+
+def get_supabase() -> "Client":
+    """获取共享的Supabase客户端，底层使用keep-alive连接池（supabase在首次使用时才导入）"""
+    global _supabase_client
+    if _supabase_client is None:
+        with _supabase_lock:
+            if _supabase_client is None:
+                from supabase import create_client, ClientOptions
+                http_client = httpx.Client(
+                    limits=httpx.Limits(
+                        max_connections=HTTP_POOL_CONFIG['max_connections'],
+                        max_keepalive_connections=HTTP_POOL_CONFIG['max_keepalive_connections'],
+                        keepalive_expiry=HTTP_POOL_CONFIG['keepalive_expiry']
+                    ),
+                    timeout=HTTP_POOL_CONFIG['timeout'],
+                    follow_redirects=True
+                )
+                client = create_client(
+                    SUPABASE_URL, SUPABASE_KEY,
+                    options=ClientOptions(httpx_client=http_client)
+                )
+                # 预先初始化PostgREST客户端，避免多个写入线程并发初始化
+                client.postgrest
+                _supabase_client = client
+    return _supabase_client
 
 class MQTTListener:
     def __init__(self):
         self.client = None
         self.connected = False
-        self.subscriptions = set()
-        # 添加连接延迟配置
-        self.connection_delay = 0.1  # 100毫秒连接延迟
+        self.session_present = False
+        self.subscriptions = SubscriptionSet(qos=SESSION_CONFIG['subscribe_qos'])
+        self.backoff = Backoff(SESSION_CONFIG['reconnect_min'], SESSION_CONFIG['reconnect_max'])
+        self.messages_received = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.sessions_resumed = 0
+        self._connected_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._network_thread = None
+        # 控制消息通道：CONTROL_CONNECTION=separate时使用独立连接，不与遥测收包争用同一socket和网络线程
+        self.control_client = None
+        self.control_connected = False
+        # 遥测收包通道：网络线程只入队，解码和写入在独立线程中进行
+        self.ingest_lane = IngestLane(
+            self.handle_message,
+            max_queue_size=FLOW_CONFIG['ingest_queue_size']
+        ) if FLOW_CONFIG['ingest_lane'] else None
+        # 限速发布器：取代每条消息之间的固定延迟
+        self.publisher = RateLimitedPublisher(
+            self.get_control_client,
+            rate=PUBLISH_CONFIG['rate'],
+            burst=PUBLISH_CONFIG['burst'],
+            ack_timeout=PUBLISH_CONFIG['ack_timeout']
+        )
         
     def on_connect(self, client, userdata, flags, rc, properties=None):
         """MQTT连接回调 - 使用最新API版本"""
         if rc == 0:
-            print("[OK] MQTT连接成功")
+            self.session_present = bool(getattr(flags, 'session_present', False))
+            print(f"[OK] MQTT连接成功（{'恢复会话' if self.session_present else '新会话'}）")
             self.connected = True
-            # 重新订阅所有主题
-            for topic in self.subscriptions:
-                time.sleep(self.connection_delay)  # 订阅之间添加延迟
-                client.subscribe(topic)
-                print(f"[OK] 重新订阅主题: {topic}")
+            self.connects += 1
+            self.backoff.reset()
+            if self.session_present:
+                self.sessions_resumed += 1
+            self._connected_event.set()
+            # 恢复会话时broker仍保留订阅，只补订缺失的主题
+            self.subscriptions.reset(self.session_present)
+            result, topics = self.subscriptions.subscribe(client)
+            if topics and result == mqtt.MQTT_ERR_SUCCESS:
+                print(f"[OK] 补订 {len(topics)} 个主题")
         else:
             print(f"[ERROR] MQTT连接失败，返回码: {rc}")
             self.connected = False
@@ -56,163 +347,218 @@ class MQTTListener:
         """MQTT消息回调"""
         try:
             topic = msg.topic
-            payload = msg.payload.decode('utf-8')
-            print(f"[RECEIVE] 收到MQTT消息 - 主题: {topic}  消息内容: {payload[:68]}...")
+            self.messages_received += 1
+            receive_log.debug("receive", "收到MQTT消息", topic=topic, size=len(msg.payload), payload=msg.payload[:68])
             
-            # 解析消息
-            data = json.loads(payload)
+            if capture_writer is not None:
+                capture_writer.record(topic, msg.payload)
             
-            # 从主题中提取packsn (bms/telemetry/PKG001 -> PKG001)
-            packsn = topic.split('/')[-1] if '/' in topic else topic
-            # 去除首尾空格
-            packsn = packsn.strip()
+            # 超过单个电池包速率的消息直接丢弃
+            if not admit_telemetry(topic):
+                return
+            if self.ingest_lane is not None:
+                self.ingest_lane.submit(topic, msg.payload)
+            else:
+                self.handle_message(topic, msg.payload)
             
-            # 处理电池数据
-            self.process_battery_data(packsn, data)
+        except Exception as e:
+            print(f"[ERROR] 处理MQTT消息时出错: {e}")
+            
+    def handle_message(self, topic: str, payload: bytes):
+        """处理一条遥测消息（收包通道线程中调用；未启用通道时在网络线程中调用）"""
+        try:
+            # 直接从payload字节解码、校验并降采样
+            insert_data = prepare_telemetry_row(topic, payload)
+            if insert_data is None:
+                return
+            
+            # 交给写入管道批量插入
+            write_pipeline.submit(insert_data)
             
         except Exception as e:
             print(f"[ERROR] 处理MQTT消息时出错: {e}")
             
+    def get_control_client(self):
+        """控制消息使用的客户端：独立连接可用时用独立连接，否则用遥测连接"""
+        if self.control_client is not None:
+            return self.control_client if self.control_connected else None
+        return self.client if self.connected else None
+            
     def on_disconnect(self, client, userdata, flags,rc, properties=None):
         """MQTT断开连接回调 - 使用最新API版本"""
         print("[WARNING] MQTT连接断开")
         self.connected = False
+        self.disconnects += 1
+        self._connected_event.clear()
+
+    def on_subscribe(self, client, userdata, mid, reason_codes, properties=None):
+        """SUBACK回调：记录broker已确认的订阅"""
+        rejected = self.subscriptions.acknowledged(mid, reason_codes)
+        if rejected:
+            print(f"[ERROR] broker拒绝订阅 {len(rejected)} 个主题: {', '.join(rejected[:5])}")
+            
+    def wait_subscribed(self, timeout: float) -> bool:
+        """等待已登记的订阅全部收到SUBACK"""
+        return self.subscriptions.wait_granted(timeout)
         
     def process_battery_data(self, packsn: str, data: Dict):
-        """处理电池数据并插入数据库"""
+        """处理电池数据并提交到写入管道"""
         try:
-            # 验证必需的字段
-            required_fields = ['cell_voltages', 'cell_socs', 'cell_temperatures']
-            for field in required_fields:
-                if field not in data:
-                    print(f"[ERROR] 消息缺少必需字段: {field}")
-                    return
-            
-            # 准备插入数据
-            insert_data = {
-                "packsn": packsn,
-                "cell_voltages": data['cell_voltages'],
-                "cell_socs": data['cell_socs'],
-                "cell_temperatures": data['cell_temperatures'],
-                # "created_at": datetime.now().isoformat()
-                "created_at": datetime.now(beijing_tz).replace(microsecond=0).isoformat()
-            }
+            insert_data = build_battery_row(packsn, data)
+            if insert_data is None:
+                return
+            if latest_state is not None:
+                latest_state.update(insert_data)
+            if rule_engine is not None:
+                rule_engine.evaluate(insert_data)
+            insert_data = downsampler.process(insert_data)
+            if insert_data is None:
+                return
             
-            # 插入到Supabase
-            response = supabase.table("battery_cell_data").insert(insert_data).execute()
-            
-            if response.data:
-                # print(f"[OK] 成功插入电池包 {packsn} 的数据")
-                # print(f"   电压数组长度: {len(data['cell_voltages'])}")
-                # print(f"   SOC数组长度: {len(data['cell_socs'])}")
-                # print(f"   温度数组长度: {len(data['cell_temperatures'])}")
-                pass
-            else:
-                print(f"[ERROR] 插入电池包 {packsn} 数据失败")
+            # 交给写入管道批量插入
+            write_pipeline.submit(insert_data)
                 
         except Exception as e:
             print(f"[ERROR] 处理电池数据时出错: {e}")
             
     def connect(self):
-        """连接MQTT服务器"""
+        """连接MQTT服务器（客户端只创建一次，之后由网络线程自动重连）"""
         try:
-            # 使用最新的Callback API版本
-            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-            self.client.on_connect = self.on_connect
-            self.client.on_message = self.on_message
-            self.client.on_disconnect = self.on_disconnect
-            
-            # 设置认证
-            self.client.username_pw_set(MQTT_CONFIG['username'], MQTT_CONFIG['password'])
-            
-            # 配置TLS
-            if MQTT_CONFIG['use_tls']:
-                self.client.tls_set(
-                    cert_reqs=mqtt.ssl.CERT_NONE if MQTT_CONFIG['insecure'] else mqtt.ssl.CERT_REQUIRED,
-                    tls_version=MQTT_CONFIG['tls_version']
-                )
+            if self.client is None:
+                self.client = create_session_client(SESSION_CONFIG)
+                self.client.on_connect = self.on_connect
+                self.client.on_message = self.on_message
+                self.client.on_disconnect = self.on_disconnect
+                self.client.on_subscribe = self.on_subscribe
+                self.client.on_publish = self.publisher.on_publish
+                self.client.max_inflight_messages_set(PUBLISH_CONFIG['max_inflight'])
+                
+                # 设置认证
+                self.client.username_pw_set(MQTT_CONFIG['username'], MQTT_CONFIG['password'])
+                
+                # 配置TLS
+                if MQTT_CONFIG['use_tls']:
+                    self.client.tls_set(
+                        cert_reqs=mqtt.ssl.CERT_NONE if MQTT_CONFIG['insecure'] else mqtt.ssl.CERT_REQUIRED,
+                        tls_version=MQTT_CONFIG['tls_version']
+                    )
+                
+                # 只记录连接参数，实际连接在网络线程中进行
+                self.client.connect_async(MQTT_CONFIG['host'], MQTT_CONFIG['port'], 60,
+                                          **session_connect_options(SESSION_CONFIG))
             
-            # 连接
-            time.sleep(self.connection_delay)  # 连接前添加延迟
-            self.client.connect(MQTT_CONFIG['host'], MQTT_CONFIG['port'], 60)
+            if FLOW_CONFIG['control_connection'] == 'separate' and self.control_client is None:
+                self.control_client = self.create_control_client()
+            if self.ingest_lane is not None:
+                self.ingest_lane.start()
             
-            # 启动网络循环（在后台线程中）
-            self.client.loop_start()
+            # 启动网络线程
+            if self._network_thread is None or not self._network_thread.is_alive():
+                self._stop_event.clear()
+                self._network_thread = threading.Thread(target=self._network_loop, name="mqtt-network", daemon=True)
+                self._network_thread.start()
+            self.publisher.start()
             
-            # 等待连接建立
-            for i in range(10):
-                if self.connected:
-                    return True
-                time.sleep(0.5)
-                
-            return False
+            # 等待CONNACK（超时后网络线程仍会在后台继续重连）
+            return self._connected_event.wait(PUBLISH_CONFIG['connect_timeout'])
             
         except Exception as e:
             print(f"[ERROR] MQTT连接失败: {e}")
             return False
+
+    def create_control_client(self):
+        """创建控制消息专用连接（不订阅、不保留会话，由paho后台线程自动重连）"""
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"{SESSION_CONFIG['client_id']}-control",
+                             protocol=mqtt.MQTTv5 if SESSION_CONFIG['protocol'] == 5 else mqtt.MQTTv311)
+        client.on_publish = self.publisher.on_publish
+        client.on_connect = self.on_control_connect
+        client.on_disconnect = self.on_control_disconnect
+        client.max_inflight_messages_set(PUBLISH_CONFIG['max_inflight'])
+        client.reconnect_delay_set(max(1, int(SESSION_CONFIG['reconnect_min'])), max(1, int(SESSION_CONFIG['reconnect_max'])))
+        client.username_pw_set(MQTT_CONFIG['username'], MQTT_CONFIG['password'])
+        if MQTT_CONFIG['use_tls']:
+            client.tls_set(
+                cert_reqs=mqtt.ssl.CERT_NONE if MQTT_CONFIG['insecure'] else mqtt.ssl.CERT_REQUIRED,
+                tls_version=MQTT_CONFIG['tls_version']
+            )
+        client.connect_async(MQTT_CONFIG['host'], MQTT_CONFIG['port'], 60)
+        client.loop_start()
+        return client
+        
+    def on_control_connect(self, client, userdata, flags, rc, properties=None):
+        """控制连接回调"""
+        if rc == 0:
+            print("[OK] MQTT控制连接成功")
+            self.control_connected = True
+        else:
+            print(f"[ERROR] MQTT控制连接失败，返回码: {rc}")
             
-    def subscribe_packs_all(self):
-        """订阅指定电池包的主题"""
+    def on_control_disconnect(self, client, userdata, flags, rc, properties=None):
+        """控制连接断开回调"""
+        print("[WARNING] MQTT控制连接断开")
+        self.control_connected = False
+
+    def _network_loop(self):
+        """网络线程：处理收发，断线后复用同一客户端按抖动指数退避重连"""
+        client = self.client
+        delay = 0.0
+        while not self._stop_event.is_set():
+            if client.socket() is None:
+                if self._stop_event.wait(delay):
+                    break
+                try:
+                    client.reconnect()
+                except Exception as e:
+                    delay = self.backoff.next_delay()
+                    print(f"[WARNING] MQTT重连失败: {e}，{delay:.2f} 秒后重试")
+                    continue
+            if client.loop(timeout=1.0) != mqtt.MQTT_ERR_SUCCESS:
+                delay = self.backoff.next_delay()
+            
+    def subscribe_topics(self, topics: List[str]) -> bool:
+        """登记并用一条SUBSCRIBE批量订阅多个主题（断线期间登记的主题在重连后补订）"""
         try:
-            topic = f"{MQTT_CONFIG['base_topic']}{'#'}"
+            topics = list(dict.fromkeys(topics))
+            new_topics = self.subscriptions.add(topics)
             
-            # 检查是否已经订阅了这个主题
-            if topic in self.subscriptions:
-                print(f"[INFO] 已经订阅了主题 {topic}，跳过重复订阅")
+            # 检查是否已经订阅了这些主题
+            if not new_topics and not self.subscriptions.missing():
+                print(f"[INFO] 已经订阅了全部 {len(topics)} 个主题，跳过重复订阅")
                 return True
                 
             if self.connected and self.client:
-                time.sleep(self.connection_delay)  # 订阅前添加延迟
-                result, mid = self.client.subscribe(topic)
+                result, sent = self.subscriptions.subscribe(self.client, topics)
                 if result == mqtt.MQTT_ERR_SUCCESS:
-                    self.subscriptions.add(topic)
-                    print(f"[OK] 订阅主题: {topic}")
+                    if sent:
+                        print(f"[OK] 订阅 {len(sent)} 个主题: {', '.join(sent[:5])}{' ...' if len(sent) > 5 else ''}")
                     return True
                 else:
-                    print(f"[ERROR] 订阅主题失败: {topic}")
+                    print(f"[ERROR] 订阅主题失败: {', '.join(sent[:5])}")
                     return False
             else:
-                print("[WARNING] MQTT客户端未连接")
+                print(f"[WARNING] MQTT客户端未连接，{len(new_topics)} 个主题将在连接后订阅")
                 return False
                 
         except Exception as e:
             print(f"[ERROR] 订阅主题时出错: {e}")
             return False
 
+    def subscribe_packs_all(self):
+        """订阅所有电池包的主题（多进程时只订阅本分片负责的部分）"""
+        return self.subscribe_topics(telemetry_topics())
+
+    def subscribe_to_packs(self, packsns: List[str]) -> bool:
+        """批量订阅多个电池包的主题"""
+        # 去除首尾空格，跳过空字符串
+        topics = [f"{MQTT_CONFIG['base_topic']}{packsn.strip()}" for packsn in packsns if packsn.strip()]
+        if not topics:
+            print("[WARNING] 电池包序列号为空，跳过订阅")
+            return False
+        return self.subscribe_topics(topics)
 
     def subscribe_to_pack(self, packsn: str):
         """订阅指定电池包的主题"""
-        try:
-            # 去除首尾空格
-            packsn = packsn.strip()
-            if not packsn:  # 如果为空字符串，跳过
-                print("[WARNING] 电池包序列号为空，跳过订阅")
-                return False
-                
-            topic = f"{MQTT_CONFIG['base_topic']}{packsn}"
-            
-            # 检查是否已经订阅了这个主题
-            if topic in self.subscriptions:
-                print(f"[INFO] 已经订阅了主题 {topic}，跳过重复订阅")
-                return True
-                
-            if self.connected and self.client:
-                time.sleep(self.connection_delay)  # 订阅前添加延迟
-                result, mid = self.client.subscribe(topic)
-                if result == mqtt.MQTT_ERR_SUCCESS:
-                    self.subscriptions.add(topic)
-                    print(f"[OK] 订阅主题: {topic}")
-                    return True
-                else:
-                    print(f"[ERROR] 订阅主题失败: {topic}")
-                    return False
-            else:
-                print("[WARNING] MQTT客户端未连接")
-                return False
-                
-        except Exception as e:
-            print(f"[ERROR] 订阅主题时出错: {e}")
-            return False
+        return self.subscribe_to_packs([packsn])
             
     def unsubscribe_from_pack(self, packsn: str):
         """取消订阅指定电池包的主题"""
@@ -222,7 +568,6 @@ class MQTTListener:
             topic = f"{MQTT_CONFIG['base_topic']}{packsn}"
             
             if self.connected and self.client:
-                time.sleep(self.connection_delay)  # 取消订阅前添加延迟
                 self.client.unsubscribe(topic)
                 self.subscriptions.discard(topic)
                 print(f"[OK] 取消订阅主题: {topic}")
@@ -233,9 +578,9 @@ class MQTTListener:
     def publish(self, topic: str, payload: Dict, qos: int = 0, retain: bool = False):
         """发布消息到MQTT服务器"""
         try:
-            if self.connected and self.client:
-                time.sleep(self.connection_delay)  # 发布前添加延迟
-                result = self.client.publish(topic, json.dumps(payload), qos=qos, retain=retain)
+            client = self.get_control_client()
+            if client:
+                result = client.publish(topic, json.dumps(payload), qos=qos, retain=retain)
                 if result.rc == mqtt.MQTT_ERR_SUCCESS:
                     # print(f"[OK] 发布成功 - 主题: {topic}")
                     return True
@@ -248,81 +593,310 @@ class MQTTListener:
         except Exception as e:
             print(f"[ERROR] 发布消息时出错: {e}")
             return False
+
+    def broadcast(self, messages: List[tuple]):
+        """经限速发布器流水线发布一批消息，返回全部确认后完成的future"""
+        return self.publisher.broadcast(messages)
             
     def disconnect(self):
         """断开MQTT连接"""
         try:
             if self.client:
-                time.sleep(self.connection_delay)  # 断开连接前添加延迟
-                self.client.loop_stop()
+                self.publisher.stop()
+                self._stop_event.set()
                 self.client.disconnect()
+                if self._network_thread:
+                    self._network_thread.join(5.0)
+                    self._network_thread = None
                 self.connected = False
+                self._connected_event.clear()
+                if self.control_client:
+                    self.control_client.disconnect()
+                    self.control_client.loop_stop()
+                    self.control_client = None
+                    self.control_connected = False
+                # 处理完已收到的消息再停止写入管道
+                if self.ingest_lane is not None:
+                    self.ingest_lane.stop()
                 print("[OK] MQTT连接已断开")
                 
         except Exception as e:
             print(f"[ERROR] 断开MQTT连接时出错: {e}")
 
+def telemetry_topics() -> List[str]:
+    """本进程需要订阅的遥测主题"""
+    base_topic = MQTT_CONFIG['base_topic']
+    if SHARD_CONFIG['count'] <= 1:
+        return [f"{base_topic}#"]
+    if SHARD_CONFIG['mode'] == 'share':
+        # 共享订阅：broker在组内各工作进程之间分发消息
+        return [f"$share/{SHARD_CONFIG['group']}/{base_topic}#"]
+    # 按packsn哈希：只订阅本分片的电池包
+    return [f"{base_topic}{packsn}" for packsn in get_unique_battery_packs()
+            if shard_of(packsn, SHARD_CONFIG['count']) == SHARD_CONFIG['index']]
+
+def insert_battery_cell_rows(rows: List[Dict[str, Any]]) -> bool:
+    """批量插入battery_cell_data数据"""
+    payload = [jsonable_row(row) for row in rows]
+    key_column = DEDUP_CONFIG['key_column']
+    if key_column:
+        from postgrest.types import ReturnMethod
+        # 按幂等键upsert，已写入过的重复数据直接忽略；失败时execute会抛出APIError
+        get_supabase().table("battery_cell_data").upsert(
+            payload, on_conflict=key_column, ignore_duplicates=True, returning=ReturnMethod.minimal
+        ).execute()
+        return True
+    response = get_supabase().table("battery_cell_data").insert(payload).execute()
+    return bool(response.data)
+
+def insert_battery_cell_rollup_rows(rows: List[Dict[str, Any]]) -> bool:
+    """批量插入电芯汇总数据"""
+    table = DOWNSAMPLE_CONFIG['rollup_table']
+    response = get_supabase().table(table).insert([jsonable_row(row) for row in rows]).execute()
+    return bool(response.data)
+
+def create_battery_cell_sink():
+    """按SINK_MODE选择battery_cell_data的批量写入方式"""
+    sink = create_columnar_sink(SINK_CONFIG, table="battery_cell_data", conflict_column=DEDUP_CONFIG['key_column'])
+    if sink is None:
+        return insert_battery_cell_rows
+    print(f"[INFO] battery_cell_data写入方式: {SINK_CONFIG['mode']}")
+    return sink
+
+def is_retryable_insert_error(e: Exception) -> bool:
+    """判断写库错误是否值得重试（网络/服务端错误可重试，数据错误不可重试）"""
+    from postgrest.exceptions import APIError
+    if isinstance(e, APIError):
+        code = e.code
+    else:
+        # psycopg2错误（COPY模式）带有pgcode
+        code = getattr(e, 'pgcode', None)
+    # SQLSTATE 22xxx 数据异常, 23xxx 约束冲突, 42xxx 语法/字段错误
+    return not (code or '').startswith(('22', '23', '42'))
+
+def packsn_from_topic(topic: str) -> str:
+    """从主题中提取packsn (bms/telemetry/PKG001 -> PKG001)"""
+    return TelemetryDecoder.packsn_from_topic(topic)
+
+def build_battery_row(packsn: str, data: Dict) -> Optional[Dict[str, Any]]:
+    """校验消息并构建battery_cell_data行，不合法时返回None"""
+    return telemetry_decoder.build_row(packsn.strip(), data)
+
+def decode_telemetry_message(topic: str, payload: bytes) -> Optional[Dict[str, Any]]:
+    """解码一条遥测消息为battery_cell_data行"""
+    return telemetry_decoder.decode(topic, payload)
+
+def admit_telemetry(topic: str) -> bool:
+    """按电池包令牌桶判断是否接收这条消息（在解码之前调用）"""
+    return pack_limiter is None or pack_limiter.allow(TelemetryDecoder.packsn_from_topic(topic))
+
+def prepare_admitted_telemetry_row(topic: str, payload: bytes) -> Optional[Dict[str, Any]]:
+    """捕获原始消息，按电池包限速后解码并降采样（asyncio模式的解码入口）"""
+    if capture_writer is not None:
+        capture_writer.record(topic, payload)
+    if not admit_telemetry(topic):
+        return None
+    return prepare_telemetry_row(topic, payload)
+
+def prepare_telemetry_row(topic: str, payload: bytes) -> Optional[Dict[str, Any]]:
+    """解码并降采样，返回需要写入battery_cell_data的行"""
+    row = telemetry_decoder.decode(topic, payload)
+    if row is None:
+        return None
+    # 最新状态在降采样之前更新，查询到的总是最后一次收到的读数
+    if latest_state is not None:
+        latest_state.update(row)
+    if rule_engine is not None:
+        rule_engine.evaluate(row)
+    return downsampler.process(row)
+
+def replay_telemetry_row(topic: str, payload: bytes, received_at: float) -> Optional[Dict[str, Any]]:
+    """回放捕获的消息：与收包时相同的解码、校验和降采样，created_at使用捕获时的接收时间
+
+    不更新最新状态、不检查告警规则（历史数据不应覆盖实时状态或重新发布告警）。
+    """
+    row = telemetry_decoder.decode(topic, payload, received_at)
+    if row is None:
+        return None
+    return downsampler.process(row, received_at)
+
 # 全局MQTT监听器实例
 mqtt_listener = MQTTListener()
 
+# 全局热数据存储实例（启用时原始数据只写本地，由压缩任务上传）
+hot_store = HotStore(
+    HOTSTORE_CONFIG['directory'],
+    table="battery_cell_data",
+    partition_seconds=HOTSTORE_CONFIG['partition_seconds'],
+    synchronous=HOTSTORE_CONFIG['synchronous'],
+    max_bytes=HOTSTORE_CONFIG['max_bytes']
+) if HOTSTORE_CONFIG['enabled'] else None
+
+hotstore_compactor = HotStoreCompactor(
+    hot_store,
+    upload=insert_battery_cell_rollup_rows if HOTSTORE_CONFIG['upload_mode'] == 'rollup' else create_battery_cell_sink(),
+    mode=HOTSTORE_CONFIG['upload_mode'],
+    rollup_window=HOTSTORE_CONFIG['rollup_window'],
+    batch_size=PIPELINE_CONFIG['batch_size'],
+    interval=HOTSTORE_CONFIG['compact_interval'],
+    grace=HOTSTORE_CONFIG['grace'],
+    retention=HOTSTORE_CONFIG['retention'],
+    is_retryable=is_retryable_insert_error,
+    tz=beijing_tz
+) if hot_store is not None else None
+
+# 全局写入管道实例
+write_pipeline = WritePipeline(
+    sink=hot_store.write if hot_store is not None else create_battery_cell_sink(),
+    batch_size=PIPELINE_CONFIG['batch_size'],
+    flush_interval=PIPELINE_CONFIG['flush_interval'],
+    max_queue_size=PIPELINE_CONFIG['max_queue_size'],
+    put_timeout=PIPELINE_CONFIG['put_timeout'],
+    num_workers=PIPELINE_CONFIG['num_workers'],
+    spool_config=SPOOL_CONFIG if SPOOL_CONFIG['enabled'] else None,
+    is_retryable=is_retryable_insert_error,
+    metrics=metrics
+)
+
+# 汇总数据写入管道（仅在降采样汇总模式下启动）
+rollup_pipeline = WritePipeline(
+    sink=insert_battery_cell_rollup_rows,
+    batch_size=PIPELINE_CONFIG['batch_size'],
+    flush_interval=PIPELINE_CONFIG['flush_interval'],
+    max_queue_size=PIPELINE_CONFIG['max_queue_size'],
+    put_timeout=PIPELINE_CONFIG['put_timeout'],
+    num_workers=1,
+    spool_config=SPOOL_CONFIG if SPOOL_CONFIG['enabled'] else None,
+    is_retryable=is_retryable_insert_error,
+    name=DOWNSAMPLE_CONFIG['rollup_table'],
+    metrics=metrics
+)
+
+# 全局最新状态表实例
+latest_state = LatestStateStore(max_packs=STATE_CONFIG['max_packs']) if STATE_CONFIG['enabled'] else None
+
+# 全局原始消息捕获实例
+capture_writer = CaptureWriter(
+    CAPTURE_CONFIG['directory'],
+    prefix=f"capture-{SHARD_CONFIG['index']}",
+    rotate_bytes=CAPTURE_CONFIG['rotate_bytes'],
+    rotate_seconds=CAPTURE_CONFIG['rotate_seconds'],
+    compresslevel=CAPTURE_CONFIG['compresslevel'],
+    max_queue_size=CAPTURE_CONFIG['queue_size']
+) if CAPTURE_CONFIG['enabled'] else None
+
+# 全局电池包限速实例
+pack_limiter = PackRateLimiter(
+    rate=FLOW_CONFIG['pack_rate'],
+    burst=FLOW_CONFIG['pack_burst']
+) if FLOW_CONFIG['pack_rate'] > 0 else None
+
+# 全局告警规则引擎实例
+rule_engine = RuleEngine(
+    thresholds=RULES_CONFIG['thresholds'],
+    overrides=load_threshold_overrides(RULES_CONFIG['overrides_file']),
+    get_publisher=lambda: mqtt_listener,
+    alert_topic=RULES_CONFIG['alert_topic'],
+    qos=RULES_CONFIG['qos'],
+    repeat_interval=RULES_CONFIG['repeat_interval']
+) if RULES_CONFIG['enabled'] else None
+
+# 全局降采样实例
+downsampler = PackDownsampler(
+    mode=DOWNSAMPLE_CONFIG['mode'],
+    deadbands=DOWNSAMPLE_CONFIG['deadbands'],
+    heartbeat_interval=DOWNSAMPLE_CONFIG['heartbeat_interval'],
+    rollup_window=DOWNSAMPLE_CONFIG['rollup_window'],
+    emit_rollup=rollup_pipeline.submit,
+    max_packs=DOWNSAMPLE_CONFIG['max_packs'],
+    tz=beijing_tz
+)
+
+def start_downsampling():
+    """启动汇总写入管道和窗口到期检查"""
+    if downsampler.rollup_enabled:
+        rollup_pipeline.start()
+        downsampler.start()
+
+def stop_downsampling():
+    """输出未完成的窗口并停止汇总写入管道"""
+    if downsampler.rollup_enabled:
+        downsampler.stop()
+        rollup_pipeline.stop()
+
+def start_hotstore():
+    """启动热数据压缩任务"""
+    if hotstore_compactor is not None:
+        hotstore_compactor.start()
+        print(f"[OK] 本地热数据存储: {hot_store.directory}，上传方式: {HOTSTORE_CONFIG['upload_mode']}")
+
+def stop_hotstore():
+    """停止压缩任务并关闭本地分区（在写入管道停止之后调用）"""
+    if hotstore_compactor is not None:
+        hotstore_compactor.stop()
+        hot_store.close()
+
+def print_hotstore_stats():
+    """打印热数据存储统计"""
+    if hotstore_compactor is None:
+        return
+    stats = hotstore_compactor.stats()
+    print(f"[STATS] 本地热数据: {stats['partitions']} 个分区, {stats['disk_bytes'] / 1024 / 1024:.1f} MB, "
+          f"已写入 {stats['rows_written']} 条, 已上传 {stats['partitions_uploaded']} 个分区/{stats['rows_uploaded']} 条, "
+          f"已删除 {stats['partitions_deleted']} 个分区, 上传失败 {stats['upload_failures']} 次")
+    if stats['partitions_discarded']:
+        print(f"[WARNING] 本地热数据超过磁盘上限，已丢弃 {stats['partitions_discarded']} 个分区/{stats['rows_discarded']} 条")
+
+def print_flow_stats():
+    """打印遥测收包通道、原始消息捕获和电池包限速统计"""
+    lane = mqtt_listener.ingest_lane
+    if lane is not None and lane.messages_submitted:
+        stats = lane.stats()
+        print(f"[STATS] 遥测收包通道: 队列深度 {stats['queue_depth']}/{stats['queue_capacity']}, "
+              f"已处理 {stats['messages_processed']} 条, 丢弃 {stats['messages_dropped']} 条")
+    if capture_writer is not None:
+        stats = capture_writer.stats()
+        print(f"[STATS] 原始消息捕获: {stats['messages_captured']} 条, 已完成 {stats['files_completed']} 个文件, "
+              f"队列满丢弃 {stats['messages_dropped']} 条, 写入失败 {stats['write_errors']} 次")
+    if pack_limiter is None:
+        return
+    stats = pack_limiter.stats()
+    top = ", ".join(f"{packsn}({count})" for packsn, count in pack_limiter.top_throttled())
+    print(f"[STATS] 电池包限速: 限速丢弃 {stats['messages_throttled']} 条, 被限速电池包 {stats['packs_throttled']} 次"
+          f"{'，最多: ' + top if top else ''}")
+
+def print_downsample_stats():
+    """打印降采样统计"""
+    if not downsampler.enabled:
+        return
+    stats = downsampler.stats()
+    print(f"[STATS] 降采样({stats['mode']}): 输入 {stats['rows_in']} 行, 写入 {stats['rows_passed']} 行, "
+          f"过滤 {stats['rows_suppressed']} 行, 心跳 {stats['heartbeats']} 次, 汇总 {stats['rollups_emitted']} 行")
+
 def get_all_battery_packs() -> List[Dict[str, Any]]:
     """获取所有电池包信息"""
-    try:
-        response = supabase.table("battery_pack_info").select("packsn").execute()
-        if response.data:
-            # 清理每个packsn的首尾空格
-            cleaned_packs = []
-            for pack in response.data:
-                packsn = pack.get('packsn')
-                if packsn:
-                    cleaned_packsn = packsn.strip()
-                    if cleaned_packsn:  # 只添加非空字符串
-                        pack['packsn'] = cleaned_packsn
-                        cleaned_packs.append(pack)
-            return cleaned_packs
-        return []
-    except Exception as e:
-        print(f"[ERROR] 获取电池包信息失败: {e}")
-        return []
+    # 缓存中的packsn已清理首尾空格并去掉空字符串
+    return [{'packsn': pack['packsn']} for pack in pack_registry.rows()]
 
 def get_unique_battery_packs() -> List[str]:
     """获取唯一的电池包序列号列表"""
-    try:
-        response = supabase.table("battery_pack_info").select("packsn").execute()
-        if response.data:
-            # 使用集合来存储唯一的packsn
-            unique_packsn = set()
-            cleaned_packsn = []
-            
-            for pack in response.data:
-                packsn = pack.get('packsn')
-                if packsn:
-                    cleaned_packsn = packsn.strip()
-                    if cleaned_packsn and cleaned_packsn not in unique_packsn:
-                        unique_packsn.add(cleaned_packsn)
-                        
-            return list(unique_packsn)
-        return []
-    except Exception as e:
-        print(f"[ERROR] 获取唯一电池包信息失败: {e}")
-        return []
+    return pack_registry.packsns()
 
 def get_all_battery_pack_info() -> List[Dict[str, Any]]:
     """获取所有电池包详细信息"""
-    try:
-        response = supabase.table("battery_pack_info").select("*").execute()
-        if response.data:
-            return response.data
-        return []
-    except Exception as e:
-        print(f"[ERROR] 获取电池包详细信息失败: {e}")
-        return []
+    return pack_registry.rows()
 
-def initilize_battery_pack_info_publishing():
-    """发布电池包信息到MQTT"""
+def initilize_battery_pack_info_publishing(broadcaster: Optional[PackInfoBroadcaster] = None,
+                                           rows: Optional[List[Dict[str, Any]]] = None):
+    """发布电池包信息到MQTT（传入已加载的rows时不再重新查询）"""
     print("[PUBLISH] 开始发布电池包信息到MQTT...")
 
-    publish_status = publish_battery_pack_info()
+    broadcaster = broadcaster or pack_info_broadcaster
+    try:
+        publish_status = broadcaster.broadcast_all(rows).result(timeout=PUBLISH_CONFIG['broadcast_timeout'])
+    except Exception as e:
+        print(f"[ERROR] 等待电池包信息发布完成时出错: {e}")
+        publish_status = []
         
     if len(publish_status) == 0:
         print("[WARNING] 没有电池包信息可发布")
@@ -335,72 +909,183 @@ def initilize_battery_pack_info_publishing():
             print(f"[OK] 第{i}条电池包信息发布成功")
         else:
             print(f"[ERROR] 第{i}条电池包信息发布失败")
-        
-        time.sleep(0.5)
     
     print(f"[OK] 电池包信息发布完成，共发布 {sum(publish_status)} 条")
 
-def publish_battery_pack_info():
-    """发布电池包信息到MQTT"""
-    if not (pack_info_list := get_all_battery_pack_info()):
-        return []
+def build_pack_info_message(pack_info: Dict[str, Any]) -> Dict[str, Any]:
+    """构建电池包信息发布内容"""
+    # 简洁的数据构建
+    publish_data = {
+        key: pack_info.get(key, '').strip() 
+        if isinstance(pack_info.get(key), str) 
+        else pack_info.get(key)
+        for key in [
+            'id', 'packsn', 'bmssn', 'manufacturer', 'device_type',
+            'rated_capacity', 'rated_voltage', 'battery_type', 'number_of_cells',
+            'number_of_temperature_sensors', 'bms_hardware_version',
+            'bms_software_version', 'created_at', 'updated_at'
+        ]
+        if pack_info.get(key) is not None
+    }
     
-    publish_status = []
+    publish_data['publish_time'] = datetime.now(beijing_tz).replace(microsecond=0).isoformat()
+    return publish_data
+
+def broadcast_battery_pack_info(publisher=None):
+    """经限速发布器广播电池包信息，返回全部确认后完成的future（结果为发布状态列表）"""
+    publisher = publisher or mqtt_listener
+    pack_info_list = get_all_battery_pack_info()
     
-    for i, pack_info in enumerate(pack_info_list):
+    messages = []
+    for pack_info in pack_info_list:
         try:
-            # 简洁的数据构建
-            publish_data = {
-                key: pack_info.get(key, '').strip() 
-                if isinstance(pack_info.get(key), str) 
-                else pack_info.get(key)
-                for key in [
-                    'id', 'packsn', 'bmssn', 'manufacturer', 'device_type',
-                    'rated_capacity', 'rated_voltage', 'battery_type', 'number_of_cells',
-                    'number_of_temperature_sensors', 'bms_hardware_version',
-                    'bms_software_version', 'created_at', 'updated_at'
-                ]
-                if pack_info.get(key) is not None
-            }
-            
-            publish_data['publish_time'] = datetime.now(beijing_tz).replace(microsecond=0).isoformat()
-            
-            # 发布并记录状态
-            success = mqtt_listener.publish(
-                topic=MQTT_CONFIG['control_topic'],
-                payload=publish_data,
-                qos=1,
-                retain=False
-            )
-            
-            publish_status.append(int(success))
-            
-            # 条件延迟
-            if i < len(pack_info_list) - 1:
-                time.sleep(0.5)
-                
-        except Exception:
-            publish_status.append(0)
+            messages.append((MQTT_CONFIG['control_topic'], build_pack_info_message(pack_info), 1, False))
+        except Exception as e:
+            print(f"[ERROR] 构建电池包信息时出错: {e}")
     
-    return publish_status
+    return publisher.broadcast(messages)
+
+def publish_battery_pack_info(publisher=None):
+    """发布电池包信息到MQTT，等待全部确认后返回发布状态列表"""
+    future = broadcast_battery_pack_info(publisher)
+    try:
+        return future.result(timeout=PUBLISH_CONFIG['broadcast_timeout'])
+    except Exception as e:
+        print(f"[ERROR] 等待电池包信息发布完成时出错: {e}")
+        return []
+
+def fetch_all_battery_pack_info() -> List[Dict[str, Any]]:
+    """全量查询battery_pack_info（失败时抛出异常）"""
+    response = get_supabase().table("battery_pack_info").select("*").execute()
+    return response.data or []
+
+def fetch_changed_battery_pack_info(since: str) -> List[Dict[str, Any]]:
+    """查询updated_at不早于since的battery_pack_info行（失败时抛出异常），并同步到缓存"""
+    response = get_supabase().table("battery_pack_info").select("*").gte("updated_at", since).execute()
+    rows = response.data or []
+    pack_registry.upsert(rows)
+    return rows
+
+def refresh_battery_pack_registry() -> List[Dict[str, Any]]:
+    """强制刷新电池包信息缓存并返回全部行（失败时抛出异常）"""
+    return pack_registry.refresh(force=True)
+
+# 全局电池包信息缓存
+pack_registry = PackRegistry(
+    fetch_all=fetch_all_battery_pack_info,
+    ttl=REGISTRY_CONFIG['ttl'],
+    miss_refresh_interval=REGISTRY_CONFIG['miss_refresh_interval']
+)
+
+# 全局去重窗口实例
+dedup_window = DedupWindow(
+    capacity=DEDUP_CONFIG['capacity'],
+    ttl=DEDUP_CONFIG['ttl']
+) if DEDUP_CONFIG['enabled'] else None
+
+# 全局遥测解码器（按缓存的电池包元数据校验数组长度）
+telemetry_decoder = TelemetryDecoder(
+    registry=pack_registry,
+    json_backend=DECODER_CONFIG['json_backend'],
+    array_backend=DECODER_CONFIG['array_backend'],
+    float_typecode=DECODER_CONFIG['float_typecode'],
+    strict_lengths=DECODER_CONFIG['strict_lengths'],
+    validate_packsn=REGISTRY_CONFIG['validate_packsn'],
+    tz=beijing_tz,
+    dedup=dedup_window,
+    dedup_key_column=DEDUP_CONFIG['key_column']
+)
+
+def create_pack_info_broadcaster(get_publisher) -> PackInfoBroadcaster:
+    """创建增量电池包信息广播器"""
+    return PackInfoBroadcaster(
+        fetch_all=refresh_battery_pack_registry,
+        fetch_changed=fetch_changed_battery_pack_info,
+        build_message=build_pack_info_message,
+        get_publisher=get_publisher,
+        control_topic=MQTT_CONFIG['control_topic'],
+        retain=PACK_INFO_CONFIG['retain'],
+        full_refresh_interval=PACK_INFO_CONFIG['full_refresh_interval']
+    )
+
+def publish_changed_battery_pack_info(broadcaster: Optional[PackInfoBroadcaster] = None) -> List[int]:
+    """只发布发生变化的电池包信息，返回发布状态列表"""
+    broadcaster = broadcaster or pack_info_broadcaster
+    try:
+        return broadcaster.broadcast_changes().result(timeout=PUBLISH_CONFIG['broadcast_timeout'])
+    except Exception as e:
+        print(f"[ERROR] 等待电池包信息发布完成时出错: {e}")
+        return []
+
+# 全局电池包信息广播器
+pack_info_broadcaster = create_pack_info_broadcaster(lambda: mqtt_listener)
+
+def load_pack_registry() -> List[Dict[str, Any]]:
+    """加载电池包信息缓存（启动时只查询一次），失败时返回空列表"""
+    try:
+        rows = pack_registry.refresh()
+    except Exception as e:
+        print(f"[ERROR] 加载电池包信息失败: {e}")
+        return []
+    print(f"[STATS] 发现 {len(pack_registry.packsns())} 个唯一的电池包")
+    return rows
 
 def start_mqtt_listener():
-    """启动MQTT监听器"""
+    """启动MQTT监听器
+    
+    fast模式下电池包信息与MQTT连接并行加载，订阅收到SUBACK即开始收包，
+    电池包信息广播在后台线程中进行；full模式按顺序执行并等待广播完成。
+    """
     print("[START] 启动MQTT监听器...")
+    started_at = time.monotonic()
     
-    # 连接MQTT
-    if not mqtt_listener.connect():
-        print("[ERROR] MQTT连接失败")
-        return False
+    # 启动写入管道
+    write_pipeline.start()
+    start_downsampling()
+    start_hotstore()
+    if capture_writer is not None:
+        capture_writer.start()
+    
+    fast = STARTUP_CONFIG['mode'] != 'full'
+    registry_loaded = threading.Event()
+    registry_rows: List[List[Dict[str, Any]]] = []
     
-    # 获取所有唯一的电池包序列号
-    unique_packsn = get_unique_battery_packs()
-    print(f"[STATS] 发现 {len(unique_packsn)} 个唯一的电池包")
+    def load_registry():
+        registry_rows.append(load_pack_registry())
+        registry_loaded.set()
     
+    if fast:
+        threading.Thread(target=load_registry, name="registry-load", daemon=True).start()
+    else:
+        load_registry()
+    
+    # 连接MQTT（失败时网络线程在后台继续重连，已登记的订阅在连接后补订）
+    connected = mqtt_listener.connect()
+    
+    # 通配符/共享订阅不依赖电池包列表，只有按packsn哈希分片时才需等待加载完成
+    if SHARD_CONFIG['count'] > 1 and SHARD_CONFIG['mode'] == 'hash':
+        registry_loaded.wait()
     mqtt_listener.subscribe_packs_all()
     
+    if not connected:
+        print("[ERROR] MQTT连接失败，后台继续重连")
+        return False
+    
+    if mqtt_listener.wait_subscribed(STARTUP_CONFIG['subscribe_timeout']):
+        print(f"[OK] 订阅已确认，启动耗时 {(time.monotonic() - started_at) * 1000:.0f} ms")
+    else:
+        print(f"[WARNING] {STARTUP_CONFIG['subscribe_timeout']:.0f} 秒内未收到全部SUBACK，继续等待broker确认")
+    
     # 发布电池包信息
-    initilize_battery_pack_info_publishing()
+    if IS_LEADER_SHARD:
+        def broadcast():
+            registry_loaded.wait()
+            initilize_battery_pack_info_publishing(rows=registry_rows[0])
+        
+        if fast:
+            threading.Thread(target=broadcast, name="pack-info-broadcast", daemon=True).start()
+        else:
+            broadcast()
     
     print("[OK] MQTT监听器已启动")
     return True
@@ -409,28 +1094,37 @@ def stop_mqtt_listener():
     """停止MQTT监听器"""
     print("[STOP] 停止MQTT监听器...")
     mqtt_listener.disconnect()
+    if capture_writer is not None:
+        capture_writer.close()
+    stop_downsampling()
+    write_pipeline.stop()
+    stop_hotstore()
     print("[OK] MQTT监听器已停止")
 
 def get_battery_pack_info(packsn: str) -> Dict[str, Any]:
     """获取指定电池包的详细信息"""
-    try:
-        # 清理packsn的首尾空格
-        packsn = packsn.strip()
-        response = supabase.table("battery_pack_info").select("*").eq("packsn", packsn).execute()
-        if response.data:
-            return response.data[0]
-        else:
-            print(f"未找到电池包 {packsn} 的信息")
-            return None
-    except Exception as e:
-        print(f"获取电池包信息时出错: {e}")
-        return None
+    pack = pack_registry.get(packsn)
+    if pack is None:
+        print(f"未找到电池包 {packsn.strip()} 的信息")
+    return pack
+
+def get_battery_pack_infos(packsns: List[str]) -> Dict[str, Dict[str, Any]]:
+    """批量获取电池包详细信息，返回 packsn -> 信息"""
+    return pack_registry.get_many(packsns)
 
-def read_latest_battery_cell_data() -> Dict[str, Any]:
-    """读取battery_cell_data表的最后一个记录"""
+def read_latest_battery_cell_data(packsn: Optional[str] = None) -> Dict[str, Any]:
+    """读取最新的电池单元数据：优先使用内存中的最新状态，没有时才查询battery_cell_data表"""
+    if latest_state is not None:
+        snapshots = [latest_state.get(packsn)] if packsn else latest_state.snapshots()
+        snapshots = [snapshot for snapshot in snapshots if snapshot is not None]
+        if snapshots:
+            return max(snapshots, key=lambda snapshot: snapshot.received_at).to_dict()
     try:
         # 按创建时间倒序排列，只取第一条
-        response = supabase.table("battery_cell_data").select("*").order("created_at", desc=True).limit(1).execute()
+        query = get_supabase().table("battery_cell_data").select("*")
+        if packsn:
+            query = query.eq("packsn", packsn)
+        response = query.order("created_at", desc=True).limit(1).execute()
         
         if response.data and len(response.data) > 0:
             record = response.data[0]
@@ -454,18 +1148,11 @@ def read_latest_battery_cell_data() -> Dict[str, Any]:
 def read_battery_pack_info() -> List[Dict[str, Any]]:
     """读取battery_pack_info表的所有数据"""
     try:
-        response = supabase.table("battery_pack_info").select("*").execute()
+        rows = pack_registry.rows()
         
-        if response.data:
+        if rows:
             # 获取唯一的电池包序列号
-            unique_packsn = set()
-            unique_pack_info = []
-            
-            for record in response.data:
-                packsn = record.get('packsn')
-                if packsn and packsn not in unique_packsn:
-                    unique_packsn.add(packsn)
-                    unique_pack_info.append(record)
+            unique_pack_info = pack_registry.unique_rows()
             
             print(f"\n成功读取到 {len(unique_pack_info)} 条唯一的电池包信息记录:")
             for i, record in enumerate(unique_pack_info, 1):
@@ -484,7 +1171,7 @@ def read_battery_pack_info() -> List[Dict[str, Any]]:
                 print(f"  BMS软件版本: {record.get('bms_software_version')}")
                 print(f"  创建时间: {record.get('created_at')}")
                 print(f"  更新时间: {record.get('updated_at')}")
-            return response.data
+            return rows
         else:
             print("电池包信息表中没有数据")
             return []
@@ -493,26 +1180,305 @@ def read_battery_pack_info() -> List[Dict[str, Any]]:
         print(f"读取电池包信息时出错: {e}")
         return []
 
+def print_dedup_stats():
+    """打印去重窗口统计，用于评估窗口大小"""
+    if dedup_window is None:
+        return
+    stats = dedup_window.stats()
+    print(f"[STATS] 去重窗口: {stats['size']}/{stats['capacity']}, 命中 {stats['hits']} 次, "
+          f"未命中 {stats['misses']} 次, 命中率 {stats['hit_rate']:.2%}, 容量淘汰 {stats['evictions']} 次")
+
+def print_rule_stats():
+    """打印告警规则引擎统计"""
+    if rule_engine is None:
+        return
+    stats = rule_engine.stats()
+    print(f"[STATS] 告警规则: 检查 {stats['rows_evaluated']} 条, 触发 {stats['alerts_raised']} 次, "
+          f"恢复 {stats['alerts_cleared']} 次, 未恢复 {stats['alerts_active']} 条, 发布失败 {stats['publish_failed']} 次")
+
 def monitor_mqtt_status():
     """监控MQTT状态"""
     while True:
         if mqtt_listener.connected:
             print("[RUNNING] MQTT监听器运行中...")
-            publish_status = publish_battery_pack_info()
-            if sum(publish_status) > 0:
-                print(f"[OK] 电池包信息发布完成，共发布 {sum(publish_status)} 条")
+            stats = write_pipeline.stats()
+            print(f"[STATS] 写入队列深度: {stats['queue_depth']}/{stats['queue_capacity']}, "
+                  f"已写入 {stats['rows_written']} 条, 失败 {stats['rows_failed']} 条, 丢弃 {stats['rows_dropped']} 条, 本地缓冲待回放 {stats['spool_pending']} 条")
+            for worker in stats['workers']:
+                print(f"[STATS] 写入线程 {worker['worker']}: {worker['rows_per_second']} 行/秒, "
+                      f"累计 {worker['rows_written']} 条, 队列深度 {worker['queue_depth']}")
+            print_dedup_stats()
+            print_rule_stats()
+            print_flow_stats()
+            print_downsample_stats()
+            print_hotstore_stats()
+            if SHARD_CONFIG['count'] > 1 and SHARD_CONFIG['mode'] == 'hash':
+                # 订阅本分片新增的电池包
+                mqtt_listener.subscribe_packs_all()
+            if IS_LEADER_SHARD:
+                publish_status = publish_changed_battery_pack_info()
+                if sum(publish_status) > 0:
+                    print(f"[OK] 电池包信息发布完成，共发布 {sum(publish_status)} 条")
         else:
-            print("[WARNING] MQTT连接断开，尝试重连...")
-            time.sleep(1)  # 重连前等待1秒
-            start_mqtt_listener()
-        time.sleep(30)  # 每30秒检查一次
+            # 网络线程按退避间隔复用原会话自动重连，这里只报告状态
+            print(f"[WARNING] MQTT连接断开，等待自动重连（已断开 {mqtt_listener.disconnects} 次，"
+                  f"恢复会话 {mqtt_listener.sessions_resumed} 次）")
+        time.sleep(PACK_INFO_CONFIG['broadcast_interval'])  # 每30秒检查一次
+
+async def run_async_ingestor():
+    """以asyncio模式运行：收包、解码、攒批、写库共用一个事件循环"""
+    engine = AsyncIngestor(
+        mqtt_config=MQTT_CONFIG,
+        supabase_url=SUPABASE_URL,
+        supabase_key=SUPABASE_KEY,
+        decode=prepare_admitted_telemetry_row,
+        batch_size=PIPELINE_CONFIG['batch_size'],
+        flush_interval=PIPELINE_CONFIG['flush_interval'],
+        max_queue_size=PIPELINE_CONFIG['max_queue_size'],
+        max_in_flight=ASYNC_CONFIG['max_in_flight'],
+        publish_config=PUBLISH_CONFIG,
+        http_config=HTTP_POOL_CONFIG,
+        spool_config=SPOOL_CONFIG if SPOOL_CONFIG['enabled'] else None,
+        conflict_column=DEDUP_CONFIG['key_column'],
+        metrics=metrics,
+        session_config=SESSION_CONFIG
+    )
+    if hot_store is not None:
+        print("[WARNING] asyncio模式直接写远端数据库，HOTSTORE_ENABLED仅在线程模式下生效")
+    if FLOW_CONFIG['control_connection'] == 'separate':
+        print("[WARNING] asyncio模式收发共用一个连接，CONTROL_CONNECTION=separate仅在线程模式下生效")
+    register_metrics(engine)
+    # 电池包信息与MQTT连接并行加载；只有按packsn哈希分片时订阅才依赖电池包列表
+    registry_task = asyncio.create_task(asyncio.to_thread(load_pack_registry))
+    hash_sharded = SHARD_CONFIG['count'] > 1 and SHARD_CONFIG['mode'] == 'hash'
+    if not hash_sharded:
+        for topic in telemetry_topics():
+            engine.subscribe(topic)
+    broadcaster = create_pack_info_broadcaster(lambda: engine)
+    if rule_engine is not None:
+        rule_engine.get_publisher = lambda: engine
+    start_downsampling()
+    if capture_writer is not None:
+        capture_writer.start()
+    reporter = start_shard_reporter(lambda: collect_async_shard_stats(engine))
+    start_metrics_server()
+    start_state_server()
+    await engine.start()
+    await registry_task
+    if hash_sharded:
+        for topic in telemetry_topics():
+            engine.subscribe(topic)
+    
+    try:
+        while True:
+            await asyncio.sleep(PACK_INFO_CONFIG['broadcast_interval'])  # 每30秒发布一次变化的电池包信息
+            if engine.connected:
+                print("[RUNNING] asyncio采集引擎运行中...")
+            if SHARD_CONFIG['count'] > 1 and SHARD_CONFIG['mode'] == 'hash':
+                # 订阅本分片新增的电池包
+                for topic in telemetry_topics():
+                    if topic not in engine.subscriptions:
+                        engine.subscribe(topic)
+            if engine.connected and IS_LEADER_SHARD:
+                publish_status = await asyncio.to_thread(publish_changed_battery_pack_info, broadcaster)
+                if sum(publish_status) > 0:
+                    print(f"[OK] 电池包信息发布完成，共发布 {sum(publish_status)} 条")
+            stats = engine.stats()
+            print(f"[STATS] 队列深度: {stats['queue_depth']}, 在途写入: {stats['in_flight']}, "
+                  f"已写入 {stats['rows_written']} 条, 失败 {stats['rows_failed']} 条, "
+                  f"丢弃 {stats['messages_dropped']} 条, 本地缓冲待回放 {stats['spool_pending']} 条")
+            print_dedup_stats()
+            print_rule_stats()
+            print_flow_stats()
+            print_downsample_stats()
+    finally:
+        await engine.stop()
+        if capture_writer is not None:
+            capture_writer.close()
+        stop_downsampling()
+        if reporter:
+            reporter.stop()
+
+def register_metrics(engine: Optional[AsyncIngestor] = None):
+    """把各组件已有的统计注册为抓取时读取的指标"""
+    if engine is None:
+        metrics.counter_func("ingestor_messages_received", "收到的MQTT消息数", lambda: mqtt_listener.messages_received)
+        metrics.counter_func("ingestor_mqtt_connects", "MQTT连接成功次数（含重连）", lambda: mqtt_listener.connects)
+        metrics.counter_func("ingestor_mqtt_disconnects", "MQTT断开次数", lambda: mqtt_listener.disconnects)
+        metrics.counter_func("ingestor_mqtt_sessions_resumed", "重连时恢复持久会话的次数", lambda: mqtt_listener.sessions_resumed)
+        publisher = mqtt_listener.publisher
+        pipelines = [write_pipeline, rollup_pipeline]
+        metrics.counter_func("ingestor_rows_written", "已写入的行数",
+                             lambda: {p.name: p.counters()['rows_written'] for p in pipelines}, ("table",))
+        metrics.counter_func("ingestor_rows_failed", "写入失败的行数",
+                             lambda: {p.name: p.counters()['rows_failed'] for p in pipelines}, ("table",))
+        metrics.counter_func("ingestor_rows_dropped", "队列满被丢弃的行数",
+                             lambda: {p.name: p.counters()['rows_dropped'] for p in pipelines}, ("table",))
+        metrics.gauge_func("ingestor_queue_depth", "写入队列深度",
+                           lambda: {p.name: p.counters()['queue_depth'] for p in pipelines}, ("table",))
+        metrics.gauge_func("ingestor_spool_pending_rows", "本地缓冲待回放的行数",
+                           lambda: {p.name: p.counters()['spool_pending'] for p in pipelines}, ("table",))
+        lane = mqtt_listener.ingest_lane
+        if lane is not None:
+            metrics.gauge_func("ingestor_ingest_lane_depth", "遥测收包通道队列深度", lambda: lane.queue.qsize())
+            metrics.counter_func("ingestor_ingest_lane_dropped", "遥测收包通道队列满被丢弃的消息数",
+                                 lambda: lane.messages_dropped)
+    else:
+        metrics.counter_func("ingestor_messages_received", "收到的MQTT消息数", lambda: engine.messages_received)
+        metrics.counter_func("ingestor_mqtt_connects", "MQTT连接成功次数（含重连）", lambda: engine.connects)
+        metrics.counter_func("ingestor_mqtt_disconnects", "MQTT断开次数", lambda: engine.disconnects)
+        metrics.counter_func("ingestor_mqtt_sessions_resumed", "重连时恢复持久会话的次数", lambda: engine.sessions_resumed)
+        publisher = engine.publisher
+        metrics.counter_func("ingestor_rows_written", "已写入的行数", lambda: {engine.table: engine.rows_written}, ("table",))
+        metrics.counter_func("ingestor_rows_failed", "写入失败的行数", lambda: {engine.table: engine.rows_failed}, ("table",))
+        metrics.counter_func("ingestor_rows_dropped", "队列满被丢弃的行数",
+                             lambda: {engine.table: engine.messages_dropped}, ("table",))
+        metrics.gauge_func("ingestor_queue_depth", "写入队列深度",
+                           lambda: {engine.table: engine.stats()['queue_depth']}, ("table",))
+        metrics.gauge_func("ingestor_spool_pending_rows", "本地缓冲待回放的行数",
+                           lambda: {engine.table: engine.stats()['spool_pending']}, ("table",))
+        metrics.gauge_func("ingestor_inserts_in_flight", "在途写库请求数", engine.in_flight)
+
+    metrics.counter_func("ingestor_messages_decoded", "解码成功的消息数",
+                         lambda: telemetry_decoder.messages_decoded)
+    metrics.counter_func("ingestor_decode_errors", "解码失败或被拒绝的消息数",
+                         lambda: {reason: telemetry_decoder.stats()[reason] for reason in
+                                  ('decode_errors', 'missing_fields', 'length_mismatches', 'unknown_packs')},
+                         ("reason",))
+    metrics.counter_func("ingestor_publish_sent", "已发布的控制消息数", lambda: publisher.messages_sent)
+    metrics.counter_func("ingestor_publish_acked", "已确认（PUBACK）的控制消息数", lambda: publisher.messages_acked)
+    metrics.counter_func("ingestor_publish_failed", "发布失败或确认超时的控制消息数", lambda: publisher.messages_failed)
+    metrics.gauge_func("ingestor_publish_awaiting_ack", "等待确认的控制消息数", lambda: publisher.stats()['awaiting_ack'])
+    metrics.counter_func("ingestor_registry_lookups", "电池包信息缓存查询次数",
+                         lambda: {"hit": pack_registry.hits, "miss": pack_registry.misses}, ("result",))
+    if dedup_window is not None:
+        metrics.counter_func("ingestor_dedup_lookups", "去重窗口查询次数",
+                             lambda: {"hit": dedup_window.hits, "miss": dedup_window.misses}, ("result",))
+        metrics.gauge_func("ingestor_dedup_window_size", "去重窗口当前大小", dedup_window.size)
+    if capture_writer is not None:
+        metrics.counter_func("ingestor_messages_captured", "写入捕获文件的原始消息数",
+                             lambda: capture_writer.messages_captured)
+    if pack_limiter is not None:
+        metrics.counter_func("ingestor_messages_throttled", "超过单个电池包速率被丢弃的消息数",
+                             lambda: pack_limiter.messages_throttled)
+        metrics.counter_func("ingestor_packs_throttled", "电池包开始被限速的次数", lambda: pack_limiter.packs_throttled)
+    if rule_engine is not None:
+        metrics.counter_func("ingestor_alerts", "告警规则触发和恢复次数",
+                             lambda: {"raised": rule_engine.alerts_raised, "cleared": rule_engine.alerts_cleared},
+                             ("state",))
+        metrics.gauge_func("ingestor_alerts_active", "未恢复的告警数", lambda: rule_engine.stats()['alerts_active'])
+    if downsampler.enabled:
+        metrics.counter_func("ingestor_downsample_rows", "降采样处理的行数",
+                             lambda: {"passed": downsampler.rows_passed, "suppressed": downsampler.rows_suppressed},
+                             ("result",))
+
+def start_metrics_server() -> Optional[MetricsServer]:
+    """启动Prometheus指标端点"""
+    if METRICS_CONFIG['port'] <= 0:
+        return None
+    server = MetricsServer(metrics, host=METRICS_CONFIG['host'], port=METRICS_CONFIG['port'] + SHARD_CONFIG['index'])
+    return server if server.start() else None
+
+def start_state_server() -> Optional[StateServer]:
+    """启动最新状态查询接口"""
+    if latest_state is None or STATE_CONFIG['port'] <= 0:
+        return None
+    try:
+        app = create_state_app(latest_state, known_packsns=lambda: [
+            packsn for packsn in pack_registry.packsns()
+            if SHARD_CONFIG['mode'] != 'hash' or shard_of(packsn, SHARD_CONFIG['count']) == SHARD_CONFIG['index']])
+    except RuntimeError as e:
+        print(f"[WARNING] {e}")
+        return None
+    server = StateServer(app, host=STATE_CONFIG['host'], port=STATE_CONFIG['port'] + SHARD_CONFIG['index'])
+    return server if server.start() else None
+
+def collect_shard_stats() -> Dict[str, Any]:
+    """线程模式下本工作进程的统计（上报给监督进程）"""
+    counters = write_pipeline.counters()
+    counters['connected'] = mqtt_listener.connected
+    counters['messages_received'] = mqtt_listener.messages_received
+    return counters
+
+def collect_async_shard_stats(engine: AsyncIngestor) -> Dict[str, Any]:
+    """asyncio模式下本工作进程的统计（上报给监督进程）"""
+    stats = engine.stats()
+    return {
+        "connected": engine.connected,
+        "messages_received": stats['messages_received'],
+        "rows_written": stats['rows_written'],
+        "rows_failed": stats['rows_failed'],
+        "rows_dropped": stats['messages_dropped'],
+        "queue_depth": stats['queue_depth'],
+        "spool_pending": stats['spool_pending'],
+    }
+
+def start_shard_reporter(collect) -> Optional[ShardReporter]:
+    """作为监督模式的工作进程运行时，启动统计上报线程"""
+    if not SHARD_CONFIG['stats_shm']:
+        return None
+    reporter = ShardReporter(ShardStats(SHARD_CONFIG['count'], name=SHARD_CONFIG['stats_shm']),
+                             SHARD_CONFIG['index'], collect)
+    reporter.start()
+    return reporter
+
+def run_supervisor(args):
+    """监督模式：启动多个工作进程分担订阅和写入"""
+    argv = [os.path.abspath(__file__), "--runtime", args.runtime, "--workers", "1", "--startup", args.startup]
+    Supervisor(
+        argv,
+        num_workers=args.workers,
+        mode=SHARD_CONFIG['mode'],
+        group=SHARD_CONFIG['group'],
+        report_interval=PACK_INFO_CONFIG['broadcast_interval']
+    ).run()
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="电池管理系统数据采集")
+    parser.add_argument(
+        "--runtime", choices=["thread", "async"],
+        default=os.getenv("RUNTIME_MODE", "thread"),
+        help="运行模式: thread=paho网络线程(默认), async=asyncio事件循环"
+    )
+    parser.add_argument(
+        "--workers", type=int,
+        default=SHARD_CONFIG['workers'],
+        help="工作进程数，大于1时以监督模式运行并按SHARD_MODE分片"
+    )
+    parser.add_argument(
+        "--startup", choices=["fast", "full"],
+        default=STARTUP_CONFIG['mode'],
+        help="启动方式: fast=并行加载并在后台广播(默认), full=按顺序执行并打印全部电池包信息"
+    )
+    return parser.parse_args()
 
 if __name__ == "__main__":
+    args = parse_args()
+    STARTUP_CONFIG['mode'] = args.startup
     print("[BATTERY] 电池管理系统数据工具")
     print("=" * 50)
     
-    # 读取电池包信息数据
-    pack_data = read_battery_pack_info()
+    if args.workers > 1 and not SHARD_CONFIG['stats_shm']:
+        run_supervisor(args)
+        raise SystemExit(0)
+    
+    if args.runtime == "async":
+        try:
+            asyncio.run(run_async_ingestor())
+        except KeyboardInterrupt:
+            print("\n\n[STOP] 程序退出中...")
+            print("[OK] 程序已退出")
+        raise SystemExit(0)
+    
+    reporter = start_shard_reporter(collect_shard_stats)
+    register_metrics()
+    start_metrics_server()
+    start_state_server()
+    
+    # 读取电池包信息数据（full模式下打印全部记录）
+    if args.startup == "full":
+        read_battery_pack_info()
     
     # 读取电池单元数据（只显示最后一条记录）
     # latest_cell_data = read_latest_battery_cell_data()
@@ -521,8 +1487,6 @@ if __name__ == "__main__":
         print("[OK] MQTT监听器启动成功")
     else:
         print("[ERROR] MQTT监听器启动失败")
-
-    time.sleep(3)
     
     # 启动MQTT监听器
     mqtt_thread = threading.Thread(target=monitor_mqtt_status, daemon=True)
@@ -0,0 +1,368 @@
+import bisect
+import logging
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# 默认的延迟直方图分桶（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 默认的批量大小直方图分桶（行）
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def _format_labels(labelnames: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        """(后缀, 标签串, 值)"""
+        return ()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """单调递增计数器"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        for key, value in list(self._values.items()):
+            yield "_total", _format_labels(self.labelnames, key), value
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def samples(self):
+        for key, value in list(self._values.items()):
+            yield "", _format_labels(self.labelnames, key), value
+
+
+class Histogram(_Metric):
+    """分桶直方图（累计桶、总和、次数）"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 标签 -> [各桶计数(最后一个为+Inf), 总和, 次数]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels) -> "_Timer":
+        """with metrics.time(): ... 记录代码块耗时"""
+        return _Timer(self, labels)
+
+    def samples(self):
+        for key, (counts, total, count) in list(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield "_bucket", _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"'), cumulative
+            yield "_sum", _format_labels(self.labelnames, key), total
+            yield "_count", _format_labels(self.labelnames, key), count
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: Histogram, labels: Dict[str, Any]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class _CallbackMetric(_Metric):
+    """抓取时才调用回调读取的指标，热路径上零开销（用于已有的stats计数）"""
+
+    def __init__(self, name: str, help_text: str, kind: str,
+                 collect: Callable[[], Any], labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self.kind = kind
+        self.collect = collect
+
+    def samples(self):
+        suffix = "_total" if self.kind == "counter" else ""
+        value = self.collect()
+        if isinstance(value, dict):
+            # 带标签：{标签值或标签值元组: 数值}
+            for key, item in value.items():
+                key = key if isinstance(key, tuple) else (key,)
+                yield suffix, _format_labels(self.labelnames, key), item or 0
+        else:
+            yield suffix, "", value or 0
+
+
+class MetricsRegistry:
+    """进程内指标注册表，按Prometheus文本格式输出"""
+
+    def __init__(self, const_labels: Optional[Dict[str, Any]] = None):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+        self.const_labels = const_labels or {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def counter_func(self, name: str, help_text: str, collect: Callable[[], Any],
+                     labelnames: Sequence[str] = ()):
+        """由回调提供值的计数器"""
+        return self._register(_CallbackMetric(name, help_text, "counter", collect, labelnames))
+
+    def gauge_func(self, name: str, help_text: str, collect: Callable[[], Any],
+                   labelnames: Sequence[str] = ()):
+        """由回调提供值的瞬时值"""
+        return self._register(_CallbackMetric(name, help_text, "gauge", collect, labelnames))
+
+    def render(self) -> str:
+        """输出Prometheus文本格式"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# 采集 {metric.name} 失败: {e}")
+        if self.const_labels:
+            extra = ",".join(f'{k}="{_escape(v)}"' for k, v in self.const_labels.items())
+            lines = [_add_const_labels(line, extra) for line in lines]
+        return "\n".join(lines) + "\n"
+
+
+def _add_const_labels(line: str, extra: str) -> str:
+    if line.startswith('#'):
+        return line
+    name_part, value = line.rsplit(' ', 1)
+    if name_part.endswith('}'):
+        return f"{name_part[:-1]},{extra}}} {value}"
+    return f"{name_part}{{{extra}}} {value}"
+
+
+class MetricsServer:
+    """本地HTTP指标端点（GET /metrics）"""
+
+    def __init__(self, registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def start(self) -> bool:
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            print(f"[ERROR] 指标端点启动失败 {self.host}:{self.port}: {e}")
+            return False
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        print(f"[OK] 指标端点: http://{self.host}:{self.port}/metrics")
+        return True
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+# ----------------------------------------------------------------------
+# 采样的分级结构化日志
+# ----------------------------------------------------------------------
+class _StructuredFormatter(logging.Formatter):
+    """[LEVEL] 消息 key=value ..."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = f"[{record.levelname}] {record.getMessage()}"
+        fields = getattr(record, 'fields', None)
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+
+class SampledLogger:
+    """按事件键限流的日志：每个键每个周期最多输出N条，被抑制的条数附在下一条日志中"""
+
+    def __init__(self, name: str, level: str = "INFO", max_per_interval: int = 10, interval: float = 1.0):
+        self.logger = logging.getLogger(name)
+        if not self.logger.handlers:
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(_StructuredFormatter())
+            self.logger.addHandler(handler)
+            self.logger.propagate = False
+        self.logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+        self.max_per_interval = max_per_interval
+        self.interval = interval
+        # 键 -> [周期开始时间, 本周期已输出条数, 被抑制条数]
+        self._windows: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def enabled_for(self, level: int) -> bool:
+        return self.logger.isEnabledFor(level)
+
+    def _admit(self, key: str) -> Optional[int]:
+        """判断本条是否输出；输出时返回此前被抑制的条数"""
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = [now, 0, 0]
+            if now - window[0] >= self.interval:
+                window[0] = now
+                window[1] = 0
+            if window[1] >= self.max_per_interval:
+                window[2] += 1
+                return None
+            window[1] += 1
+            suppressed, window[2] = window[2], 0
+            return suppressed
+
+    def log(self, level: int, key: str, message: str, **fields):
+        # 级别未开启时不做任何格式化
+        if not self.logger.isEnabledFor(level):
+            return
+        suppressed = self._admit(key)
+        if suppressed is None:
+            return
+        if suppressed:
+            fields['suppressed'] = suppressed
+        self.logger.log(level, message, extra={'fields': fields})
+
+    def debug(self, key: str, message: str, **fields):
+        self.log(logging.DEBUG, key, message, **fields)
+
+    def info(self, key: str, message: str, **fields):
+        self.log(logging.INFO, key, message, **fields)
+
+    def warning(self, key: str, message: str, **fields):
+        self.log(logging.WARNING, key, message, **fields)
+
+    def error(self, key: str, message: str, **fields):
+        self.log(logging.ERROR, key, message, **fields)
+
+
+_loggers: Dict[str, SampledLogger] = {}
+_log_settings = {"level": "INFO", "max_per_interval": 10, "interval": 1.0}
+
+
+def configure_logging(level: str = "INFO", max_per_interval: int = 10, interval: float = 1.0):
+    """设置所有采样日志的级别和限流参数（包括已创建的）"""
+    _log_settings.update(level=level, max_per_interval=max_per_interval, interval=interval)
+    for logger in _loggers.values():
+        logger.logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+        logger.max_per_interval = max_per_interval
+        logger.interval = interval
+
+
+def get_logger(name: str) -> SampledLogger:
+    """按名称获取共享的采样日志"""
+    logger = _loggers.get(name)
+    if logger is None:
+        logger = _loggers[name] = SampledLogger(name, **_log_settings)
+    return logger
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+# 计算内容哈希时忽略的字段（每次发布都会变化）
+_VOLATILE_KEYS = ('publish_time',)
+
+
+def content_hash(message: Dict[str, Any]) -> str:
+    """计算电池包信息的内容哈希"""
+    stable = {key: value for key, value in message.items() if key not in _VOLATILE_KEYS}
+    raw = json.dumps(stable, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(raw.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class PackInfoBroadcaster:
+    """增量电池包信息广播
+
+    按packsn缓存每行的内容哈希和updated_at水位线，每个周期只查询
+    updated_at不早于水位线的行，只发布内容发生变化的电池包；
+    周期性全量刷新以发现删除的电池包和未更新updated_at的修改。
+    内容哈希只在消息被确认后记录，发布失败或超时的电池包在下个周期通过全量刷新重发。
+    """
+
+    def __init__(self,
+                 fetch_all: Callable[[], List[Dict[str, Any]]],
+                 fetch_changed: Callable[[str], List[Dict[str, Any]]],
+                 build_message: Callable[[Dict[str, Any]], Dict[str, Any]],
+                 get_publisher: Callable[[], Any],
+                 control_topic: str,
+                 retain: bool = False,
+                 retained_topic_prefix: Optional[str] = None,
+                 full_refresh_interval: float = 600.0):
+        self.fetch_all = fetch_all
+        self.fetch_changed = fetch_changed
+        self.build_message = build_message
+        self.get_publisher = get_publisher
+        self.control_topic = control_topic
+        self.retain = retain
+        self.retained_topic_prefix = retained_topic_prefix or f"{control_topic}/"
+        self.full_refresh_interval = full_refresh_interval
+
+        self._hashes: Dict[str, str] = {}
+        self._watermark: Optional[str] = None
+        self._last_full_refresh = 0.0
+        # 有消息发布失败时，下个周期做一次全量刷新
+        self._resend_due = False
+        # 可重入锁：发布结果可能在_publish内同步返回并立即触发确认回调
+        self._lock = threading.RLock()
+
+        # 统计信息
+        self.rows_fetched = 0
+        self.rows_published = 0
+        self.rows_unchanged = 0
+        self.rows_failed = 0
+
+    def invalidate(self):
+        """清空快照，下个周期重新全量发布"""
+        with self._lock:
+            self._hashes.clear()
+            self._watermark = None
+            self._last_full_refresh = 0.0
+
+    def snapshot_size(self) -> int:
+        return len(self._hashes)
+
+    @staticmethod
+    def _empty_result() -> Future:
+        future: Future = Future()
+        future.set_result([])
+        return future
+
+    def broadcast_all(self, rows: Optional[List[Dict[str, Any]]] = None) -> Future:
+        """全量发布所有电池包信息（启动时使用；传入rows时不再查询数据库）"""
+        with self._lock:
+            try:
+                if rows is None:
+                    rows = self.fetch_all()
+            except Exception as e:
+                print(f"[ERROR] 获取电池包详细信息失败: {e}")
+                return self._empty_result()
+            self._last_full_refresh = time.monotonic()
+            return self._publish(rows, full=True, force=True)
+
+    def broadcast_changes(self) -> Future:
+        """只发布自上次以来发生变化的电池包信息"""
+        with self._lock:
+            full = (self._watermark is None or self._resend_due
+                    or time.monotonic() - self._last_full_refresh >= self.full_refresh_interval)
+            try:
+                if full:
+                    rows = self.fetch_all()
+                    self._last_full_refresh = time.monotonic()
+                    self._resend_due = False
+                else:
+                    # 使用>=水位线查询，同一时刻的修改靠内容哈希去重
+                    rows = self.fetch_changed(self._watermark)
+            except Exception as e:
+                # 查询失败时不能当作空表处理，否则会误删快照
+                print(f"[ERROR] 获取电池包详细信息失败: {e}")
+                return self._empty_result()
+            return self._publish(rows, full=full, force=False)
+
+    def _publish(self, rows: List[Dict[str, Any]], full: bool, force: bool) -> Future:
+        """比对内容哈希并发布变化的行"""
+        self.rows_fetched += len(rows)
+        messages = []
+        # 控制主题消息在messages中的位置 -> (packsn, 内容哈希)，确认后才记录哈希
+        pending: Dict[int, tuple] = {}
+        seen = set()
+
+        for row in rows:
+            packsn = (row.get('packsn') or '').strip()
+            if not packsn:
+                continue
+            seen.add(packsn)
+            updated_at = row.get('updated_at')
+            if updated_at and (self._watermark is None or str(updated_at) > self._watermark):
+                self._watermark = str(updated_at)
+
+            try:
+                message = self.build_message(row)
+            except Exception as e:
+                print(f"[ERROR] 构建电池包信息时出错: {e}")
+                continue
+
+            digest = content_hash(message)
+            if not force and self._hashes.get(packsn) == digest:
+                self.rows_unchanged += 1
+                continue
+
+            pending[len(messages)] = (packsn, digest)
+            messages.append((self.control_topic, message, 1, False))
+            if self.retain:
+                messages.append((f"{self.retained_topic_prefix}{packsn}", message, 1, True))
+
+        if full:
+            # 全量刷新时清理已删除的电池包
+            for packsn in [p for p in self._hashes if p not in seen]:
+                del self._hashes[packsn]
+                if self.retain:
+                    # 空的retained消息会清除broker上保留的旧信息
+                    messages.append((f"{self.retained_topic_prefix}{packsn}", b"", 1, True))
+
+        self.rows_published += len(pending)
+        future = self.get_publisher().broadcast(messages)
+        future.add_done_callback(lambda done: self._acknowledged(done, pending))
+        return future
+
+    def _acknowledged(self, future: Future, pending: Dict[int, tuple]):
+        """记录已确认消息的内容哈希；有失败时下个周期全量刷新重发"""
+        try:
+            statuses = future.result()
+        except Exception:
+            statuses = []
+        failed = 0
+        with self._lock:
+            for index, (packsn, digest) in pending.items():
+                if index < len(statuses) and statuses[index]:
+                    self._hashes[packsn] = digest
+                else:
+                    failed += 1
+                    # 旧哈希可能与失败的内容相同，清除后全量刷新时一定重发
+                    self._hashes.pop(packsn, None)
+            if failed:
+                self.rows_failed += failed
+                self._resend_due = True
+
+    def stats(self) -> Dict[str, Any]:
+        """返回广播统计信息"""
+        return {
+            "snapshot_size": len(self._hashes),
+            "watermark": self._watermark,
+            "rows_fetched": self.rows_fetched,
+            "rows_published": self.rows_published,
+            "rows_unchanged": self.rows_unchanged,
+            "rows_failed": self.rows_failed,
+        }
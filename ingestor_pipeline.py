@@ -0,0 +1,295 @@
+import os
+import queue
+import threading
+import time
+import zlib
+from typing import Any, Callable, Dict, List, Optional
+
+from ingestor_metrics import SIZE_BUCKETS, get_logger
+from ingestor_spool import DiskSpool
+
+# 关闭写入线程的哨兵对象
+_STOP = object()
+
+# 反压时每条被丢弃的数据都会触发日志，按事件类型限流
+log = get_logger("ingestor.pipeline")
+
+
+class InsertWorker:
+    """单个写入线程：独占一个有界队列，负责一部分电池包的数据"""
+
+    def __init__(self, pipeline: "WritePipeline", index: int, max_queue_size: int):
+        self.pipeline = pipeline
+        self.index = index
+        self.queue: "queue.Queue" = queue.Queue(maxsize=max_queue_size)
+        self.thread: Optional[threading.Thread] = None
+
+        # 写库失败时的本地缓冲（每个写入线程独立，保证同一电池包的顺序）
+        self.spool: Optional[DiskSpool] = None
+        self._next_retry = 0.0
+
+        # 吞吐量统计
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.batches_written = 0
+        self.started_at = time.monotonic()
+        self._last_sample = (self.started_at, 0)
+
+    def start(self):
+        """启动写入线程"""
+        self.started_at = time.monotonic()
+        self._last_sample = (self.started_at, self.rows_written)
+        config = self.pipeline.spool_config
+        if config and self.spool is None:
+            self.spool = DiskSpool(
+                os.path.join(config['directory'], self.pipeline.name, f"worker-{self.index}"),
+                segment_bytes=config['segment_bytes'],
+                max_bytes=max(config['segment_bytes'], config['max_bytes'] // self.pipeline.num_workers),
+                fsync_interval=config['fsync_interval'],
+                fsync_every=config['fsync_every']
+            )
+        self.thread = threading.Thread(
+            target=self._run, name=f"writer-{self.pipeline.name}-{self.index}", daemon=True
+        )
+        self.thread.start()
+
+    def is_alive(self) -> bool:
+        return bool(self.thread and self.thread.is_alive())
+
+    def rows_per_second(self) -> float:
+        """自上次采样以来的写入速率（行/秒）"""
+        now = time.monotonic()
+        last_time, last_rows = self._last_sample
+        self._last_sample = (now, self.rows_written)
+        elapsed = now - last_time
+        if elapsed <= 0:
+            return 0.0
+        return (self.rows_written - last_rows) / elapsed
+
+    def stats(self) -> Dict[str, Any]:
+        """返回该线程的统计信息"""
+        uptime = time.monotonic() - self.started_at
+        return {
+            "worker": self.index,
+            "queue_depth": self.queue.qsize(),
+            "rows_written": self.rows_written,
+            "rows_failed": self.rows_failed,
+            "batches_written": self.batches_written,
+            "rows_per_second": round(self.rows_per_second(), 1),
+            "avg_rows_per_second": round(self.rows_written / uptime, 1) if uptime > 0 else 0.0,
+            "spool_pending": self.spool.pending_rows if self.spool else 0,
+        }
+
+    def _run(self):
+        """写入线程主循环：达到批量大小或超时后刷新"""
+        batch_size = self.pipeline.batch_size
+        flush_interval = self.pipeline.flush_interval
+        batch: List[Dict[str, Any]] = []
+        deadline = time.monotonic() + flush_interval
+
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=max(remaining, 0.001))
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._flush(batch)
+                if self.spool:
+                    self.spool.close()
+                    self.spool = None
+                return
+
+            if item is not None:
+                batch.append(item)
+
+            if len(batch) >= batch_size or time.monotonic() >= deadline:
+                self._flush(batch)
+                batch = []
+                deadline = time.monotonic() + flush_interval
+
+    def _flush(self, batch: List[Dict[str, Any]]):
+        """将一批数据写入数据库，失败时转存到本地缓冲"""
+        if batch:
+            if self.spool and self.spool.pending():
+                # 缓冲中还有未回放的数据，新数据排在其后以保持顺序
+                self.spool.append(batch)
+            elif not self._write(batch) and self.spool:
+                self.spool.append(batch)
+                self._next_retry = time.monotonic() + self.pipeline.spool_config['retry_interval']
+                print(f"[WARNING] 写入线程 {self.index} 写库失败，{len(batch)} 条数据已转存本地缓冲")
+
+        if self.spool and self.spool.pending():
+            self._replay()
+
+    def _replay(self):
+        """按顺序回放本地缓冲中的数据，遇到失败则等待下次重试"""
+        if time.monotonic() < self._next_retry:
+            return
+        for _ in range(self.pipeline.spool_config['replay_batches']):
+            rows, position = self.spool.read_batch(self.pipeline.batch_size)
+            if not rows:
+                return
+            if not self._write(rows):
+                self._next_retry = time.monotonic() + self.pipeline.spool_config['retry_interval']
+                return
+            self.spool.commit(position, len(rows))
+            if not self.spool.pending():
+                print(f"[OK] 写入线程 {self.index} 本地缓冲回放完成")
+                return
+
+    def _write(self, batch: List[Dict[str, Any]]) -> bool:
+        """写入一批数据；返回False表示可重试的失败"""
+        pipeline = self.pipeline
+        started = time.perf_counter()
+        try:
+            ok = pipeline.sink(batch)
+            if pipeline.insert_latency is not None:
+                pipeline.insert_latency.observe(time.perf_counter() - started, table=pipeline.name)
+                pipeline.batch_rows.observe(len(batch), table=pipeline.name)
+            if ok:
+                self.rows_written += len(batch)
+                self.batches_written += 1
+                return True
+            print(f"[ERROR] 写入线程 {self.index} 批量写入 {self.pipeline.name} 失败，共 {len(batch)} 条")
+            if not self.spool:
+                self.rows_failed += len(batch)
+            return False
+        except Exception as e:
+            print(f"[ERROR] 写入线程 {self.index} 批量写入 {self.pipeline.name} 时出错: {e}")
+            if self.spool and self.pipeline.is_retryable(e):
+                return False
+            # 不可重试的错误（如数据格式错误），回放也不会成功，直接丢弃
+            self.rows_failed += len(batch)
+            return True
+
+
+class WritePipeline:
+    """MQTT回调与数据库写入之间的有界批量写入管道
+
+    数据按packsn分区到多个写入线程，同一电池包的数据始终由同一线程按顺序写入，
+    不同电池包之间并行刷新。
+    """
+
+    def __init__(self,
+                 sink: Callable[[List[Dict[str, Any]]], bool],
+                 batch_size: int = 100,
+                 flush_interval: float = 1.0,
+                 max_queue_size: int = 10000,
+                 put_timeout: float = 5.0,
+                 num_workers: int = 1,
+                 partition_key: str = "packsn",
+                 spool_config: Optional[Dict[str, Any]] = None,
+                 is_retryable: Callable[[Exception], bool] = lambda e: True,
+                 name: str = "battery_cell_data",
+                 metrics=None):
+        self.sink = sink
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.put_timeout = put_timeout
+        self.num_workers = max(1, num_workers)
+        self.partition_key = partition_key
+        self.spool_config = spool_config
+        self.is_retryable = is_retryable
+        self.name = name
+
+        # 写库耗时和批量大小直方图（传入MetricsRegistry时启用）
+        self.insert_latency = None
+        self.batch_rows = None
+        if metrics is not None:
+            self.insert_latency = metrics.histogram(
+                "ingestor_insert_latency_seconds", "批量写库耗时（秒）", ("table",))
+            self.batch_rows = metrics.histogram(
+                "ingestor_insert_batch_rows", "每批写入的行数", ("table",), buckets=SIZE_BUCKETS)
+
+        # 总队列容量平均分配给各写入线程
+        per_worker_size = max(1, max_queue_size // self.num_workers)
+        self.workers = [InsertWorker(self, i, per_worker_size) for i in range(self.num_workers)]
+        self._running = False
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.rows_submitted = 0
+        self.rows_dropped = 0
+        self.max_depth_seen = 0
+
+    def start(self):
+        """启动所有写入线程（重复调用无副作用）"""
+        with self._lock:
+            if self._running:
+                return
+            for worker in self.workers:
+                worker.start()
+            self._running = True
+
+    def stop(self, timeout: float = 10.0):
+        """停止写入线程，退出前刷新队列中剩余的数据"""
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+        for worker in self.workers:
+            try:
+                worker.queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                print(f"[WARNING] 写入线程 {worker.index} 队列已满，无法发送停止信号")
+        for worker in self.workers:
+            if worker.thread:
+                worker.thread.join(timeout)
+
+    def partition(self, row: Dict[str, Any]) -> int:
+        """根据分区键计算写入线程序号（进程间稳定）"""
+        if self.num_workers == 1:
+            return 0
+        key = str(row.get(self.partition_key, ""))
+        return zlib.crc32(key.encode('utf-8')) % self.num_workers
+
+    def submit(self, row: Dict[str, Any]) -> bool:
+        """提交一行数据；队列满时阻塞调用方（反压），超时后丢弃"""
+        worker = self.workers[self.partition(row)]
+        try:
+            worker.queue.put(row, timeout=self.put_timeout)
+        except queue.Full:
+            self.rows_dropped += 1
+            log.warning("queue_full", "写入队列已满，丢弃数据", table=self.name, worker=worker.index,
+                        rows_dropped=self.rows_dropped)
+            return False
+
+        self.rows_submitted += 1
+        depth = worker.queue.qsize()
+        if depth > self.max_depth_seen:
+            self.max_depth_seen = depth
+        return True
+
+    def queue_depth(self) -> int:
+        """当前所有写入队列的总深度"""
+        return sum(worker.queue.qsize() for worker in self.workers)
+
+    def counters(self) -> Dict[str, Any]:
+        """累计计数（不重置速率采样，供其他线程周期性读取）"""
+        return {
+            "queue_depth": sum(worker.queue.qsize() for worker in self.workers),
+            "rows_written": sum(worker.rows_written for worker in self.workers),
+            "rows_failed": sum(worker.rows_failed for worker in self.workers),
+            "rows_dropped": self.rows_dropped,
+            "spool_pending": sum(worker.spool.pending_rows if worker.spool else 0 for worker in self.workers),
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        """返回管道统计信息"""
+        worker_stats = [worker.stats() for worker in self.workers]
+        return {
+            "queue_depth": sum(w['queue_depth'] for w in worker_stats),
+            "max_queue_depth": self.max_depth_seen,
+            "queue_capacity": self.max_queue_size,
+            "rows_submitted": self.rows_submitted,
+            "rows_written": sum(w['rows_written'] for w in worker_stats),
+            "rows_failed": sum(w['rows_failed'] for w in worker_stats),
+            "rows_dropped": self.rows_dropped,
+            "batches_written": sum(w['batches_written'] for w in worker_stats),
+            "rows_per_second": round(sum(w['rows_per_second'] for w in worker_stats), 1),
+            "spool_pending": sum(w['spool_pending'] for w in worker_stats),
+            "workers": worker_stats,
+        }
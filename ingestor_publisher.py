@@ -0,0 +1,222 @@
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import paho.mqtt.client as mqtt
+
+# 一条待发布消息: (主题, 内容, qos, retain)
+PublishMessage = Tuple[str, Any, int, bool]
+
+
+class TokenBucket:
+    """线程安全的令牌桶限速器，rate<=0 表示不限速"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """尝试取令牌，不足时立即返回False"""
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1.0):
+        """取令牌，不足时等待到令牌补足为止"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class Broadcast:
+    """一次批量发布：全部消息确认（或失败/超时）后完成future
+
+    future的结果为与消息顺序一致的发布状态列表（1成功 / 0失败）。
+    """
+
+    def __init__(self, count: int):
+        self.future: Future = Future()
+        self.statuses = [0] * count
+        self._remaining = count
+        self._lock = threading.Lock()
+        if count == 0:
+            self.future.set_result([])
+
+    def complete(self, index: int, success: bool):
+        with self._lock:
+            self.statuses[index] = int(success)
+            self._remaining -= 1
+            done = self._remaining == 0
+        if done:
+            self.future.set_result(self.statuses)
+
+
+class RateLimitedPublisher:
+    """按令牌桶限速的流水线发布器
+
+    消息不等待确认即连续发出，QoS1消息按mid在on_publish中确认，
+    取代每条消息之间的固定sleep。
+    """
+
+    def __init__(self,
+                 get_client: Callable[[], Optional[mqtt.Client]],
+                 rate: float = 50.0,
+                 burst: Optional[float] = None,
+                 ack_timeout: float = 30.0,
+                 max_pending: int = 100000):
+        self.get_client = get_client
+        self.bucket = TokenBucket(rate, burst)
+        self.ack_timeout = ack_timeout
+
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_pending)
+        self._pending: Dict[int, Tuple[Broadcast, int, float]] = {}
+        # 可重入锁：qos0消息可能在client.publish内部同步触发on_publish
+        self._lock = threading.RLock()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+        # 统计信息
+        self.messages_sent = 0
+        self.messages_acked = 0
+        self.messages_failed = 0
+
+    def start(self):
+        """启动发布线程（重复调用无副作用）"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="mqtt-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """停止发布线程，未发出的消息按失败处理"""
+        self._running = False
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        while True:
+            try:
+                broadcast, index, _ = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self.messages_failed += 1
+            broadcast.complete(index, False)
+
+    def broadcast(self, messages: List[PublishMessage]) -> Future:
+        """提交一批消息，返回全部完成时结束的future"""
+        broadcast = Broadcast(len(messages))
+        for index, message in enumerate(messages):
+            try:
+                self._queue.put_nowait((broadcast, index, message))
+            except queue.Full:
+                self.messages_failed += 1
+                broadcast.complete(index, False)
+        return broadcast.future
+
+    def publish(self, topic: str, payload: Any, qos: int = 0, retain: bool = False) -> Future:
+        """提交单条消息"""
+        return self.broadcast([(topic, payload, qos, retain)])
+
+    def pending_count(self) -> int:
+        """排队及等待确认的消息数"""
+        return self._queue.qsize() + len(self._pending)
+
+    def on_publish(self, client, userdata, mid, reason_code=None, properties=None):
+        """paho发布确认回调（QoS1收到PUBACK）"""
+        with self._lock:
+            entry = self._pending.pop(mid, None)
+        if entry:
+            broadcast, index, _ = entry
+            success = reason_code is None or not reason_code.is_failure
+            if success:
+                self.messages_acked += 1
+            else:
+                self.messages_failed += 1
+            broadcast.complete(index, success)
+
+    def _expire(self):
+        """超时未确认的消息按失败处理"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [mid for mid, (_, _, deadline) in self._pending.items() if deadline <= now]
+            entries = [self._pending.pop(mid) for mid in expired]
+        for broadcast, index, _ in entries:
+            self.messages_failed += 1
+            broadcast.complete(index, False)
+
+    def _send(self, broadcast: Broadcast, index: int, message: PublishMessage):
+        topic, payload, qos, retain = message
+        client = self.get_client()
+        if client is None:
+            self.messages_failed += 1
+            broadcast.complete(index, False)
+            return
+        if not isinstance(payload, (bytes, str)):
+            payload = json.dumps(payload)
+
+        with self._lock:
+            info = client.publish(topic, payload, qos=qos, retain=retain)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                self.messages_failed += 1
+                broadcast.complete(index, False)
+                return
+            self.messages_sent += 1
+            if qos > 0:
+                self._pending[info.mid] = (broadcast, index, time.monotonic() + self.ack_timeout)
+                return
+        self.messages_acked += 1
+        broadcast.complete(index, True)
+
+    def _run(self):
+        """发布线程主循环"""
+        last_expire = time.monotonic()
+        while self._running:
+            try:
+                broadcast, index, message = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                broadcast = None
+
+            if broadcast is not None:
+                self.bucket.acquire()
+                try:
+                    self._send(broadcast, index, message)
+                except Exception as e:
+                    print(f"[ERROR] 发布消息时出错: {e}")
+                    self.messages_failed += 1
+                    broadcast.complete(index, False)
+
+            if self._pending and time.monotonic() - last_expire >= 1.0:
+                self._expire()
+                last_expire = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回发布统计信息"""
+        return {
+            "messages_sent": self.messages_sent,
+            "messages_acked": self.messages_acked,
+            "messages_failed": self.messages_failed,
+            "queued": self._queue.qsize(),
+            "awaiting_ack": len(self._pending),
+        }
@@ -0,0 +1,209 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+
+def normalize_packsn(packsn: Optional[str]) -> str:
+    """统一packsn格式（去除首尾空格）"""
+    return packsn.strip() if isinstance(packsn, str) else ''
+
+
+class _Flight:
+    """一次进行中的加载，并发的未命中请求等待同一次加载结果"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error: Optional[Exception] = None
+
+
+class PackRegistry:
+    """进程内电池包信息缓存
+
+    以去空格后的packsn为键缓存battery_pack_info，支持TTL过期、显式失效和批量查询；
+    并发的未命中只触发一次数据库查询（single-flight），过期后查询失败时继续使用旧数据。
+    """
+
+    def __init__(self,
+                 fetch_all: Callable[[], List[Dict[str, Any]]],
+                 ttl: float = 300.0,
+                 miss_refresh_interval: float = 30.0):
+        self.fetch_all = fetch_all
+        self.ttl = ttl
+        self.miss_refresh_interval = miss_refresh_interval
+
+        self._packs: Dict[str, Dict[str, Any]] = {}
+        self._rows: List[Dict[str, Any]] = []
+        self._loaded_at: Optional[float] = None
+        self._last_miss_refresh = 0.0
+        self._inflight: Optional[_Flight] = None
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    # ------------------------------------------------------------------
+    # 加载
+    # ------------------------------------------------------------------
+    def _is_fresh(self) -> bool:
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def _apply(self, rows: List[Dict[str, Any]]):
+        """用全量查询结果替换缓存（重复的packsn保留第一条）"""
+        packs: Dict[str, Dict[str, Any]] = {}
+        normalized_rows = []
+        for row in rows:
+            packsn = normalize_packsn(row.get('packsn'))
+            if not packsn:
+                continue
+            row = dict(row, packsn=packsn)
+            normalized_rows.append(row)
+            packs.setdefault(packsn, row)
+        with self._lock:
+            self._packs = packs
+            self._rows = normalized_rows
+            self._loaded_at = time.monotonic()
+
+    def refresh(self, force: bool = False) -> List[Dict[str, Any]]:
+        """重新加载全表；并发调用合并为一次查询，失败时抛出异常"""
+        with self._lock:
+            if not force and self._is_fresh():
+                return self._rows
+            flight = self._inflight
+            leader = flight is None
+            if leader:
+                flight = self._inflight = _Flight()
+
+        if not leader:
+            flight.event.wait()
+            if flight.error:
+                raise flight.error
+            return self._rows
+
+        try:
+            self._apply(self.fetch_all())
+            self.loads += 1
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight = None
+            flight.event.set()
+        return self._rows
+
+    def _ensure_fresh(self):
+        """缓存过期时刷新；刷新失败时继续使用旧数据"""
+        if self._is_fresh():
+            return
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"[ERROR] 刷新电池包信息缓存失败: {e}")
+
+    def _refresh_in_background(self):
+        """未知packsn触发的后台刷新，按间隔限流，避免热路径阻塞在数据库查询上"""
+        now = time.monotonic()
+        with self._lock:
+            if self._inflight is not None or now - self._last_miss_refresh < self.miss_refresh_interval:
+                return
+            self._last_miss_refresh = now
+        threading.Thread(target=self._ensure_fresh_forced, name="registry-refresh", daemon=True).start()
+
+    def _ensure_fresh_forced(self):
+        try:
+            self.refresh(force=True)
+        except Exception as e:
+            print(f"[ERROR] 刷新电池包信息缓存失败: {e}")
+
+    def upsert(self, rows: Iterable[Dict[str, Any]]):
+        """合并增量查询到的行（如广播器按updated_at查到的变化）"""
+        with self._lock:
+            packs = dict(self._packs)
+            for row in rows:
+                packsn = normalize_packsn(row.get('packsn'))
+                if packsn:
+                    packs[packsn] = dict(row, packsn=packsn)
+            self._packs = packs
+            self._rows = list(packs.values())
+
+    def invalidate(self, packsn: Optional[str] = None):
+        """使缓存失效；指定packsn时只移除该电池包"""
+        with self._lock:
+            if packsn is None:
+                self._loaded_at = None
+                return
+            packs = dict(self._packs)
+            packs.pop(normalize_packsn(packsn), None)
+            self._packs = packs
+            self._rows = [row for row in self._rows if row['packsn'] in packs]
+
+    # ------------------------------------------------------------------
+    # 查询
+    # ------------------------------------------------------------------
+    def get(self, packsn: str) -> Optional[Dict[str, Any]]:
+        """查询单个电池包信息"""
+        self._ensure_fresh()
+        pack = self._packs.get(normalize_packsn(packsn))
+        if pack is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return pack
+
+    def get_many(self, packsns: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """批量查询，返回已知电池包的 packsn -> 信息"""
+        self._ensure_fresh()
+        packs = self._packs
+        result = {}
+        for packsn in packsns:
+            packsn = normalize_packsn(packsn)
+            pack = packs.get(packsn)
+            if pack is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                result[packsn] = pack
+        return result
+
+    def contains(self, packsn: str) -> bool:
+        """热路径O(1)判断packsn是否已知，不阻塞在数据库查询上"""
+        if packsn in self._packs:
+            self.hits += 1
+            return True
+        self.misses += 1
+        # 可能是新增的电池包，或缓存尚未加载/已过期，触发后台刷新
+        self._refresh_in_background()
+        # 缓存尚未加载时无法判断，放行
+        return self._loaded_at is None
+
+    def peek(self, packsn: str) -> Optional[Dict[str, Any]]:
+        """只读缓存查询，不触发刷新（供热路径使用）"""
+        return self._packs.get(packsn)
+
+    def packsns(self) -> List[str]:
+        """所有唯一的packsn"""
+        self._ensure_fresh()
+        return list(self._packs)
+
+    def rows(self) -> List[Dict[str, Any]]:
+        """全部行（packsn已去空格，保留重复行）"""
+        self._ensure_fresh()
+        return list(self._rows)
+
+    def unique_rows(self) -> List[Dict[str, Any]]:
+        """每个packsn一行"""
+        self._ensure_fresh()
+        return list(self._packs.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存统计信息"""
+        age = time.monotonic() - self._loaded_at if self._loaded_at is not None else None
+        return {
+            "packs": len(self._packs),
+            "age_seconds": round(age, 1) if age is not None else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+        }
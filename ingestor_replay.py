@@ -0,0 +1,185 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from ingestor_capture import capture_files, replay_messages
+from ingestor_supervisor import shard_of
+
+
+# ----------------------------------------------------------------------
+# 单个回放进程
+# ----------------------------------------------------------------------
+def configure_environment(index: int, count: int):
+    """在导入ingestor_main之前设置环境变量，使全局实例按回放配置创建"""
+    os.environ.setdefault("METRICS_PORT", "0")
+    os.environ.setdefault("STATE_API_ENABLED", "false")
+    # 回放的消息不再捕获，也不重新发布告警
+    os.environ["CAPTURE_ENABLED"] = "false"
+    os.environ["RULES_ENABLED"] = "false"
+    # 去重窗口按当前时间过期，全速回放历史数据时会把窗口内的正常行当作重复丢弃；
+    # 重复写入由幂等键列（DEDUP_KEY_COLUMN）在库端去重
+    os.environ["DEDUP_ENABLED"] = "false"
+    # 与在线采集进程的本地缓冲/热数据目录分开
+    os.environ.setdefault("SPOOL_DIR", os.path.join("spool", "replay"))
+    os.environ.setdefault("HOTSTORE_DIR", os.path.join("hotstore", "replay"))
+    os.environ["SHARD_INDEX"] = str(index)
+    os.environ["SHARD_COUNT"] = str(count)
+
+
+def run_replay(files: List[str], index: int, count: int, speed: float,
+               start_at: Optional[float] = None, report_interval: float = 5.0) -> Dict[str, Any]:
+    """回放本分片（按packsn哈希）的消息：解码、校验、降采样后提交到写入管道"""
+    configure_environment(index, count)
+    import ingestor_main as ingestor
+
+    # 与在线采集相同，按电池包元数据校验数组长度和未知电池包
+    ingestor.load_pack_registry()
+    ingestor.write_pipeline.start()
+    if ingestor.downsampler.rollup_enabled:
+        # 窗口按捕获时间推进，不启动按当前时间检查到期的线程，结束时统一输出
+        ingestor.rollup_pipeline.start()
+    ingestor.start_hotstore()
+
+    accept = None
+    if count > 1:
+        def accept(topic: str) -> bool:
+            return shard_of(ingestor.packsn_from_topic(topic), count) == index
+
+    messages = 0
+    rows = 0
+    first_ts = last_ts = None
+    started = time.monotonic()
+    next_report = started + report_interval
+    for received_at, topic, payload in replay_messages(files, speed, accept, start_at):
+        messages += 1
+        if first_ts is None:
+            first_ts = received_at
+        last_ts = received_at
+        try:
+            row = ingestor.replay_telemetry_row(topic, payload, received_at)
+        except Exception as e:
+            print(f"[ERROR] 回放消息时出错 topic={topic}: {e}")
+            continue
+        if row is not None and ingestor.write_pipeline.submit(row):
+            rows += 1
+        if report_interval > 0 and time.monotonic() >= next_report:
+            elapsed = time.monotonic() - started
+            print(f"[REPLAY] 分片 {index}: 已回放 {messages} 条 ({messages / elapsed:.0f} 条/秒), 已提交 {rows} 行")
+            next_report += report_interval
+    decode_seconds = time.monotonic() - started
+
+    # 输出未完成的汇总窗口，等写入管道排空后再统计
+    ingestor.downsampler.stop()
+    ingestor.write_pipeline.stop()
+    if ingestor.downsampler.rollup_enabled:
+        ingestor.rollup_pipeline.stop()
+    ingestor.stop_hotstore()
+    total_seconds = time.monotonic() - started
+
+    counters = ingestor.write_pipeline.counters()
+    return {
+        "shard": index,
+        "messages": messages,
+        "rows_submitted": rows,
+        "rows_written": counters['rows_written'],
+        "rows_failed": counters['rows_failed'],
+        "rows_dropped": counters['rows_dropped'],
+        "spool_pending": counters['spool_pending'],
+        "decode_seconds": round(decode_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+        "captured_span_seconds": round(last_ts - first_ts, 3) if messages else 0.0,
+        "decoder": ingestor.telemetry_decoder.stats(),
+    }
+
+
+def _replay_worker(files, index, count, speed, start_at, report_interval, results):
+    results.put(run_replay(files, index, count, speed, start_at, report_interval))
+
+
+# ----------------------------------------------------------------------
+# 多进程回放
+# ----------------------------------------------------------------------
+def replay(paths: List[str], processes: int = 1, speed: float = 0.0, report_interval: float = 5.0) -> Dict[str, Any]:
+    """回放捕获文件；processes>1时按packsn哈希分给多个进程并行解码和写入"""
+    files = capture_files(paths)
+    if not files:
+        raise SystemExit(f"[ERROR] 没有找到捕获文件: {' '.join(paths)}")
+    print(f"[REPLAY] {len(files)} 个捕获文件, {processes} 个进程, "
+          f"{'全速' if speed <= 0 else f'{speed:g} 倍速'}")
+
+    started = time.monotonic()
+    if processes <= 1:
+        shards = [run_replay(files, 0, 1, speed, report_interval=report_interval)]
+    else:
+        ctx = multiprocessing.get_context("spawn")
+        results = ctx.Queue()
+        # 各进程共用同一起始时刻，按倍速回放时沿同一时间轴推进
+        start_at = time.time() + 1.0
+        workers = [ctx.Process(target=_replay_worker, name=f"replay-{index}",
+                               args=(files, index, processes, speed, start_at, report_interval, results))
+                   for index in range(processes)]
+        for worker in workers:
+            worker.start()
+        shards = []
+        for _ in workers:
+            shards.append(results.get())
+        for worker in workers:
+            worker.join()
+        shards.sort(key=lambda shard: shard['shard'])
+    wall = time.monotonic() - started
+
+    messages = sum(shard['messages'] for shard in shards)
+    rows = sum(shard['rows_written'] for shard in shards)
+    decode_wall = max(shard['decode_seconds'] for shard in shards)
+    return {
+        "files": len(files),
+        "processes": processes,
+        "speed": speed,
+        "messages": messages,
+        "rows_written": rows,
+        "rows_failed": sum(shard['rows_failed'] for shard in shards),
+        "rows_dropped": sum(shard['rows_dropped'] for shard in shards),
+        "wall_seconds": round(wall, 3),
+        "msgs_per_sec": round(messages / decode_wall, 1) if decode_wall > 0 else None,
+        "rows_per_sec": round(rows / wall, 1) if wall > 0 else None,
+        "shards": shards,
+    }
+
+
+def print_report(result: Dict[str, Any]):
+    print("=" * 50)
+    print(f"[REPLAY] 文件: {result['files']}, 进程: {result['processes']}, 耗时: {result['wall_seconds']} 秒")
+    print(f"[REPLAY] 吞吐: {result['msgs_per_sec']} 条/秒解码, {result['rows_per_sec']} 行/秒写库")
+    print(f"[REPLAY] 消息: {result['messages']} 条, 写入 {result['rows_written']} 行, "
+          f"失败 {result['rows_failed']} 行, 丢弃 {result['rows_dropped']} 行")
+    for shard in result['shards']:
+        decoder = shard['decoder']
+        print(f"[REPLAY] 分片 {shard['shard']}: {shard['messages']} 条, 解码失败 {decoder['decode_errors']} 条, "
+              f"缺字段 {decoder['missing_fields']} 条, 长度不符 {decoder['length_mismatches']} 条, "
+              f"重复 {decoder['duplicates']} 条, 本地缓冲待回放 {shard['spool_pending']} 行")
+    print("=" * 50)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="回放捕获的MQTT遥测消息（补数/基准测试）")
+    parser.add_argument("paths", nargs="+", help="捕获文件或目录（CAPTURE_DIR）")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="回放倍速：0为全速（默认），1为按原始节奏，10为10倍速")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="并行回放进程数，按packsn哈希分配，每个进程独立解码和写入")
+    parser.add_argument("--report-interval", type=float, default=5.0, help="进度输出间隔（秒），0为不输出")
+    parser.add_argument("--json", dest="json_path", help="把结果写入JSON文件")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = replay(args.paths, max(1, args.processes), args.speed, args.report_interval)
+    print_report(result)
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"[OK] 结果已写入 {args.json_path}")
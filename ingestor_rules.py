@@ -0,0 +1,215 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from ingestor_decoder import CELL_ARRAY_FIELDS
+
+# (规则名, 字段, 类型, 阈值键)
+#   high: 任一电芯高于阈值; low: 任一电芯低于阈值;
+#   spread: 最大值与最小值之差超过阈值; rate: 任一电芯变化速率（每秒）超过阈值
+RULES = (
+    ('over_voltage', 'cell_voltages', 'high', 'voltage_max'),
+    ('under_voltage', 'cell_voltages', 'low', 'voltage_min'),
+    ('voltage_imbalance', 'cell_voltages', 'spread', 'voltage_spread_max'),
+    ('voltage_rate', 'cell_voltages', 'rate', 'voltage_rate_max'),
+    ('over_temperature', 'cell_temperatures', 'high', 'temperature_max'),
+    ('under_temperature', 'cell_temperatures', 'low', 'temperature_min'),
+    ('temperature_imbalance', 'cell_temperatures', 'spread', 'temperature_spread_max'),
+    ('temperature_rate', 'cell_temperatures', 'rate', 'temperature_rate_max'),
+    ('low_soc', 'cell_socs', 'low', 'soc_min'),
+    ('high_soc', 'cell_socs', 'high', 'soc_max'),
+)
+THRESHOLD_KEYS = tuple(rule[3] for rule in RULES)
+
+# 告警中最多列出的电芯序号
+MAX_ALERT_CELLS = 32
+
+# 规则在这一行上无法计算（如距上次读数不足min_rate_interval），保持原有的告警状态
+_SKIPPED = object()
+
+
+def load_threshold_overrides(path: Optional[str]) -> Dict[str, Dict[str, Optional[float]]]:
+    """读取按电池包覆盖的阈值文件：{"packsn": {"voltage_max": 3.7, ...}}"""
+    if not path:
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return {packsn.strip(): values for packsn, values in data.items()}
+
+
+class _RuleState:
+    """单个电池包的规则状态：上一次的读数（算变化速率）和未恢复的告警"""
+
+    __slots__ = ('last', 'last_at', 'active')
+
+    def __init__(self):
+        self.last: Optional[Dict[str, np.ndarray]] = None
+        self.last_at = 0.0
+        # 规则名 -> 上次发布告警的时间
+        self.active: Dict[str, float] = {}
+
+
+class RuleEngine:
+    """收包路径上的阈值与异常检测
+
+    每条消息对电芯数组做一次向量化计算，按电池包阈值检查过压、欠压、过温、SOC、
+    压差/温差以及变化速率；告警在触发和恢复时各发布一次，持续触发时按repeat_interval重复发布。
+    状态只保存在内存中，不做任何数据库查询。
+    """
+
+    def __init__(self,
+                 thresholds: Dict[str, Optional[float]],
+                 overrides: Optional[Dict[str, Dict[str, Optional[float]]]] = None,
+                 get_publisher: Optional[Callable[[], Any]] = None,
+                 alert_topic: str = "bms/alerts",
+                 qos: int = 1,
+                 repeat_interval: float = 300.0,
+                 min_rate_interval: float = 1.0,
+                 max_packs: int = 100000):
+        self.thresholds = {key: thresholds.get(key) for key in THRESHOLD_KEYS}
+        # 预先合并每个电池包的阈值，热路径只做一次字典查询
+        self._pack_thresholds = {
+            packsn: dict(self.thresholds, **{k: v for k, v in values.items() if k in self.thresholds})
+            for packsn, values in (overrides or {}).items()
+        }
+        self.get_publisher = get_publisher
+        self.alert_topic = alert_topic.rstrip('/')
+        self.qos = qos
+        self.repeat_interval = repeat_interval
+        # 变化速率至少按这么长的间隔计算，避免重连后积压消息集中到达时误报
+        self.min_rate_interval = min_rate_interval
+        self.max_packs = max(1, max_packs)
+        self.uses_rate = any(self.thresholds[rule[3]] is not None or
+                             any(t.get(rule[3]) is not None for t in self._pack_thresholds.values())
+                             for rule in RULES if rule[2] == 'rate')
+
+        self._packs: "OrderedDict[str, _RuleState]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.rows_evaluated = 0
+        self.alerts_raised = 0
+        self.alerts_cleared = 0
+        self.publish_failed = 0
+        self.packs_evicted = 0
+
+    def evaluate(self, row: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """检查一行遥测数据并发布状态发生变化的告警，返回本次发布的告警"""
+        packsn = row['packsn']
+        thresholds = self._pack_thresholds.get(packsn, self.thresholds)
+        now = time.monotonic()
+        vectors = {field: np.asarray(row[field], dtype=np.float64) for field in CELL_ARRAY_FIELDS if field in row}
+        triggered: Dict[str, Dict[str, Any]] = {}
+        # 本行实际计算过的规则；只有计算过且未超过阈值的规则才算恢复
+        evaluated = set()
+
+        with self._lock:
+            self.rows_evaluated += 1
+            state = self._state(packsn)
+            for name, field, kind, key in RULES:
+                threshold = thresholds[key]
+                if threshold is None:
+                    continue
+                values = vectors.get(field)
+                if values is None or values.size == 0:
+                    continue
+                result = self._check(kind, values, threshold, state, field, now)
+                if result is _SKIPPED:
+                    continue
+                evaluated.add(name)
+                if result is not None:
+                    value, cells = result
+                    triggered[name] = {"field": field, "value": round(float(value), 4), "threshold": threshold,
+                                       "cells": cells[:MAX_ALERT_CELLS].tolist()}
+            if self.uses_rate and (state.last is None or now - state.last_at >= self.min_rate_interval):
+                state.last = vectors
+                state.last_at = now
+            alerts = self._transitions(packsn, state, triggered, evaluated, now, row.get('created_at'))
+
+        for alert in alerts:
+            self._publish(alert)
+        return alerts
+
+    def _check(self, kind: str, values: np.ndarray, threshold: float, state: _RuleState, field: str, now: float):
+        """返回(告警值, 相关电芯序号)，未触发时返回None，无法计算时返回_SKIPPED"""
+        if kind == 'high':
+            peak = values.max()
+            if peak > threshold:
+                return peak, np.flatnonzero(values > threshold)
+        elif kind == 'low':
+            low = values.min()
+            if low < threshold:
+                return low, np.flatnonzero(values < threshold)
+        elif kind == 'spread':
+            spread = values.max() - values.min()
+            if spread > threshold:
+                return spread, np.array([int(values.argmax()), int(values.argmin())])
+        elif kind == 'rate':
+            last = state.last
+            elapsed = now - state.last_at
+            previous = last.get(field) if last is not None else None
+            if previous is None or elapsed < self.min_rate_interval or previous.shape != values.shape:
+                return _SKIPPED
+            rates = np.abs(values - previous) / elapsed
+            peak = rates.max()
+            if peak > threshold:
+                return peak, np.flatnonzero(rates > threshold)
+        return None
+
+    def _transitions(self, packsn: str, state: _RuleState, triggered: Dict[str, Dict[str, Any]],
+                     evaluated: set, now: float, created_at: Any) -> List[Dict[str, Any]]:
+        """对比上次状态：新触发、持续触发到达重复间隔、已恢复的规则各生成一条告警
+
+        本行无法计算的规则（缺字段、变化速率间隔不足）保持原有状态，不视为恢复。
+        """
+        alerts = []
+        for name, detail in triggered.items():
+            published_at = state.active.get(name)
+            if published_at is not None and now - published_at < self.repeat_interval:
+                continue
+            state.active[name] = now
+            self.alerts_raised += 1
+            alerts.append(dict(packsn=packsn, rule=name, state="raised", created_at=created_at, **detail))
+        for name in [name for name in state.active if name in evaluated and name not in triggered]:
+            del state.active[name]
+            self.alerts_cleared += 1
+            alerts.append({"packsn": packsn, "rule": name, "state": "cleared", "created_at": created_at})
+        return alerts
+
+    def _state(self, packsn: str) -> _RuleState:
+        state = self._packs.get(packsn)
+        if state is None:
+            state = self._packs[packsn] = _RuleState()
+            while len(self._packs) > self.max_packs:
+                self._packs.popitem(last=False)
+                self.packs_evicted += 1
+        else:
+            self._packs.move_to_end(packsn)
+        return state
+
+    def _publish(self, alert: Dict[str, Any]):
+        publisher = self.get_publisher() if self.get_publisher else None
+        if publisher is None or not publisher.publish(f"{self.alert_topic}/{alert['packsn']}", alert, qos=self.qos):
+            self.publish_failed += 1
+
+    def active_alerts(self) -> Dict[str, List[str]]:
+        """当前未恢复的告警：packsn -> 规则名列表"""
+        with self._lock:
+            return {packsn: list(state.active) for packsn, state in self._packs.items() if state.active}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            active = sum(len(state.active) for state in self._packs.values())
+            return {
+                "packs": len(self._packs),
+                "rows_evaluated": self.rows_evaluated,
+                "alerts_raised": self.alerts_raised,
+                "alerts_cleared": self.alerts_cleared,
+                "alerts_active": active,
+                "publish_failed": self.publish_failed,
+                "packs_evicted": self.packs_evicted,
+            }
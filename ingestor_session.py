@@ -0,0 +1,154 @@
+import random
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+
+class Backoff:
+    """带抖动的指数退避：每次失败延迟翻倍（上限maximum），连接成功后重置
+
+    延迟在 [base/2, base] 之间随机取值，避免整个集群在broker恢复的同一时刻一起重连。
+    """
+
+    def __init__(self, initial: float = 0.1, maximum: float = 30.0, multiplier: float = 2.0):
+        self.initial = max(0.001, initial)
+        self.maximum = max(self.initial, maximum)
+        self.multiplier = multiplier
+        self.attempts = 0
+
+    def next_delay(self) -> float:
+        base = min(self.maximum, self.initial * (self.multiplier ** self.attempts))
+        if base < self.maximum:
+            self.attempts += 1
+        return random.uniform(base / 2, base)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class SubscriptionSet:
+    """期望订阅与broker已确认订阅的对账表
+
+    恢复持久会话（session_present）时broker仍保留原有订阅，只需补订尚未确认的主题；
+    新会话则全部重新订阅。SUBSCRIBE的mid在持锁期间登记，保证SUBACK回调能找到对应主题。
+    """
+
+    def __init__(self, qos: int = 1):
+        self.qos = qos
+        self.desired: Dict[str, int] = {}
+        self.granted = set()
+        self._pending: Dict[int, List[str]] = {}
+        self._lock = threading.Lock()
+        self._granted_changed = threading.Condition(self._lock)
+
+        # 统计信息
+        self.subscribes_sent = 0
+        self.topics_rejected = 0
+
+    def __contains__(self, topic: str) -> bool:
+        return topic in self.desired
+
+    def __iter__(self):
+        return iter(list(self.desired))
+
+    def __len__(self) -> int:
+        return len(self.desired)
+
+    def add(self, topics: Iterable[str]) -> List[str]:
+        """登记期望订阅，返回此前未登记的主题"""
+        with self._lock:
+            new_topics = [topic for topic in dict.fromkeys(topics) if topic not in self.desired]
+            for topic in new_topics:
+                self.desired[topic] = self.qos
+            return new_topics
+
+    def discard(self, topic: str):
+        with self._lock:
+            self.desired.pop(topic, None)
+            self.granted.discard(topic)
+
+    def missing(self) -> List[str]:
+        """已登记但broker尚未确认、也不在确认途中的主题"""
+        with self._lock:
+            return self._missing()
+
+    def _missing(self) -> List[str]:
+        in_flight = {topic for topics in self._pending.values() for topic in topics}
+        return [topic for topic in self.desired if topic not in self.granted and topic not in in_flight]
+
+    def subscribe(self, client: mqtt.Client, topics: Optional[Iterable[str]] = None):
+        """用一条SUBSCRIBE订阅给定主题中尚缺的部分（默认全部缺失主题），返回(结果码, 主题列表)"""
+        with self._lock:
+            missing = self._missing()
+            if topics is not None:
+                wanted = set(topics)
+                missing = [topic for topic in missing if topic in wanted]
+            if not missing:
+                return mqtt.MQTT_ERR_SUCCESS, []
+            result, mid = client.subscribe([(topic, self.desired[topic]) for topic in missing])
+            if result == mqtt.MQTT_ERR_SUCCESS:
+                self._pending[mid] = missing
+                self.subscribes_sent += 1
+            return result, missing
+
+    def acknowledged(self, mid: int, reason_codes: List[Any]) -> List[str]:
+        """处理SUBACK，返回被broker拒绝的主题"""
+        with self._lock:
+            topics = self._pending.pop(mid, [])
+            rejected = []
+            for topic, reason in zip(topics, reason_codes):
+                if getattr(reason, 'is_failure', False):
+                    rejected.append(topic)
+                elif topic in self.desired:
+                    self.granted.add(topic)
+            self.topics_rejected += len(rejected)
+            self._granted_changed.notify_all()
+            return rejected
+
+    def wait_granted(self, timeout: float) -> bool:
+        """等待所有已登记的主题都被broker确认（收到SUBACK后才开始收包）"""
+        with self._lock:
+            return self._granted_changed.wait_for(
+                lambda: all(topic in self.granted for topic in self.desired), timeout)
+
+    def reset(self, session_present: bool):
+        """连接建立时调用：在途的SUBSCRIBE作废；新会话时broker侧订阅已不存在"""
+        with self._lock:
+            self._pending.clear()
+            if not session_present:
+                self.granted.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "desired": len(self.desired),
+                "granted": len(self.granted),
+                "pending": sum(len(topics) for topics in self._pending.values()),
+                "subscribes_sent": self.subscribes_sent,
+                "topics_rejected": self.topics_rejected,
+            }
+
+
+def create_session_client(session_config: Dict[str, Any]) -> mqtt.Client:
+    """创建使用固定client_id的paho客户端，断线重连时复用同一会话"""
+    persistent = session_config['session_expiry'] > 0
+    if session_config['protocol'] == 5:
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,
+                           client_id=session_config['client_id'], protocol=mqtt.MQTTv5)
+    return mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=session_config['client_id'],
+                       clean_session=not persistent, protocol=mqtt.MQTTv311)
+
+
+def session_connect_options(session_config: Dict[str, Any]) -> Dict[str, Any]:
+    """connect/connect_async的会话参数：MQTT 5使用clean_start=False和会话过期时间"""
+    if session_config['protocol'] != 5:
+        return {}
+    properties = Properties(PacketTypes.CONNECT)
+    properties.SessionExpiryInterval = session_config['session_expiry']
+    return {
+        "clean_start": session_config['session_expiry'] <= 0,
+        "properties": properties,
+    }
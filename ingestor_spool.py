@@ -0,0 +1,357 @@
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 段文件格式：
+#   文件头  MAGIC(8字节)
+#   记录帧  <u32 正文长度><u32 crc32><正文>
+#   正文    <u16 字段数> 每个字段: <u8 键长><键><u8 类型><值>
+# 类型: s=字符串 i=int32数组 d=float64数组 f=float32数组 n=None j=JSON兜底
+# 数组字段解码为array.array，写库前由sink转换为列表
+MAGIC = b"BMSWAL01"
+_FRAME = struct.Struct("<II")
+_U32 = struct.Struct("<I")
+_SEGMENT_PREFIX = "spool-"
+_SEGMENT_SUFFIX = ".wal"
+_CURSOR_FILE = "cursor"
+_NEEDS_SWAP = sys.byteorder != "little"
+
+_INT32_MIN = -(1 << 31)
+_INT32_MAX = (1 << 31) - 1
+
+
+def _pack_array(typecode: str, values) -> bytes:
+    """将数值序列编码为小端定长数组"""
+    arr = values if isinstance(values, array) and values.typecode == typecode else array(typecode, values)
+    if _NEEDS_SWAP:
+        arr = array(typecode, arr)
+        arr.byteswap()
+    return _U32.pack(len(arr)) + arr.tobytes()
+
+
+def _encode_value(value: Any) -> bytes:
+    """编码单个字段值"""
+    if value is None:
+        return b"n"
+    if isinstance(value, str):
+        raw = value.encode("utf-8")
+        return b"s" + _U32.pack(len(raw)) + raw
+    if isinstance(value, array) and value.typecode in ("f", "d", "i"):
+        return value.typecode.encode() + _pack_array(value.typecode, value)
+    if np is not None and isinstance(value, np.ndarray):
+        typecode = {"float32": "f", "float64": "d", "int32": "i"}.get(value.dtype.name)
+        if typecode:
+            return typecode.encode() + _pack_array(typecode, array(typecode, value.tobytes()))
+        value = value.tolist()
+    if isinstance(value, (list, tuple, array)):
+        if all(isinstance(v, int) and not isinstance(v, bool) and _INT32_MIN <= v <= _INT32_MAX
+               for v in value):
+            return b"i" + _pack_array("i", value)
+        if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in value):
+            return b"d" + _pack_array("d", value)
+    raw = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return b"j" + _U32.pack(len(raw)) + raw
+
+
+def encode_row(row: Dict[str, Any]) -> bytes:
+    """将一行数据编码为紧凑的二进制正文"""
+    parts = [struct.pack("<H", len(row))]
+    for key, value in row.items():
+        raw_key = key.encode("utf-8")
+        parts.append(struct.pack("<B", len(raw_key)))
+        parts.append(raw_key)
+        parts.append(_encode_value(value))
+    return b"".join(parts)
+
+
+def decode_row(body: bytes) -> Dict[str, Any]:
+    """解码二进制正文，数组字段还原为array.array"""
+    view = memoryview(body)
+    (count,) = struct.unpack_from("<H", view, 0)
+    pos = 2
+    row: Dict[str, Any] = {}
+    for _ in range(count):
+        key_len = view[pos]
+        pos += 1
+        key = bytes(view[pos:pos + key_len]).decode("utf-8")
+        pos += key_len
+        tag = chr(view[pos])
+        pos += 1
+        if tag == "n":
+            row[key] = None
+            continue
+        (length,) = _U32.unpack_from(view, pos)
+        pos += 4
+        if tag in ("i", "d", "f"):
+            arr = array(tag)
+            size = length * arr.itemsize
+            arr.frombytes(view[pos:pos + size])
+            if _NEEDS_SWAP:
+                arr.byteswap()
+            pos += size
+            row[key] = arr
+        else:
+            raw = bytes(view[pos:pos + length])
+            pos += length
+            row[key] = raw.decode("utf-8") if tag == "s" else json.loads(raw)
+    return row
+
+
+class DiskSpool:
+    """按段轮转的只追加本地缓冲（预写日志）
+
+    写库失败的数据按顺序追加到段文件，恢复后按相同顺序回放；
+    fsync按条数或时间批量执行，总磁盘占用超过上限时丢弃最旧的段。
+    """
+
+    def __init__(self,
+                 directory: str,
+                 segment_bytes: int = 64 * 1024 * 1024,
+                 max_bytes: int = 2 * 1024 * 1024 * 1024,
+                 fsync_interval: float = 1.0,
+                 fsync_every: int = 1000):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+        self.fsync_every = fsync_every
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._active_seq = 0
+        self._active_size = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+        # 统计信息
+        self.pending_rows = 0
+        self.rows_spooled = 0
+        self.rows_replayed = 0
+        self.rows_discarded = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._cursor = self._load_cursor()
+        self._recover()
+
+    # ------------------------------------------------------------------
+    # 段文件管理
+    # ------------------------------------------------------------------
+    def _segment_path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"{_SEGMENT_PREFIX}{seq:012d}{_SEGMENT_SUFFIX}")
+
+    def _segments(self) -> List[int]:
+        """按顺序返回所有段序号"""
+        seqs = []
+        for name in os.listdir(self.directory):
+            if name.startswith(_SEGMENT_PREFIX) and name.endswith(_SEGMENT_SUFFIX):
+                try:
+                    seqs.append(int(name[len(_SEGMENT_PREFIX):-len(_SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(seqs)
+
+    def _load_cursor(self) -> Tuple[int, int]:
+        """读取回放位置 (段序号, 偏移)"""
+        try:
+            with open(os.path.join(self.directory, _CURSOR_FILE), "r") as f:
+                seq, offset = f.read().split()
+                return int(seq), int(offset)
+        except (OSError, ValueError):
+            return 0, len(MAGIC)
+
+    def _save_cursor(self, position: Tuple[int, int]):
+        """原子地保存回放位置"""
+        path = os.path.join(self.directory, _CURSOR_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(f"{position[0]} {position[1]}")
+        os.replace(tmp_path, path)
+
+    def _recover(self):
+        """启动时统计未回放的数据，并开启新的活动段"""
+        seqs = self._segments()
+        cursor_seq, cursor_offset = self._cursor
+        for seq in seqs:
+            if seq < cursor_seq:
+                os.remove(self._segment_path(seq))
+            else:
+                start = cursor_offset if seq == cursor_seq else len(MAGIC)
+                self.pending_rows += self._count_frames(self._segment_path(seq), start)
+        seqs = [seq for seq in seqs if seq >= cursor_seq]
+        if seqs and cursor_seq < seqs[0]:
+            self._cursor = (seqs[0], len(MAGIC))
+        self._open_segment((seqs[-1] + 1) if seqs else max(cursor_seq, 1))
+        if not seqs:
+            self._cursor = (self._active_seq, len(MAGIC))
+        if self.pending_rows:
+            print(f"[INFO] 本地缓冲 {self.directory} 中有 {self.pending_rows} 条待回放数据")
+
+    def _open_segment(self, seq: int):
+        """创建新的活动段"""
+        if self._file:
+            self._sync_locked(force=True)
+            self._file.close()
+        self._active_seq = seq
+        self._file = open(self._segment_path(seq), "ab")
+        self._file.write(MAGIC)
+        self._file.flush()
+        self._active_size = len(MAGIC)
+
+    @staticmethod
+    def _iter_frames(path: str, offset: int, max_rows: Optional[int] = None):
+        """从指定偏移开始遍历段内完整的记录帧，产出 (正文, 下一帧偏移)"""
+        with open(path, "rb") as f:
+            f.seek(offset)
+            count = 0
+            while max_rows is None or count < max_rows:
+                header = f.read(_FRAME.size)
+                if len(header) < _FRAME.size:
+                    return
+                length, crc = _FRAME.unpack(header)
+                body = f.read(length)
+                if len(body) < length or zlib.crc32(body) != crc:
+                    # 不完整或损坏的尾部（进程崩溃时写了一半）
+                    return
+                offset += _FRAME.size + length
+                count += 1
+                yield body, offset
+
+    def _count_frames(self, path: str, offset: int) -> int:
+        try:
+            return sum(1 for _ in self._iter_frames(path, offset))
+        except OSError:
+            return 0
+
+    def _disk_usage(self) -> int:
+        total = 0
+        for seq in self._segments():
+            try:
+                total += os.path.getsize(self._segment_path(seq))
+            except OSError:
+                pass
+        return total
+
+    def _enforce_cap_locked(self):
+        """超过磁盘上限时丢弃最旧的已关闭段"""
+        seqs = self._segments()
+        usage = self._disk_usage()
+        while usage > self.max_bytes and len(seqs) > 1:
+            seq = seqs.pop(0)
+            path = self._segment_path(seq)
+            start = self._cursor[1] if seq == self._cursor[0] else len(MAGIC)
+            dropped = self._count_frames(path, start)
+            usage -= os.path.getsize(path)
+            os.remove(path)
+            self.pending_rows -= dropped
+            self.rows_discarded += dropped
+            self._cursor = (seqs[0], len(MAGIC))
+            self._save_cursor(self._cursor)
+            print(f"[WARNING] 本地缓冲超过上限 {self.max_bytes} 字节，丢弃最旧的段 {seq}（{dropped} 条）")
+
+    # ------------------------------------------------------------------
+    # 写入
+    # ------------------------------------------------------------------
+    def append(self, rows: List[Dict[str, Any]]) -> int:
+        """按顺序追加多行数据，返回写入条数"""
+        if not rows:
+            return 0
+        frames = []
+        for row in rows:
+            body = encode_row(row)
+            frames.append(_FRAME.pack(len(body), zlib.crc32(body)))
+            frames.append(body)
+        data = b"".join(frames)
+
+        with self._lock:
+            if self._active_size + len(data) > self.segment_bytes and self._active_size > len(MAGIC):
+                self._open_segment(self._active_seq + 1)
+                self._enforce_cap_locked()
+            self._file.write(data)
+            self._active_size += len(data)
+            self._unsynced += len(rows)
+            self.pending_rows += len(rows)
+            self.rows_spooled += len(rows)
+            self._sync_locked()
+        return len(rows)
+
+    def _sync_locked(self, force: bool = False):
+        """批量fsync：累计条数或间隔时间达到阈值时才落盘"""
+        if not self._file or not self._unsynced:
+            return
+        now = time.monotonic()
+        if force or self._unsynced >= self.fsync_every or now - self._last_sync >= self.fsync_interval:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+            self._last_sync = now
+
+    def sync(self):
+        """强制落盘"""
+        with self._lock:
+            self._sync_locked(force=True)
+
+    # ------------------------------------------------------------------
+    # 回放
+    # ------------------------------------------------------------------
+    def pending(self) -> bool:
+        """是否有待回放的数据"""
+        return self.pending_rows > 0
+
+    def read_batch(self, max_rows: int) -> Tuple[List[Dict[str, Any]], Tuple[int, int]]:
+        """从回放位置读取一批数据，返回 (数据, 新位置)；成功写库后需调用commit"""
+        with self._lock:
+            if self._file:
+                self._file.flush()
+            active_seq = self._active_seq
+        seq, offset = self._cursor
+        rows: List[Dict[str, Any]] = []
+        while len(rows) < max_rows and seq <= active_seq:
+            path = self._segment_path(seq)
+            if os.path.exists(path):
+                for body, offset in self._iter_frames(path, offset, max_rows - len(rows)):
+                    rows.append(decode_row(body))
+            if len(rows) >= max_rows or seq == active_seq:
+                break
+            # 当前段已读完，转到下一段
+            seq, offset = seq + 1, len(MAGIC)
+        return rows, (seq, offset)
+
+    def commit(self, position: Tuple[int, int], count: int):
+        """确认回放到指定位置，删除已完全回放的段"""
+        with self._lock:
+            for seq in self._segments():
+                if seq < position[0] and seq != self._active_seq:
+                    os.remove(self._segment_path(seq))
+            self._cursor = position
+            self._save_cursor(position)
+            self.pending_rows = max(0, self.pending_rows - count)
+            self.rows_replayed += count
+
+    def close(self):
+        """落盘并关闭活动段"""
+        with self._lock:
+            if self._file:
+                self._sync_locked(force=True)
+                self._file.close()
+                self._file = None
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓冲统计信息"""
+        return {
+            "pending_rows": self.pending_rows,
+            "rows_spooled": self.rows_spooled,
+            "rows_replayed": self.rows_replayed,
+            "rows_discarded": self.rows_discarded,
+            "disk_bytes": self._disk_usage(),
+        }
@@ -0,0 +1,166 @@
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from ingestor_decoder import CELL_ARRAY_FIELDS, to_json_list
+
+
+class PackSnapshot:
+    """一个电池包的最新读数（创建后不再修改，读者拿到引用即可安全使用）"""
+
+    __slots__ = ('packsn', 'created_at', 'received_at', 'cells', 'sequence')
+
+    def __init__(self, packsn: str, created_at: Any, received_at: float, cells: Dict[str, Any], sequence: int):
+        self.packsn = packsn
+        self.created_at = created_at
+        self.received_at = received_at
+        self.cells = cells
+        self.sequence = sequence
+
+    def to_dict(self, now: Optional[float] = None) -> Dict[str, Any]:
+        now = time.time() if now is None else now
+        result = {
+            "packsn": self.packsn,
+            "created_at": self.created_at,
+            "received_at": self.received_at,
+            "age_seconds": round(now - self.received_at, 3),
+            "sequence": self.sequence,
+        }
+        for field, values in self.cells.items():
+            result[field] = to_json_list(values)
+        return result
+
+
+class LatestStateStore:
+    """按packsn保存最新读数的内存表
+
+    写入只做一次字典赋值（用新的不可变快照替换旧快照），读取直接取引用，
+    读写之间不加锁；电芯数组沿用解码器产出的定长数组，不做拷贝。
+    """
+
+    def __init__(self, max_packs: int = 100000):
+        self.max_packs = max_packs
+        self._states: Dict[str, PackSnapshot] = {}
+
+        # 统计信息（只由收包线程修改）
+        self.updates = 0
+        self.rejected = 0
+
+    def update(self, row: Dict[str, Any], received_at: Optional[float] = None):
+        """用一行遥测数据更新该电池包的最新状态"""
+        packsn = row.get('packsn')
+        if not packsn:
+            return
+        states = self._states
+        if packsn not in states and len(states) >= self.max_packs:
+            self.rejected += 1
+            return
+        self.updates += 1
+        states[packsn] = PackSnapshot(
+            packsn,
+            row.get('created_at'),
+            time.time() if received_at is None else received_at,
+            {field: row[field] for field in CELL_ARRAY_FIELDS if field in row},
+            self.updates
+        )
+
+    def get(self, packsn: str) -> Optional[PackSnapshot]:
+        return self._states.get(packsn.strip())
+
+    def packsns(self) -> List[str]:
+        return list(self._states)
+
+    def snapshots(self) -> List[PackSnapshot]:
+        return list(self._states.values())
+
+    def stale(self, max_age: float, known_packsns: Optional[List[str]] = None,
+              now: Optional[float] = None) -> List[Dict[str, Any]]:
+        """超过max_age秒没有新数据的电池包；传入known_packsns时包括从未上报过的电池包"""
+        now = time.time() if now is None else now
+        states = dict(self._states)
+        result = []
+        for packsn, snapshot in states.items():
+            age = now - snapshot.received_at
+            if age > max_age:
+                result.append({"packsn": packsn, "received_at": snapshot.received_at, "age_seconds": round(age, 3)})
+        for packsn in known_packsns or ():
+            if packsn not in states:
+                result.append({"packsn": packsn, "received_at": None, "age_seconds": None})
+        # 从未上报的排在最前，其余按静默时长从长到短
+        result.sort(key=lambda item: float('inf') if item['age_seconds'] is None else item['age_seconds'], reverse=True)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "packs": len(self._states),
+            "updates": self.updates,
+            "rejected": self.rejected,
+        }
+
+
+def create_state_app(store: LatestStateStore, known_packsns=None):
+    """创建最新状态查询接口（FastAPI，启用时才导入，避免拖慢启动）"""
+    try:
+        from fastapi import FastAPI, HTTPException, Query
+    except ImportError:
+        raise RuntimeError("最新状态查询接口需要安装fastapi和uvicorn")
+
+    app = FastAPI(title="ingestor latest state")
+
+    @app.get("/packs")
+    def list_packs():
+        now = time.time()
+        return [{"packsn": s.packsn, "created_at": s.created_at, "age_seconds": round(now - s.received_at, 3)}
+                for s in store.snapshots()]
+
+    @app.get("/packs/stale")
+    def stale_packs(max_age: float = Query(60.0, ge=0), include_unseen: bool = False):
+        known = known_packsns() if include_unseen and known_packsns else None
+        return store.stale(max_age, known)
+
+    @app.get("/packs/{packsn}")
+    def pack_state(packsn: str):
+        snapshot = store.get(packsn)
+        if snapshot is None:
+            raise HTTPException(status_code=404, detail=f"没有电池包 {packsn} 的数据")
+        return snapshot.to_dict()
+
+    @app.get("/stats")
+    def state_stats():
+        return store.stats()
+
+    return app
+
+
+class StateServer:
+    """在后台线程中运行最新状态查询接口"""
+
+    def __init__(self, app, host: str = "127.0.0.1", port: int = 9110):
+        self.app = app
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> bool:
+        import uvicorn
+        config = uvicorn.Config(self.app, host=self.host, port=self.port, log_level="warning", access_log=False)
+        # 非主线程中运行时uvicorn不会接管信号处理，Ctrl+C仍由主程序处理
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self._server.run, name="state-http", daemon=True)
+        self._thread.start()
+        deadline = time.monotonic() + 5.0
+        while not self._server.started and self._thread.is_alive() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        if not self._server.started:
+            print(f"[ERROR] 最新状态查询接口启动失败 {self.host}:{self.port}")
+            return False
+        print(f"[OK] 最新状态查询接口: http://{self.host}:{self.port}/packs")
+        return True
+
+    def stop(self):
+        if self._server:
+            self._server.should_exit = True
+            if self._thread:
+                self._thread.join(5.0)
+            self._server = None
@@ -0,0 +1,261 @@
+import os
+import signal
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Callable, Dict, List, Optional
+
+# 每个工作进程在共享内存中占一个槽位，字段均为float64
+STAT_FIELDS = (
+    'heartbeat', 'pid', 'connected', 'messages_received', 'rows_written',
+    'rows_failed', 'rows_dropped', 'queue_depth', 'spool_pending', 'rows_per_second',
+)
+_SLOT = struct.Struct(f"<{len(STAT_FIELDS)}d")
+
+
+def shard_of(packsn: str, count: int) -> int:
+    """packsn所属的分片序号（与写入管道的分区方式一致，进程间稳定）"""
+    if count <= 1:
+        return 0
+    return zlib.crc32(packsn.strip().encode('utf-8')) % count
+
+
+class ShardStats:
+    """父子进程共享的统计表：每个工作进程写自己的槽位，父进程汇总读取"""
+
+    def __init__(self, num_shards: int, name: Optional[str] = None):
+        self.num_shards = num_shards
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=_SLOT.size * num_shards)
+            self.shm.buf[:] = bytes(len(self.shm.buf))
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+            # 附加方不负责释放，避免本进程退出时resource_tracker删除父进程的共享内存
+            try:
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+            except Exception:
+                pass
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def update(self, index: int, values: Dict[str, Any]):
+        """写入一个工作进程的统计（单个写入者，读端可能读到相邻两次更新的混合值，仅用于展示）"""
+        record = [float(values.get(field) or 0) for field in STAT_FIELDS]
+        record[0] = time.time()
+        _SLOT.pack_into(self.shm.buf, index * _SLOT.size, *record)
+
+    def read(self, index: int) -> Dict[str, float]:
+        return dict(zip(STAT_FIELDS, _SLOT.unpack_from(self.shm.buf, index * _SLOT.size)))
+
+    def read_all(self) -> List[Dict[str, float]]:
+        return [self.read(i) for i in range(self.num_shards)]
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class ShardReporter:
+    """工作进程内的统计上报线程"""
+
+    def __init__(self, stats: ShardStats, index: int, collect: Callable[[], Dict[str, Any]],
+                 interval: float = 1.0):
+        self.stats = stats
+        self.index = index
+        self.collect = collect
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_sample = (time.monotonic(), 0)
+
+    def report(self):
+        """采集并写入一次统计，写入速率按两次上报之间的增量计算"""
+        values = self.collect()
+        now = time.monotonic()
+        last_time, last_rows = self._last_sample
+        rows = values.get('rows_written', 0)
+        values['rows_per_second'] = (rows - last_rows) / (now - last_time) if now > last_time else 0.0
+        self._last_sample = (now, rows)
+        values['pid'] = os.getpid()
+        self.stats.update(self.index, values)
+
+    def _run(self):
+        self.report_safely()
+        while not self._stop_event.wait(self.interval):
+            self.report_safely()
+
+    def report_safely(self):
+        try:
+            self.report()
+        except Exception as e:
+            print(f"[ERROR] 上报分片 {self.index} 统计时出错: {e}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="shard-reporter", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(2.0)
+
+
+class Supervisor:
+    """多进程采集监督者
+
+    启动N个工作进程，每个进程通过环境变量得知自己的分片序号；
+    工作进程退出或心跳超时时按退避间隔重启，并定期打印汇总的吞吐和健康状态。
+    """
+
+    def __init__(self,
+                 argv: List[str],
+                 num_workers: int,
+                 mode: str = "share",
+                 group: str = "ingestor",
+                 stale_after: float = 30.0,
+                 restart_delay: float = 1.0,
+                 max_restart_delay: float = 60.0,
+                 report_interval: float = 30.0):
+        if mode not in ('share', 'hash'):
+            raise ValueError(f"未知的分片方式: {mode}")
+        self.argv = argv
+        self.num_workers = num_workers
+        self.mode = mode
+        self.group = group
+        self.stale_after = stale_after
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.report_interval = report_interval
+
+        self.stats: Optional[ShardStats] = None
+        self.processes: List[Optional[subprocess.Popen]] = [None] * num_workers
+        self.restarts = [0] * num_workers
+        self._next_start = [0.0] * num_workers
+        self._started_at = [0.0] * num_workers
+        self._stopping = False
+
+    def _spawn(self, index: int):
+        env = dict(os.environ,
+                   SHARD_INDEX=str(index),
+                   SHARD_COUNT=str(self.num_workers),
+                   SHARD_MODE=self.mode,
+                   SHARED_SUBSCRIPTION_GROUP=self.group,
+                   SHARD_STATS_SHM=self.stats.name)
+        # 独立进程组：终端的Ctrl+C只发给监督进程，由它逐个通知工作进程退出
+        process = subprocess.Popen([sys.executable, *self.argv], env=env, start_new_session=True)
+        self.processes[index] = process
+        self._started_at[index] = time.time()
+        print(f"[START] 启动工作进程 {index}/{self.num_workers}，PID: {process.pid}")
+
+    def _check(self, index: int):
+        """检查工作进程存活和心跳，必要时重启"""
+        process = self.processes[index]
+        now = time.time()
+        if process is not None and process.poll() is None:
+            heartbeat = self.stats.read(index)['heartbeat']
+            last_seen = max(heartbeat, self._started_at[index])
+            if now - last_seen < self.stale_after:
+                return
+            print(f"[WARNING] 工作进程 {index} 心跳超时 {now - last_seen:.0f} 秒，重启中...")
+            self._terminate(process)
+        if process is not None:
+            # 连续快速退出时指数退避，运行足够久后恢复
+            if now - self._started_at[index] > self.max_restart_delay:
+                self.restarts[index] = 0
+            delay = min(self.max_restart_delay, self.restart_delay * (2 ** self.restarts[index]))
+            self.restarts[index] += 1
+            self._next_start[index] = now + delay
+            self.processes[index] = None
+            print(f"[WARNING] 工作进程 {index} 已退出（返回码 {process.returncode}），{delay:.0f} 秒后重启")
+        if now >= self._next_start[index]:
+            self._spawn(index)
+
+    @staticmethod
+    def _terminate(process: subprocess.Popen, timeout: float = 15.0):
+        """先发SIGINT让工作进程刷新队列后退出，超时再强制结束"""
+        if process.poll() is not None:
+            return
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def summary(self) -> Dict[str, Any]:
+        """汇总所有工作进程的统计"""
+        now = time.time()
+        shards = self.stats.read_all()
+        total = {field: sum(shard[field] for shard in shards)
+                 for field in ('messages_received', 'rows_written', 'rows_failed', 'rows_dropped',
+                               'queue_depth', 'spool_pending', 'rows_per_second')}
+        total['workers_alive'] = sum(1 for p in self.processes if p is not None and p.poll() is None)
+        total['workers_connected'] = sum(1 for shard in shards
+                                         if shard['connected'] and now - shard['heartbeat'] < self.stale_after)
+        total['restarts'] = sum(self.restarts)
+        total['shards'] = shards
+        return total
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"[STATS] 工作进程 {summary['workers_alive']}/{self.num_workers} 存活, "
+              f"{summary['workers_connected']} 个已连接, 重启 {summary['restarts']} 次")
+        print(f"[STATS] 合计: 收到 {summary['messages_received']:.0f} 条, 已写入 {summary['rows_written']:.0f} 条, "
+              f"{summary['rows_per_second']:.1f} 行/秒, 失败 {summary['rows_failed']:.0f} 条, "
+              f"丢弃 {summary['rows_dropped']:.0f} 条, 队列深度 {summary['queue_depth']:.0f}, "
+              f"本地缓冲待回放 {summary['spool_pending']:.0f} 条")
+        for index, shard in enumerate(summary['shards']):
+            print(f"[STATS] 工作进程 {index} (PID {shard['pid']:.0f}): "
+                  f"{'已连接' if shard['connected'] else '未连接'}, {shard['rows_per_second']:.1f} 行/秒, "
+                  f"累计 {shard['rows_written']:.0f} 条, 队列深度 {shard['queue_depth']:.0f}")
+
+    def run(self):
+        """启动全部工作进程并持续监督，直到收到Ctrl+C"""
+        self.stats = ShardStats(self.num_workers)
+        print(f"[START] 监督模式: {self.num_workers} 个工作进程, 分片方式: {self.mode}")
+        try:
+            for index in range(self.num_workers):
+                self._spawn(index)
+            last_report = time.monotonic()
+            while True:
+                time.sleep(1)
+                for index in range(self.num_workers):
+                    self._check(index)
+                if time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    self.print_summary()
+        except KeyboardInterrupt:
+            print("\n\n[STOP] 停止所有工作进程...")
+        finally:
+            self.stop()
+
+    def stop(self):
+        """停止所有工作进程并释放共享内存"""
+        if self._stopping:
+            return
+        self._stopping = True
+        for process in self.processes:
+            if process is not None and process.poll() is None:
+                try:
+                    process.send_signal(signal.SIGINT)
+                except ProcessLookupError:
+                    pass
+        for process in self.processes:
+            if process is not None:
+                try:
+                    process.wait(15.0)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+        if self.stats:
+            self.stats.close()
+        print("[OK] 所有工作进程已停止")
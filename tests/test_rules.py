@@ -0,0 +1,61 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ingestor_rules
+from ingestor_rules import RuleEngine
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _row(temperature):
+    return {"packsn": "P1", "cell_voltages": [3.3, 3.3], "cell_socs": [50, 50],
+            "cell_temperatures": [temperature, temperature]}
+
+
+def _engine(monkeypatch, **thresholds):
+    clock = _Clock()
+    monkeypatch.setattr(ingestor_rules.time, "monotonic", clock)
+    return RuleEngine(thresholds, min_rate_interval=1.0, repeat_interval=300.0), clock
+
+
+def test_rate_alert_stays_active_between_rate_samples(monkeypatch):
+    # 每0.6秒升温5°C：间隔不足min_rate_interval的行无法计算变化速率，不能把告警当作已恢复
+    engine, clock = _engine(monkeypatch, temperature_rate_max=1.0)
+    states = []
+    temperature = 25.0
+    for _ in range(10):
+        states += [alert["state"] for alert in engine.evaluate(_row(temperature))]
+        clock.now += 0.6
+        temperature += 5.0
+    assert states == ["raised"]
+    assert engine.active_alerts() == {"P1": ["temperature_rate"]}
+
+
+def test_rate_alert_clears_when_evaluated_below_threshold(monkeypatch):
+    engine, clock = _engine(monkeypatch, temperature_rate_max=1.0)
+    engine.evaluate(_row(25.0))
+    clock.now += 1.0
+    assert [alert["state"] for alert in engine.evaluate(_row(35.0))] == ["raised"]
+    clock.now += 0.5
+    assert engine.evaluate(_row(35.0)) == []
+    clock.now += 1.0
+    assert [alert["state"] for alert in engine.evaluate(_row(35.0))] == ["cleared"]
+
+
+def test_missing_field_keeps_alert_active(monkeypatch):
+    engine, clock = _engine(monkeypatch, temperature_max=40.0)
+    assert [alert["state"] for alert in engine.evaluate(_row(45.0))] == ["raised"]
+    row = _row(45.0)
+    del row["cell_temperatures"]
+    clock.now += 1.0
+    assert engine.evaluate(row) == []
+    clock.now += 1.0
+    assert [alert["state"] for alert in engine.evaluate(_row(30.0))] == ["cleared"]